@@ -0,0 +1,152 @@
+"""
+Reader for NGDP archive .index files.
+An index lists, for every encoded file stored in its archive, the file's
+ekey, size and offset in the archive.
+"""
+
+import struct
+from collections import namedtuple
+from hashlib import md5
+from math import ceil
+
+
+FOOTER_SIZE = 28
+BLOCK_SIZE = 4096
+# Each block of entries is listed in the table of contents with its last
+# key (16 bytes) and the first 8 bytes of its md5
+TOC_ENTRY_SIZE = 24
+
+IndexEntry = namedtuple("IndexEntry", ("ekey", "size", "offset"))
+
+
+class ArchiveIndexError(Exception):
+	pass
+
+
+class ArchiveIndex(object):
+	def __init__(self, data):
+		data = memoryview(data)
+		if len(data) < FOOTER_SIZE:
+			raise ArchiveIndexError("Index too short: %i bytes" % (len(data)))
+
+		footer = data[-FOOTER_SIZE:]
+		(
+			self.version, _, _, block_kb, self.offset_bytes, self.size_bytes,
+			self.key_bytes, self.checksum_size,
+		) = struct.unpack_from("8B", footer, 8)
+		self.count, = struct.unpack_from("<i", footer, 16)
+		self.block_size = block_kb * 1024
+		self.entry_size = self.key_bytes + self.size_bytes + self.offset_bytes
+		if not self.entry_size or not self.block_size:
+			raise ArchiveIndexError("Bad index footer: %r" % (bytes(footer)))
+		self.data = data
+
+	def __repr__(self):
+		return "<%s: %i entries>" % (self.__class__.__name__, len(self))
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		"Yields an IndexEntry (with a hex ekey) for every entry"
+		for ekey, size, offset in self.raw_entries():
+			yield IndexEntry(ekey.hex(), size, offset)
+
+	def raw_entries(self):
+		"Yields (ekey digest, size, offset) for every entry"
+		data = self.data
+		key_bytes, size_bytes, offset_bytes = self.key_bytes, self.size_bytes, self.offset_bytes
+		per_block = self.block_size // self.entry_size
+		remaining = self.count
+		block = 0
+		while remaining > 0:
+			pos = block * self.block_size
+			for i in range(min(per_block, remaining)):
+				ekey = bytes(data[pos:pos+key_bytes])
+				pos += key_bytes
+				size = int.from_bytes(data[pos:pos+size_bytes], "big")
+				pos += size_bytes
+				offset = int.from_bytes(data[pos:pos+offset_bytes], "big")
+				pos += offset_bytes
+				remaining -= 1
+				if not any(ekey):
+					# padding
+					continue
+				yield ekey, size, offset
+			block += 1
+
+	@property
+	def archive_size(self):
+		"Lower bound of the archive size: the end of its last entry"
+		return max((offset + size for ekey, size, offset in self.raw_entries()), default=0)
+
+	@property
+	def total_size(self):
+		return sum(size for ekey, size, offset in self.raw_entries())
+
+
+class IndexHasher(object):
+	"""
+	Checks the checksums of an index while it is being received: blocks
+	are hashed as soon as they are complete and only the tail of the data
+	(the table of contents and footer) is kept for error().
+	"""
+	def __init__(self):
+		self.size = 0
+		self.digests = []
+		self._block = bytearray()
+		self._tail = bytearray()
+
+	def __repr__(self):
+		return "<%s: %i bytes>" % (self.__class__.__name__, self.size)
+
+	def update(self, data):
+		data = memoryview(data)
+		self.size += len(data)
+
+		pos = 0
+		if self._block:
+			pos = min(BLOCK_SIZE - len(self._block), len(data))
+			self._block += data[:pos]
+			if len(self._block) == BLOCK_SIZE:
+				self.digests.append(md5(self._block).digest()[:8])
+				self._block = bytearray()
+		while pos + BLOCK_SIZE <= len(data):
+			self.digests.append(md5(data[pos:pos+BLOCK_SIZE]).digest()[:8])
+			pos += BLOCK_SIZE
+		self._block += data[pos:]
+
+		# The table of contents can only grow as fast as the blocks it lists
+		keep = (self.size // (BLOCK_SIZE + TOC_ENTRY_SIZE) + 1) * TOC_ENTRY_SIZE + FOOTER_SIZE
+		self._tail += data[-keep:]
+		if len(self._tail) > 2 * keep:
+			del self._tail[:-keep]
+
+	def error(self):
+		"Returns what is wrong with the index, or None if its checksums match"
+		if self.size < FOOTER_SIZE:
+			return "truncated (%i bytes)" % (self.size)
+		tail = self._tail
+		start = self.size - len(tail)
+		entries, = struct.unpack_from("<i", tail, len(tail) - 12)
+		blocks = ceil(entries / (BLOCK_SIZE // TOC_ENTRY_SIZE))
+		toc_end = len(tail) - FOOTER_SIZE
+		toc_start = toc_end - blocks * TOC_ENTRY_SIZE
+		if toc_start < 0 or start + toc_start < blocks * BLOCK_SIZE:
+			return "truncated (%i bytes for %i entries)" % (self.size, entries)
+
+		index_hash = md5(tail[toc_start:toc_end]).digest()[:8]
+		hash_chk = bytes(tail[toc_end:toc_end+8])
+		if index_hash != hash_chk:
+			return "%r != %r" % (index_hash, hash_chk)
+
+		for i in range(blocks):
+			pos = blocks * (BLOCK_SIZE + 16) + i * 8 - start
+			hash_chk = bytes(tail[pos:pos+8]) if pos >= 0 else b""
+			if self.digests[i] != hash_chk:
+				return "%r != %r for block %r" % (self.digests[i], hash_chk, i)
+
+
+def load(path):
+	with open(path, "rb") as f:
+		return ArchiveIndex(f.read())
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the NGDP/BPP transport paths against a local fake CDN.
+Usage:
+	bench.py [--archives N] [--entries N] [--archive-size BYTES] [--json results.json]
+	bench.py --startup [--repeat N]
+
+A local HTTP server generates synthetic /versions, /cdns, configs,
+archives, .index files, catalogs and BPP responses, so nothing touches
+the real CDN. Each benchmark reports throughput, per-call latency and
+peak traced memory (tracemalloc adds some overhead to the timings).
+--startup measures the cold-start time of the command line tools instead.
+"""
+
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from math import ceil
+from struct import pack
+from xml.sax.saxutils import escape, quoteattr
+
+import bpp
+
+
+CDN_PATH = "tpr/bench"
+CLOG_PATH = "catalogs/bench"
+# Commands timed by --startup (arguments to patchtools.py, or to python for the baseline)
+STARTUP_COMMANDS = (
+	("python", ["-c", "pass"]),
+	("patchtools", ["--help"]),
+	("patchtools ngdp", ["ngdp", "--help"]),
+	("patchtools runner", ["runner", "--help"]),
+	("import bpp", ["-c", "import bpp"]),
+)
+BLOCK = os.urandom(1 << 20)
+
+
+def _hash(hash):
+	return "%s/%s/%s" % (hash[0:2], hash[2:4], hash)
+
+
+def make_index(entries, archive_size):
+	"Build a valid archive .index with the given number of entries"
+	keys = sorted(os.urandom(16) for i in range(entries))
+	size = max(archive_size // max(entries, 1), 1)
+	blocks = ceil(entries / 170)
+
+	data, toc, block_hashes = [], [], []
+	for i in range(blocks):
+		chunk = keys[i*170:(i+1)*170]
+		block = b"".join(key + pack(">II", size, j * size) for j, key in enumerate(chunk, i*170))
+		block = block.ljust(4096, b"\0")
+		data.append(block)
+		toc.append(chunk[-1])
+		block_hashes.append(md5(block).digest()[:8])
+
+	toc = b"".join(toc) + b"".join(block_hashes)
+	footer = md5(toc).digest()[:8] + bytes((1, 0, 0, 4, 4, 4, 16, 8)) + pack("i", entries)
+	footer += md5(footer[8:] + b"\0" * 8).digest()[:8]
+	return b"".join(data) + toc + footer
+
+
+class FakeCDN(object):
+	"""
+	Synthetic patch server and CDN contents, served from memory.
+	Archives are generated on the fly so that large scales fit in RAM.
+	"""
+	def __init__(self, archives, entries, archive_size, catalog_files, records):
+		self.files = {}
+		self.archives = {}
+		self.archive_size = archive_size
+		self.records = records
+
+		archive_hashes = []
+		for i in range(archives):
+			hash = md5(b"archive %i" % (i)).hexdigest()
+			archive_hashes.append(hash)
+			self.archives[hash] = archive_size
+			self.files["/%s/data/%s.index" % (CDN_PATH, _hash(hash))] = make_index(entries, archive_size)
+
+		self.cdnconfig = self.add_config("# CDN Configuration\n\narchives = %s\n" % (" ".join(archive_hashes)))
+		self.buildconfig = self.add_config("# Build Configuration\n\nroot = %s\n" % (md5(b"root").hexdigest()))
+		self.configs = [self.cdnconfig, self.buildconfig]
+
+		lookup = {}
+		for i in range(catalog_files):
+			lookup["file%i.json" % (i)] = self.add_catalog({"file": i, "data": "x" * 512})
+		region = self.add_catalog({"installs": {}})
+		self.catalog = self.add_catalog({
+			"catalogs": {"enus": {"hash": region}},
+			"manifest": {"lookup": lookup},
+		})
+
+	def add_config(self, text):
+		data = text.encode("utf-8")
+		hash = md5(data).hexdigest()
+		self.files["/%s/config/%s" % (CDN_PATH, _hash(hash))] = data
+		return hash
+
+	def add_catalog(self, obj):
+		data = json.dumps(obj).encode("utf-8")
+		hash = md5(data).hexdigest()
+		self.files["/%s/%s" % (CLOG_PATH, _hash(hash))] = data
+		return hash
+
+	def serve(self):
+		cdn = self
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+
+			def log_message(self, *args):
+				pass
+
+			def _send(self, data, type="application/octet-stream"):
+				self.send_response(200)
+				self.send_header("Content-Type", type)
+				self.send_header("Content-Length", str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+
+			def do_GET(self):
+				host = "127.0.0.1:%i" % (self.server.server_port)
+				if self.path == "/bench/versions":
+					text = "Region!STRING:0|BuildConfig!HEX:16|CDNConfig!HEX:16|BuildId!DEC:4|VersionsName!String:0\n"
+					text += "us|%s|%s|1|1.0.0.1\n" % (cdn.buildconfig, cdn.cdnconfig)
+					return self._send(text.encode("utf-8"), "text/plain")
+				if self.path == "/bench/cdns":
+					text = "Name!STRING:0|Path!STRING:0|Hosts!STRING:0\nus|%s|%s\n" % (CDN_PATH, host)
+					return self._send(text.encode("utf-8"), "text/plain")
+				if self.path in cdn.files:
+					return self._send(cdn.files[self.path])
+
+				hash = self.path.rsplit("/", 1)[-1]
+				if self.path.startswith("/%s/data/" % (CDN_PATH)) and hash in cdn.archives:
+					size = cdn.archives[hash]
+					self.send_response(200)
+					self.send_header("Content-Length", str(size))
+					self.end_headers()
+					while size > 0:
+						chunk = BLOCK[:size]
+						self.wfile.write(chunk)
+						size -= len(chunk)
+					return
+
+				self.send_error(404)
+
+			def do_POST(self):
+				self.rfile.read(int(self.headers.get("Content-Length", 0)))
+				xml = ["<patch>"]
+				for i in range(cdn.records):
+					text = "http://127.0.0.1/config.xml;%032x;%032x;%i" % (i, i, i)
+					xml.append("<record program=%s component=\"enUS\">%s</record>" % (quoteattr("P%i" % (i)), escape(text)))
+				xml.append("</patch>")
+				self._send("".join(xml).encode("utf-8"), "text/xml")
+
+		self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		self.server.daemon_threads = True
+		thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		thread.start()
+		return "127.0.0.1:%i" % (self.server.server_port)
+
+	def shutdown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+
+class Result(object):
+	def __init__(self, name):
+		self.name = name
+		self.latencies = []
+		self.bytes = 0
+		self.elapsed = 0
+		self.peak_memory = 0
+
+	def percentile(self, p):
+		if not self.latencies:
+			return 0
+		latencies = sorted(self.latencies)
+		return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+	def as_dict(self):
+		return {
+			"name": self.name,
+			"calls": len(self.latencies),
+			"bytes": self.bytes,
+			"elapsed": self.elapsed,
+			"throughput": self.bytes / self.elapsed if self.elapsed else 0,
+			"latency_p50": self.percentile(0.5),
+			"latency_p95": self.percentile(0.95),
+			"latency_max": max(self.latencies or [0]),
+			"peak_memory": self.peak_memory,
+		}
+
+	def __str__(self):
+		d = self.as_dict()
+		return "%-24s %6i calls %10.2f MiB/s  p50 %7.2fms  p95 %7.2fms  peak %8.1f KiB" % (
+			self.name, d["calls"], d["throughput"] / (1 << 20),
+			d["latency_p50"] * 1000, d["latency_p95"] * 1000, d["peak_memory"] / 1024,
+		)
+
+
+def measure(name, func, items, size=lambda item, ret: 0):
+	"Call func on every item, recording latency, bytes and peak memory"
+	result = Result(name)
+	tracemalloc.start()
+	start = time.perf_counter()
+	for item in items:
+		t = time.perf_counter()
+		ret = func(item)
+		result.latencies.append(time.perf_counter() - t)
+		result.bytes += size(item, ret)
+	result.elapsed = time.perf_counter() - start
+	result.peak_memory = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return result
+
+
+def run(args):
+	cdn = FakeCDN(args.archives, args.entries, args.archive_size, args.catalog_files, args.records)
+	host = cdn.serve()
+	save_path = tempfile.mkdtemp(prefix="patchtools-bench-")
+	results = []
+
+	try:
+		ngdp = bpp.NGDPConnection("http://%s/bench" % (host), save_path)
+		cdns = ngdp.cdns
+		ngdp.set_cdn(cdns.get(cdns.rows[0], "hosts").split()[0], cdns.get(cdns.rows[0], "path"))
+		file_size = lambda item, path: os.path.getsize(path) if path else 0
+
+		results.append(measure("cache_hash(config)", lambda hash: ngdp.cache_hash(hash, type="config"), cdn.configs, file_size))
+		results.append(measure("cache_data_index", lambda hash: ngdp.cache_data_index(hash) or ngdp.get_paths(hash, "index")[1], cdn.archives, file_size))
+		results.append(measure("cache_hash(data)", lambda hash: ngdp.cache_hash(hash, type="data"), cdn.archives, file_size))
+
+		def preload(i):
+			# Measure cold loads, parsing included
+			bpp.JSON_CACHE.clear()
+			catalog = bpp.Catalog(host, CLOG_PATH, cdn.catalog, save_path=os.path.join(save_path, str(i)))
+			catalog.preload()
+		catalog_size = sum(len(data) for path, data in cdn.files.items() if path.startswith("/" + CLOG_PATH))
+		results.append(measure("Catalog.preload", preload, range(args.repeat), lambda item, ret: catalog_size))
+
+		def open_bpp(i):
+			conn = bpp.BPPConnection(program="Bench")
+			for j in range(args.records):
+				conn.addRecord(program="P%i" % (j), component="enUS", version="1")
+			return conn.open("http://%s/patch" % (host))
+		results.append(measure("BPPConnection.open", open_bpp, range(args.repeat), lambda item, ret: sum(len(r.text) for r in ret)))
+	finally:
+		cdn.shutdown()
+		shutil.rmtree(save_path, ignore_errors=True)
+
+	return results
+
+
+def startup(repeat):
+	"Time fresh interpreters running each of STARTUP_COMMANDS"
+	here = os.path.dirname(os.path.abspath(__file__))
+	results = []
+	for name, args in STARTUP_COMMANDS:
+		if args[0] != "-c":
+			args = [os.path.join(here, "patchtools.py")] + args
+		run = lambda i: subprocess.run([sys.executable] + args, cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		results.append(measure(name, run, range(repeat)))
+	return results
+
+
+def main():
+	arguments = ArgumentParser(prog="bench")
+	arguments.add_argument("--archives", type=int, default=200, help="number of data archives")
+	arguments.add_argument("--entries", type=int, default=5000, help="entries per archive .index")
+	arguments.add_argument("--archive-size", type=int, default=4 << 20, help="size of each data archive in bytes")
+	arguments.add_argument("--catalog-files", type=int, default=200, help="number of files in the catalog manifest")
+	arguments.add_argument("--records", type=int, default=300, help="records per BPP request")
+	arguments.add_argument("--repeat", type=int, default=20, help="repetitions of the catalog and BPP benchmarks")
+	arguments.add_argument("--json", type=str, dest="json", help="write the results to this file as JSON")
+	arguments.add_argument("--startup", action="store_true", dest="startup", help="measure the start-up time of the command line tools")
+	args = arguments.parse_args(sys.argv[1:])
+
+	logging.getLogger().setLevel(logging.WARNING)
+	results = startup(args.repeat) if args.startup else run(args)
+	for result in results:
+		print(result)
+
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump([result.as_dict() for result in results], f, indent="\t")
+
+
+if __name__ == "__main__":
+	main()
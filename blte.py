@@ -0,0 +1,83 @@
+"""
+BLTE (Block Table Encoded) decoding, as used by NGDP data files.
+"""
+
+import struct
+import zlib
+from hashlib import md5
+
+
+class BLTEError(Exception):
+	pass
+
+
+def _header(data):
+	magic, header_size = struct.unpack_from(">4sI", data)
+	if magic != b"BLTE":
+		raise BLTEError("Bad BLTE magic: %r" % (magic))
+	return header_size
+
+
+def ekey(data):
+	"""
+	Returns the encoding key of a BLTE blob: the md5 of its header, or
+	of the whole blob if it has no chunk table.
+	"""
+	header_size = _header(data)
+	if not header_size:
+		return md5(data).hexdigest()
+	return md5(bytes(data[:header_size])).hexdigest()
+
+
+def _decode_chunk(chunk):
+	mode = chunk[:1]
+	if mode == b"N":
+		return bytes(chunk[1:])
+	elif mode == b"Z":
+		return zlib.decompress(chunk[1:])
+	elif mode == b"F":
+		return decode(chunk[1:])
+	elif mode == b"E":
+		raise BLTEError("Encrypted BLTE chunks are not supported")
+	raise BLTEError("Unknown BLTE chunk mode: %r" % (mode))
+
+
+def decode(data, verify=True):
+	"Decode a BLTE blob, checking the md5 of each chunk if verify is set"
+	data = memoryview(data)
+	header_size = _header(data)
+	if not header_size:
+		# Single chunk, no chunk table
+		return _decode_chunk(data[8:])
+
+	flags = data[8]
+	chunk_count = int.from_bytes(data[9:12], "big")
+	if flags != 0x0f:
+		raise BLTEError("Unknown BLTE flags: %#x" % (flags))
+
+	ret = []
+	pos = header_size
+	for i in range(chunk_count):
+		compressed_size, decompressed_size, checksum = struct.unpack_from(">II16s", data, 12 + i * 24)
+		chunk = data[pos:pos+compressed_size]
+		if verify and md5(chunk).digest() != checksum:
+			raise BLTEError("Checksum mismatch for BLTE chunk %i" % (i))
+		decoded = _decode_chunk(chunk)
+		if len(decoded) != decompressed_size:
+			raise BLTEError("BLTE chunk %i: expected %i bytes, got %i" % (i, decompressed_size, len(decoded)))
+		ret.append(decoded)
+		pos += compressed_size
+
+	return b"".join(ret)
+
+
+def encode(data, mode=b"Z"):
+	"Encode data as a single-chunk BLTE blob (used by the tests)"
+	if mode == b"Z":
+		chunk = b"Z" + zlib.compress(data)
+	else:
+		chunk = b"N" + data
+	header_size = 12 + 24
+	header = struct.pack(">4sIB", b"BLTE", header_size, 0x0f) + (1).to_bytes(3, "big")
+	header += struct.pack(">II16s", len(chunk), len(data), md5(chunk).digest())
+	return header + chunk
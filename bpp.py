@@ -6,69 +6,195 @@ Blizzard patching protocol
 import json
 import logging
 import os
+import re
 import struct
-import requests
+import sys
+import threading
+import time
+import metrics
+import retry
 import simplestore
+import storage
+from array import array
 from binascii import hexlify
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from coordinator import COORDINATOR
 from hashlib import md5
-from io import BytesIO
-from math import ceil
+from lru import LRUCache
+from retry import FetchError
 from urllib.parse import urlparse
-from urllib.request import urlopen
-from urllib.error import HTTPError
-from xml.dom.minidom import getDOMImplementation, parseString
-from xml.parsers.expat import ExpatError
+from xml.parsers.expat import ExpatError, ParserCreate
 
 
 Record = namedtuple("Record", ("program", "component", "version"))
 ResponseRecord = namedtuple("Record", ("program", "component", "text"))
-logging.basicConfig(level=logging.DEBUG)
+MD5_REGEX = re.compile(r"[0-9a-f]{32}", re.I)
+RANGE_GAP = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+# Archive type -> type of its .index
+INDEX_TYPES = {"data": "index", "patch": "patch-index"}
 
 
 class ServerError(Exception):
 	pass
 
 
-class BPPConnection(object):
-	def __init__(self, program):
-		self.program = program
+def dump_request(program, records):
+	"Serialize a BPP request for program with the given records to XML bytes"
+	# saxutils pulls in urllib.request, keep it off the import path
+	from xml.sax.saxutils import quoteattr
+
+	xml = ["<version program=%s>" % (quoteattr(program))]
+	for record in records:
+		xml.append("<record program=%s component=%s version=%s/>" % (
+			quoteattr(record.program), quoteattr(record.component), quoteattr(str(record.version))
+		))
+	xml.append("</version>")
+	return "".join(xml).encode("utf-8")
+
+
+class ResponseParser(object):
+	"""
+	Incremental expat parser for BPP responses.
+	Feed it the response as it comes in; each ResponseRecord is appended
+	to `records` as soon as its element is closed.
+	"""
+	def __init__(self):
 		self.records = []
+		self._attrs = None
+		self._text = []
+		self._parser = ParserCreate()
+		self._parser.buffer_text = True
+		self._parser.StartElementHandler = self._start
+		self._parser.EndElementHandler = self._end
+		self._parser.CharacterDataHandler = self._data
+
+	def _start(self, name, attrs):
+		if name == "record":
+			self._attrs = attrs
+			self._text = []
+
+	def _end(self, name):
+		if name == "record" and self._attrs is not None:
+			attrs = self._attrs
+			text = "".join(self._text).strip()
+			self.records.append(ResponseRecord(attrs.get("program", ""), attrs.get("component", ""), text))
+			self._attrs = None
+
+	def _data(self, data):
+		if self._attrs is not None:
+			self._text.append(data)
+
+	def feed(self, data, final=False):
+		try:
+			self._parser.Parse(data, final)
+		except ExpatError as e:
+			raise ServerError("Invalid XML response: %s" % (e))
 
-	def getXML(self):
-		dom = getDOMImplementation().createDocument(None, "version", None)
-		dom.documentElement.setAttribute("program", self.program)
-		for record in self.records:
-			e = dom.createElement("record")
-			e.setAttribute("program", record.program)
-			e.setAttribute("component", record.component)
-			e.setAttribute("version", record.version)
-			dom.documentElement.appendChild(e)
+	def close(self):
+		self.feed(b"", True)
+		return self.records
 
-		return dom.documentElement.toxml("utf-8")
 
-	def open(self, server):
-		xml = self.getXML()
-		logging.debug("Posting XML to %r: %r", server, xml)
+def _post(server, xml, chunk_size=8192):
+	"Helper that POSTs xml to server and parses the response as it streams in"
+	logging.debug("Posting XML to %r: %r", server, xml)
 
-		try:
-			f = urlopen(server, xml)
-		except HTTPError as e:
-			raise ServerError("Could not open %s: %s" % (server, e))
+	start = time.perf_counter()
+	try:
+		f = _urlopen(server, "bpp", xml)
+	except IOError as e:
+		metrics.request(server, "bpp", 0, time.perf_counter() - start, getattr(e, "code", "error"))
+		raise ServerError("Could not open %s: %s" % (server, e))
 
-		response = f.read()
-		if not response:
-			raise ServerError("No response from server")
+	parser = ResponseParser()
+	size = 0
+	while True:
+		chunk = f.read(chunk_size)
+		if not chunk:
+			break
+		size += len(chunk)
+		parser.feed(chunk)
+
+	metrics.request(server, "bpp", size, time.perf_counter() - start, f.status)
+	if not size:
+		raise ServerError("No response from server")
 
-		self.responseRecords = []
-		for e in parseString(response).getElementsByTagName("record"):
-			record = ResponseRecord(e.getAttribute("program"), e.getAttribute("component"), e.firstChild.data.strip())
-			self.responseRecords.append(record)
+	return parser.close()
 
+
+class BPPConnection(object):
+	def __init__(self, program):
+		self.program = program
+		self.records = []
+
+	def getXML(self):
+		return dump_request(self.program, self.records)
+
+	def open(self, server):
+		self.responseRecords = _post(server, self.getXML())
 		return self.responseRecords
 
 	def addRecord(self, program, component, version):
-		self.records.append(Record(program, component, version))
+		self.records.append(Record(program, component, str(version)))
+
+
+class BPPBatch(object):
+	"""
+	Sends the records of several BPPConnections in as few POSTs as possible.
+	Connections to the same server with the same program are merged and
+	their records deduplicated, then split in chunks of at most
+	max_records (the most the patch server accepts in a single request).
+	"""
+	MAX_RECORDS = 64
+
+	def __init__(self, max_records=MAX_RECORDS):
+		self.max_records = max_records
+		self._queue = []
+
+	def add(self, connection, server):
+		self._queue.append((connection, server))
+
+	def requests(self):
+		"""
+		Returns a list of (server, program, records) tuples, one per POST.
+		"""
+		groups = OrderedDict()
+		for connection, server in self._queue:
+			records = groups.setdefault((server, connection.program), OrderedDict())
+			for record in connection.records:
+				records[record] = None
+
+		ret = []
+		for (server, program), records in groups.items():
+			records = list(records)
+			for i in range(0, len(records), self.max_records):
+				ret.append((server, program, records[i:i + self.max_records]))
+		return ret
+
+	def open(self, executor=None):
+		"""
+		POST every request (concurrently if an executor is given) and
+		return a dict mapping each connection to its response records.
+		"""
+		posts = self.requests()
+		if executor is not None:
+			futures = [executor.submit(_post, server, dump_request(program, records)) for server, program, records in posts]
+			responses = [future.result() for future in futures]
+		else:
+			responses = [_post(server, dump_request(program, records)) for server, program, records in posts]
+
+		merged = {}
+		for (server, program, records), response in zip(posts, responses):
+			merged.setdefault((server, program), []).extend(response)
+
+		ret = OrderedDict()
+		for connection, server in self._queue:
+			wanted = {(record.program, record.component) for record in connection.records}
+			response = merged[(server, connection.program)]
+			connection.responseRecords = [r for r in response if (r.program, r.component) in wanted]
+			ret[connection] = connection.responseRecords
+		return ret
 
 
 class BlizzardCSV(object):
@@ -92,13 +218,18 @@ class BlizzardCSV(object):
 
 
 class NGDPConnection(object):
-	def __init__(self, server, save_path):
+	def __init__(self, server, save_path, scheduler=None):
 		self.server = server
 		self.save_path = save_path
 		self.base_path = None
+		self.scheduler = scheduler
 
 		self.cdn = None
+		self.hosts = []
 		self._cache = {}
+		self._encodings = {}
+		self._configs = {}
+		self._rows = None
 
 	def _cached_csv(self, path):
 		if path not in self._cache:
@@ -106,7 +237,7 @@ class NGDPConnection(object):
 		return self._cache[path]
 
 	def _query(self, path):
-		r = requests.get(self.server + path)
+		r = _get(self.server + path, path.lstrip("/"), self.scheduler)
 		return r
 
 	@property
@@ -134,7 +265,59 @@ class NGDPConnection(object):
 		versions = self.versions
 		return [versions.get(row, "region") for row in versions.rows]
 
-	def _get_config(self, region, column):
+	def _region_rows(self, region):
+		"Returns the versions rows of region"
+		if self._rows is None:
+			versions = self.versions
+			self._rows = {}
+			for row in versions.rows:
+				self._rows.setdefault(versions.get(row, "region"), []).append(row)
+		return self._rows.get(region, [])
+
+	def merge_versions(self, servers):
+		"""
+		Query the versions of other endpoints of the same product (eg. the
+		other region codes of its patch server) concurrently, and add the
+		rows of the regions this server does not list.
+		"""
+		from concurrent.futures import ThreadPoolExecutor
+
+		def query(server):
+			try:
+				r = _get(server + "/versions", "versions", self.scheduler)
+			except IOError as e:
+				logging.warning("Could not query %r: %s", server, e)
+				return None
+			if r.status_code != 200:
+				logging.warning("Could not query %r: HTTP %r", server, r.status_code)
+				return None
+			return BlizzardCSV(r.text)
+
+		versions = self.versions
+		known = set(self.regions)
+		with ThreadPoolExecutor(max(len(servers), 1)) as executor:
+			for server, csv in zip(servers, executor.map(query, servers)):
+				if csv is None:
+					continue
+				if csv.column_names != versions.column_names:
+					logging.warning("Ignoring the versions of %r: columns %r != %r", server, csv.column_names, versions.column_names)
+					continue
+				for row in csv.rows:
+					region = csv.get(row, "region")
+					if region not in known:
+						known.add(region)
+						versions.rows.append(row)
+		self._rows = None
+
+	def region_groups(self):
+		"Returns an OrderedDict of (buildconfig, cdnconfig) -> the regions using that build"
+		ret = OrderedDict()
+		for region in self.regions:
+			key = (self.version(region, "buildconfig"), self.version(region, "cdnconfig"))
+			ret.setdefault(key, []).append(region)
+		return ret
+
+	def _default_cdn(self):
 		if not self.cdn:
 			cdns = self.cdns
 			assert cdns.rows, repr(cdns.text)
@@ -142,20 +325,38 @@ class NGDPConnection(object):
 			path = cdns.get(cdns.rows[0], "path")
 			logging.info("Defaulting CDN host to %r (choices: %r)", hosts[0], hosts)
 			self.set_cdn(hosts[0], path)
+			self.hosts = hosts
 
+	def _get_config(self, region, column):
+		self._default_cdn()
 		versions = self.versions
-		for row in versions.rows:
-			if versions.get(row, "region") == region:
-				hash = versions.get(row, column)
-				path = self.cache_hash(hash, type="config")
-				if path is None:
-					logging.warn("WARNING: %r missing. Ignoring..." % (hash))
-					continue
-				with open(path, "r") as f:
-					return simplestore.load(f)
+		for row in self._region_rows(region):
+			hash = versions.get(row, column)
+			config = self.config(hash)
+			if config is None:
+				logging.warn("WARNING: %r missing. Ignoring..." % (hash))
+				continue
+			return config
 
 		return {}
 
+	def config(self, hash):
+		"Returns the parsed config for hash, or None if it could not be fetched"
+		if hash in self._configs:
+			return self._configs[hash]
+		self._default_cdn()
+		path = self.cache_hash(hash, type="config")
+		if path is None:
+			return None
+		self._configs[hash] = simplestore.load_cached(path, hash)
+		return self._configs[hash]
+
+	def version(self, region, column):
+		"Returns the value of column in the versions row for region"
+		rows = self._region_rows(region)
+		if rows:
+			return self.versions.get(rows[0], column)
+
 	def _data_md5(self, data):
 		h = data.read(8)
 		magic, header_size = struct.unpack(">4si", h)
@@ -169,53 +370,201 @@ class NGDPConnection(object):
 	def cdn_config(self, region="xx"):
 		return self._get_config(region, "cdnconfig")
 
+	def encoding(self, region="xx", verify=True):
+		"""
+		Returns the EncodingTable of the build for region.
+		Requires NumPy.
+		"""
+		from encoding import EncodingTable
+
+		ckey, ekey = self.build_config(region)["encoding"][:2]
+		if ekey not in self._encodings:
+			self._encodings[ekey] = EncodingTable(self.decoded(ckey, ekey, verify), verify=verify)
+		return self._encodings[ekey]
+
+	def decoded(self, ckey, ekey, verify=True):
+		"Cache the loose BLTE data file ekey and return its decoded content"
+		import blte
+
+		path = self.cache_hash(ekey, type="data", index=False)
+		if path is None:
+			raise ServerError("Could not fetch %r" % (ekey))
+		with open(path, "rb") as f:
+			data = blte.decode(f.read(), verify=verify)
+		if verify and md5(data).hexdigest() != ckey:
+			raise ServerError("%r does not match its content key %r" % (ekey, ckey))
+		return data
+
+	def install_manifest(self, region="xx", verify=True):
+		"Returns the InstallManifest of the build for region"
+		from install import InstallManifest
+
+		keys = self.build_config(region)["install"]
+		if isinstance(keys, str) or len(keys) < 2:
+			# Only the content key is listed, resolve it through the encoding table
+			ckey = keys if isinstance(keys, str) else keys[0]
+			ekey = self.encoding(region, verify).get(ckey)
+		else:
+			ckey, ekey = keys[:2]
+		return InstallManifest(self.decoded(ckey, ekey, verify))
+
+	def patch_manifest(self, region="xx", verify=True):
+		"Returns the PatchManifest of the build for region, or None if it has none"
+		from patch import PatchManifest
+
+		hash = self.build_config(region).get("patch")
+		if not hash:
+			return None
+		path = self.cache_hash(hash, type="patch", index=False)
+		if path is None:
+			raise ServerError("Could not fetch patch manifest %r" % (hash))
+		with open(path, "rb") as f:
+			data = f.read()
+		if verify and md5(data).hexdigest() != hash:
+			metrics.verify_failure(self.get_paths(hash, "patch")[0], "patch")
+			raise ServerError("Patch manifest %r does not match its hash" % (hash))
+		return PatchManifest(data, verify=verify)
+
+	def archive_index(self, hash, type="data"):
+		"Cache the .index of the data or patch archive hash and return it as an ArchiveIndex"
+		import archiveindex
+
+		self.cache_index(hash, type)
+		return archiveindex.load(self.get_paths(hash, INDEX_TYPES[type])[1])
+
+	def locate(self, ekeys, archives, type="data"):
+		"""
+		Find the given ekeys in the indexes of archives (data or patch archives).
+		Returns a dict of archive -> [(offset, size, ekey)] sorted by offset,
+		and the set of ekeys that are not in any archive (loose files).
+		"""
+		wanted = {bytes.fromhex(ekey) for ekey in ekeys}
+		ret = OrderedDict()
+		for archive in archives:
+			if not wanted:
+				break
+			for ekey, size, offset in self.archive_index(archive, type).raw_entries():
+				if ekey in wanted:
+					wanted.discard(ekey)
+					ret.setdefault(archive, []).append((offset, size, ekey.hex()))
+
+		for entries in ret.values():
+			entries.sort()
+		return ret, {ekey.hex() for ekey in wanted}
+
+	def cache_ranges(self, archive, entries, type="data", gap=RANGE_GAP):
+		"""
+		Cache the (offset, size, ekey) entries of archive as loose files,
+		fetching them with as few Range requests as possible: entries less
+		than gap bytes apart are fetched together. The entries of a range
+		are verified and written while the next range is being received.
+		Returns the number of bytes transferred.
+		"""
+		import blte
+		from pipeline import Stage
+
+		url = self.get_paths(archive, type)[0]
+		entries = [e for e in entries if not os.path.exists(self.get_paths(e[2], type)[1])]
+		ranges = []
+		for offset, size, ekey in entries:
+			if ranges and offset <= ranges[-1][1] + gap:
+				ranges[-1][1] = max(ranges[-1][1], offset + size)
+				ranges[-1][2].append((offset, size, ekey))
+			else:
+				ranges.append([offset, offset + size, [(offset, size, ekey)]])
+
+		def store(item):
+			start, members, content = item
+			data = memoryview(content)
+			for offset, size, ekey in members:
+				blob = data[offset-start:offset-start+size]
+				try:
+					valid = blte.ekey(blob) == ekey
+				except blte.BLTEError:
+					valid = False
+				if not valid:
+					metrics.verify_failure(url, type)
+					raise ServerError("%r at %s:%i does not match its ekey" % (ekey, archive, offset))
+				_write(self.get_paths(ekey, type)[1], blob)
+
+		transferred = 0
+		stage = Stage(store, depth=2, name="cache-ranges", inline=len(ranges) < 2)
+		try:
+			for start, end, members in ranges:
+				headers = {"Range": "bytes=%i-%i" % (start, end - 1)}
+				r = _get(url, type, self.scheduler, headers, self.mirrors(url))
+				if r.status_code != 206:
+					raise FetchError("Range request to %s failed: HTTP %r" % (url, r.status_code))
+				transferred += len(r.content)
+				stage.put((start, members, r.content))
+		finally:
+			stage.close()
+
+		return transferred
+
 	def cache_data_index(self, hash):
+		return self.cache_index(hash, "data")
+
+	def cache_index(self, hash, type="data"):
+		"Cache and verify the .index of the data or patch archive hash. Returns its path."
 		assert self.cdn
 		assert self.base_path
-		url, path = self.get_paths(hash, "index")
-		if not os.path.exists(path):
-			_prep_dir_for(path)
-			r = requests.get(url)
-			assert r.status_code == 200, r.status_code
-
-			# calculate the .index md5
-			data = BytesIO(r.content)
-			data.seek(-12, os.SEEK_END)
-			entries, = struct.unpack("i", data.read(4))
-			blocks = ceil(entries / 170)
-			blocks_len = blocks * 24
-
-			data.seek(-28 - blocks_len, os.SEEK_END)
-			index_hash = md5(data.read(blocks_len)).digest()
-			hash_chk = data.read(8)
-			# We only deal with 8 byte md5
-			assert index_hash[:8] == hash_chk, "%r != %r" % (index_hash[:8], hash_chk)
-
-			data.seek(0)
-			for i in range(blocks):
-				block_hash = md5(data.read(4096)).digest()
-				pos = data.tell()
-				data.seek(blocks * (4096+16) + i*8)
-				hash_chk = data.read(8)
-				assert block_hash[:8] == hash_chk, "%r != %r for block %r" % (block_hash[:8], hash_chk, i)
-				data.seek(pos)
-
-			# Write the file now
-			with open(path, "wb") as f:
-				logging.info("Writing to %r", path)
-				f.write(r.content)
+		url, path = self.get_paths(hash, INDEX_TYPES[type])
+		return COORDINATOR.fetch(path, self._cache_index, url, path, type)
+
+	def _cache_index(self, url, path, type):
+		index_type = INDEX_TYPES[type]
+		if os.path.exists(path):
+			metrics.cache_hit(url, index_type)
+		else:
+			metrics.cache_miss(url, index_type)
+			import archiveindex
+
+			def check(r, pipeline):
+				error = pipeline.hashers[0].error()
+				if error:
+					logging.error("Bad index at %s: %s", r.url, error)
+					metrics.verify_failure(r.url, index_type)
+				return not error
+
+			# The blocks are checked while the index is being written to path
+			logging.info("Writing to %r", path)
+			r = _download(url, index_type, path, self.scheduler, self.mirrors(url), lambda: [archiveindex.IndexHasher()], check)
+			if r.status_code != 200:
+				raise FetchError("Could not fetch %s: HTTP %r" % (url, r.status_code))
+		return path
 
-	def cache_hash(self, hash, type):
+	def cache_hash(self, hash, type, index=True):
+		"""
+		Cache the object hash of the given type (config, data, patch).
+		Data and patch archives also get their .index cached, unless index
+		is False (for loose files, such as the encoding table).
+		Returns the path it is stored at, or None if it could not be fetched.
+		"""
 		assert self.cdn
 		assert self.base_path
 		url, path = self.get_paths(hash, type)
-		if type == "data":
-			index = self.cache_data_index(hash)
-		if not os.path.exists(path):
-			_prep_dir_for(path)
+		# Outside of the memo of path, which does not depend on index
+		if type in INDEX_TYPES and index:
+			self.cache_index(hash, type)
+		return COORDINATOR.fetch(path, self._cache_hash, hash, type, url, path)
+
+	def _cache_hash(self, hash, type, url, path):
+		if type == "config":
+			# Configs are text, they may be stored compressed
+			path = storage.find(path) or path
+		if os.path.exists(path):
+			metrics.cache_hit(url, type)
+		else:
+			metrics.cache_miss(url, type)
 			logging.info("Downloading %r", url)
 			try:
-				r = requests.get(url)
+				if type == "config":
+					r = _get(url, type, self.scheduler, mirrors=self.mirrors(url), check=lambda r: _verify_md5(r, hash, type))
+				else:
+					# Streamed straight to disk. Data archives are checked
+					# against their .index offline, by fsck.py
+					r = _download(url, type, path, self.scheduler, self.mirrors(url))
 			except Exception:
 				logging.exception("Got exception while trying to resolve %r", url)
 				return None
@@ -224,28 +573,17 @@ class NGDPConnection(object):
 				logging.error("Got HTTP %r", r.status_code)
 				return None
 
-			if type == "data":
-				...
-				# download the .index file too
-
-				#content_hash = self._data_md5(BytesIO(r.content))
-				#if hash != content_hash:
-				#	print("%r != %r" % (hash, content_hash))
-
-			elif type == "config":
-				content_hash = md5(r.content).hexdigest()
-				assert hash == content_hash
-
-			with open(path, "wb") as f:
+			if type == "config":
 				logging.info("Writing to %r", path)
-				f.write(r.content)
+				path = storage.write(path, r.content)
 
 		return path
 
 	def get_paths(self, hash, type):
-		if type == "index":
-			url = "%s/%s/%s.index" % (self.cdn, "data", _hash(hash))
-			path = os.path.join(self.base_path, "data", _hash(hash) + ".index")
+		if type in ("index", "patch-index"):
+			dir = "data" if type == "index" else "patch"
+			url = "%s/%s/%s.index" % (self.cdn, dir, _hash(hash))
+			path = os.path.join(self.base_path, dir, _hash(hash) + ".index")
 		else:
 			url = "%s/%s/%s" % (self.cdn, type, _hash(hash))
 			path = os.path.join(self.base_path, type, _hash(hash))
@@ -255,20 +593,99 @@ class NGDPConnection(object):
 		self.cdn = "%s://%s/%s" % (scheme, host, path)
 		self.base_path = os.path.join(self.save_path, "NGDP", path)
 
+	def mirrors(self, url):
+		"Returns url on the other known CDN hosts, to fall back to when its host is failing"
+		host = urlparse(url).netloc
+		return [url.replace("//%s/" % (host), "//%s/" % (other), 1) for other in self.hosts if other != host]
+
 
 class ConfigurationError(Exception):
 	pass
 
 
 class TorrentFile(object):
-	def __init__(self, info):
-		self.info = info
-		self.path = "/".join(info["path"])
-		self.size = info["length"]
+	__slots__ = ("path", "size")
+
+	def __init__(self, path, size):
+		self.path = path
+		self.size = size
 
 	def __repr__(self):
 		return "%s(%r)" % (self.__class__.__name__, self.path)
 
+	def __eq__(self, other):
+		if not isinstance(other, TorrentFile):
+			return NotImplemented
+		return self.path == other.path
+
+	def __hash__(self):
+		return hash(self.path)
+
+	@classmethod
+	def from_info(cls, info):
+		return cls("/".join(info["path"]), info["length"])
+
+
+class TorrentFileList(object):
+	"""
+	Compact list of torrent files, deduplicated by path.
+	Paths are interned (so that they are shared between lists of
+	different builds) and sizes are kept in a parallel array.
+	Iterating yields TorrentFile objects.
+	"""
+	__slots__ = ("_index", "_paths", "_sizes")
+
+	def __init__(self, files=()):
+		self._index = {}
+		self._paths = []
+		self._sizes = array("Q")
+		for file in files:
+			self.add(file.path, file.size)
+
+	def __repr__(self):
+		return "<%s: %i files, %i bytes>" % (self.__class__.__name__, len(self), self.total_size)
+
+	def __len__(self):
+		return len(self._paths)
+
+	def __iter__(self):
+		for path, size in zip(self._paths, self._sizes):
+			yield TorrentFile(path, size)
+
+	def __contains__(self, path):
+		if isinstance(path, TorrentFile):
+			path = path.path
+		return path in self._index
+
+	def add(self, path, size):
+		"""
+		Add path to the list. Returns False if it was already present,
+		in which case the size is updated.
+		"""
+		i = self._index.get(path)
+		if i is not None:
+			self._sizes[i] = size
+			return False
+		path = sys.intern(path)
+		self._index[path] = len(self._paths)
+		self._paths.append(path)
+		self._sizes.append(size)
+		return True
+
+	def add_info(self, info):
+		return self.add("/".join(info["path"]), info["length"])
+
+	def size(self, path):
+		return self._sizes[self._index[path]]
+
+	def paths(self):
+		return iter(self._paths)
+
+	@property
+	def total_size(self):
+		return sum(self._sizes)
+
+
 class MFILPatch(object):
 	def __init__(self, configUrl, torrentHash, mfilHash, build):
 		self.configUrl = configUrl
@@ -278,10 +695,9 @@ class MFILPatch(object):
 
 	def _urlopen(self, url):
 		try:
-			f = urlopen(url)
-		except HTTPError as e:
+			return _urlopen(url, self.__class__.__name__.lower())
+		except IOError as e:
 			raise ServerError("Could not open %s: %s" % (url, e))
-		return f
 
 	def _path(self, path):
 		return self._server + path
@@ -291,6 +707,7 @@ class MFILPatch(object):
 		f = self._urlopen(self.configUrl)
 
 		response = f.read()
+		from xml.dom.minidom import parseString
 		try:
 			self.dom = parseString(response)
 		except ExpatError as e:
@@ -336,40 +753,90 @@ class MFILPatch(object):
 				bases[i] += "/"
 
 		# cache the file list
-		torrentFiles = set()
+		torrentFiles = TorrentFileList()
 		for f in d["info"]["files"]:
 			if f["type"] == "alignment":
 				continue
-			torrentFiles.add(TorrentFile(f))
+			torrentFiles.add_info(f)
 
 		return bases, torrentFiles
 
 
 class Resource(object):
+	CHUNK_SIZE = 64 * 1024
+
 	def _urlopen(self, url):
 		try:
-			f = urlopen(url)
-		except HTTPError as e:
+			return _urlopen(url, self.__class__.__name__.lower())
+		except IOError as e:
 			raise ServerError("Could not open %s: %s" % (url, e))
-		return f
 
-	def data(self):
-		if not hasattr(self, "_data"):
-			self._data = self._urlopen(self.url()).read()
-		return self._data
+	def checksum(self):
+		"Returns the md5 the resource is named after, if any"
+		sre = MD5_REGEX.search(self.url().rsplit("/", 1)[-1])
+		if sre:
+			return sre.group(0).lower()
 
-	def cache(self, path):
+	def data(self):
+		"Download the whole resource in memory"
+		return self._urlopen(self.url()).read()
+
+	def cache(self, path, verify=False):
+		"""
+		Stream the resource to path, CHUNK_SIZE bytes at a time, hashing
+		and writing it while it is being received.
+		If verify is set, the md5 of the data is checked against the
+		one in the resource name and nothing is written on mismatch.
+		Returns path.
+		"""
+		return COORDINATOR.fetch(path, self._cache, path, verify)
+
+	def _cache(self, path, verify):
+		from pipeline import Pipeline
+
+		type = self.__class__.__name__.lower()
 		if os.path.exists(path):
-			return
+			metrics.cache_hit(self.url(), type)
+			return path
+
+		metrics.cache_miss(self.url(), type)
+		checksum = self.checksum() if verify else None
+
+		def download(url):
+			"Stream url through a Pipeline to path, returning the Pipeline"
+			from contextlib import closing
+			from urllib.request import urlopen
+
+			start = time.perf_counter()
+			with closing(urlopen(url, timeout=retry.DEFAULT_POLICY.timeout)) as f:
+				length = f.headers.get("Content-Length")
+				with Pipeline(path, [md5()], int(length) if length else None) as pipeline:
+					while True:
+						chunk = f.read(self.CHUNK_SIZE)
+						if not chunk:
+							break
+						pipeline.feed(chunk)
+					pipeline.close()
+			metrics.request(url, type, pipeline.size, time.perf_counter() - start, f.status)
+			return pipeline
+
+		def check(pipeline):
+			digest = pipeline.hashers[0].hexdigest()
+			if digest != checksum:
+				logging.error("Integrity check failed for %s: %r != %r", self.url(), digest, checksum)
+				metrics.verify_failure(self.url(), type)
+				pipeline.abort()
+				return False
+			return True
 
-		base = os.path.dirname(path)
-		if not os.path.exists(base):
-			os.makedirs(base)
+		try:
+			pipeline = retry.fetch([self.url()], download, type, check if checksum else None)
+		except IOError as e:
+			raise ServerError("Could not download %s: %s" % (self.url(), e))
 
-		with open(path, "wb") as f:
-			data = self.data()
-			f.write(data)
-			logging.info("Written %i bytes to %s", len(data), path)
+		pipeline.commit()
+		logging.info("Written %i bytes to %s", pipeline.size, path)
+		return path
 
 
 class SimpleResource(Resource):
@@ -409,6 +876,94 @@ class Blob(Resource):
 		return self.base + self.name()
 
 
+def _get(url, type, scheduler=None, headers=None, mirrors=(), check=None):
+	"""
+	Helper that GETs url (through scheduler if any), recording the requests
+	in the metrics. Transient failures are retried, on the mirrors (the same
+	url on other hosts) as well. See retry.fetch().
+	"""
+	return retry.fetch([url] + list(mirrors), lambda url: _get_once(url, type, scheduler, headers), type, check)
+
+
+def _get_once(url, type, scheduler=None, headers=None):
+	import requests
+
+	timeout = retry.DEFAULT_POLICY.timeout
+	start = time.perf_counter()
+	try:
+		if scheduler:
+			r = scheduler.get(url, type, headers, timeout)
+		else:
+			r = requests.get(url, headers=headers, timeout=timeout)
+	except Exception:
+		metrics.request(url, type, 0, time.perf_counter() - start, "error")
+		raise
+	metrics.request(url, type, len(r.content), time.perf_counter() - start, r.status_code)
+	return r
+
+
+def _download(url, type, path, scheduler=None, mirrors=(), hashers=tuple, check=None):
+	"""
+	GET url (through scheduler if any) to path, hashing and writing the
+	response while it is being received (see pipeline.Pipeline).
+	hashers() returns the hash objects to feed, for each attempt. If check
+	is given, it is called with the response and the Pipeline of every
+	complete 200 response, and the download is retried if it returns False.
+	Returns the response; its content is not kept.
+	"""
+	import requests
+	from pipeline import Pipeline
+
+	def attempt(url):
+		timeout = retry.DEFAULT_POLICY.timeout
+		start = time.perf_counter()
+		size = 0
+		try:
+			r = requests.get(url, stream=True, timeout=timeout)
+			r.pipeline = None
+			if r.status_code == 200:
+				length = r.headers.get("Content-Length")
+				with Pipeline(path, hashers(), int(length) if length else None) as pipeline:
+					chunks = scheduler.iter_content(r, url, type) if scheduler else r.iter_content(CHUNK_SIZE)
+					for chunk in chunks:
+						pipeline.feed(chunk)
+					size = pipeline.close()
+				r.pipeline = pipeline
+			r.close()
+		except Exception:
+			metrics.request(url, type, size, time.perf_counter() - start, "error")
+			raise
+		metrics.request(url, type, size, time.perf_counter() - start, r.status_code)
+		return r
+
+	def verify(r):
+		if check is None or r.pipeline is None or check(r, r.pipeline):
+			return True
+		r.pipeline.abort()
+		return False
+
+	r = retry.fetch([url] + list(mirrors), attempt, type, verify)
+	if r.pipeline is not None:
+		r.pipeline.commit()
+	return r
+
+
+def _urlopen(url, type, data=None):
+	"Helper that opens url with urllib, retrying transient failures"
+	from urllib.request import urlopen
+
+	return retry.fetch([url], lambda url: urlopen(url, data, timeout=retry.DEFAULT_POLICY.timeout), type)
+
+
+def _verify_md5(r, hash, type):
+	"Check function for _get() that verifies the md5 of the response content"
+	if md5(r.content).hexdigest() != hash:
+		logging.error("%s does not match its md5", r.url)
+		metrics.verify_failure(r.url, type)
+		return False
+	return True
+
+
 def _hash(hash):
 	"Helper that returns <hash:0-2>/<hash:2-4>/<hash>"
 	return "%s/%s/%s" % (hash[0:2], hash[2:4], hash)
@@ -416,9 +971,21 @@ def _hash(hash):
 
 def _prep_dir_for(filename):
 	"Helper that ensures the directory for \a filename exists"
-	dirname = os.path.dirname(filename)
-	if not os.path.exists(dirname):
-		os.makedirs(dirname)
+	os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+
+def _write(path, data):
+	"Helper that writes data to path atomically, so that concurrent workers never see a partial file"
+	_prep_dir_for(path)
+	tmp = "%s.%i-%i.part" % (path, os.getpid(), threading.get_ident())
+	with open(tmp, "wb") as f:
+		f.write(data)
+	os.replace(tmp, path)
+
+
+# Parsed catalog JSON by hash, shared by every catalog of the process.
+# The parsed objects are shared as well: treat them as read-only.
+JSON_CACHE = LRUCache(64)
 
 
 class BaseCatalog(object):
@@ -449,21 +1016,32 @@ class BaseCatalog(object):
 		return self._root
 
 	def cache(self, hash):
+		"Returns the path of the (possibly compressed) file stored for hash"
 		url, path = self.get_paths(hash)
-		if not os.path.exists(path):
+		return COORDINATOR.fetch(path, self._cache, hash, url, path)
+
+	def _cache(self, hash, url, path):
+		stored = storage.find(path)
+		if stored:
+			metrics.cache_hit(url, "catalog")
+			path = stored
+		else:
+			metrics.cache_miss(url, "catalog")
 			_prep_dir_for(path)
-			r = requests.get(url)
-			assert md5(r.content).hexdigest() == hash
-			with open(path, "wb") as f:
-				logging.info("Downloading %r to %r", r.url, path)
-				f.write(r.content)
+			r = _get(url, "catalog", check=lambda r: _verify_md5(r, hash, "catalog"))
+			if r.status_code != 200:
+				raise FetchError("Could not fetch %s: HTTP %r" % (url, r.status_code))
+			logging.info("Downloading %r to %r", r.url, path)
+			path = storage.write(path, r.content)
 
 		return path
 
 	def get_json(self, hash):
-		path = self.cache(hash)
-		with open(path, "r") as f:
-			return json.load(f)
+		ret = JSON_CACHE.get(hash)
+		if ret is None:
+			ret = json.loads(storage.read(self.cache(hash)))
+			JSON_CACHE.set(hash, ret)
+		return ret
 
 	def get_paths(self, hash):
 		url = "%s://%s/%s/%s" % (self.scheme, self.server, self.path, _hash(hash))
@@ -471,7 +1049,8 @@ class BaseCatalog(object):
 		return url, path
 
 	def preload(self):
-		# Cache the root hash by just accessing it
+		# The root may already be parsed (JSON_CACHE), make sure it is on disk too
+		self.cache(self.hash)
 		self.root
 
 
@@ -485,10 +1064,11 @@ class Catalog(BaseCatalog):
 
 	@property
 	def regions(self):
-		ret = {}
-		for region, d in self.root["catalogs"].items():
-			ret[region] = BaseCatalog(self.server, self.path, d["hash"], region, self.save_path, self.scheme)
-		return ret
+		if not hasattr(self, "_regions"):
+			self._regions = {}
+			for region, d in self.root["catalogs"].items():
+				self._regions[region] = BaseCatalog(self.server, self.path, d["hash"], region, self.save_path, self.scheme)
+		return self._regions
 
 	def preload(self):
 		for catalog in self.regions.values():
@@ -500,8 +1080,12 @@ class Catalog(BaseCatalog):
 
 		for filename, resource in self.root["manifest"]["lookup"].items():
 			path = self.cache(resource)
-			link_path = os.path.join(self.save_path, "Clog", filename)
+			link_path = os.path.join(self.save_path, "Clog", filename) + storage.extension(path)
 			if not os.path.exists(link_path):
 				logging.info("Linking %r -> %r" % (path, link_path))
 				_prep_dir_for(link_path)
-				os.symlink(path, link_path)
+				try:
+					os.symlink(path, link_path)
+				except FileExistsError:
+					# Linked concurrently by another catalog
+					pass
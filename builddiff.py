@@ -0,0 +1,106 @@
+"""
+Build-to-build diffs of mfil programs, to update a local tree from one
+build to another (see patchdl --from-build).
+The files of a build are a dict of path -> (size, flags), as returned
+by build_files().
+"""
+
+import os
+from shlex import quote
+
+
+# The url and output are shell-quoted by curl()
+CURL = "curl -# --fail --create-dirs %(url)s -o %(output)s &&"
+
+
+def curl(url, path):
+	"Returns the shell command downloading url to path"
+	return CURL % {"url": quote(url), "output": quote(path)}
+
+
+def rm(path):
+	"Returns the shell command removing path"
+	return "rm -f %s &&" % (quote(path))
+
+
+def build_files(mfil, torrent):
+	"""
+	Returns the files of a build from its parsed mfil and torrent (the
+	torrent has no flags, the mfil wins for the files listed by both).
+	"""
+	ret = {}
+	for f in torrent["info"]["files"]:
+		if f["type"] == "alignment":
+			continue
+		ret["/".join(f["path"])] = (int(f["length"]), None)
+
+	for file, info in mfil["file"].items():
+		size = int(info["size"])
+		if not size:
+			# Directory
+			continue
+		ret[file] = (size, info.get("flags"))
+	return ret
+
+
+def diff(old, new):
+	"""
+	Returns the (added, removed, changed) sorted lists of paths between
+	the files of two builds. A file changed if its size or flags did.
+	"""
+	added = sorted(file for file in new if file not in old)
+	removed = sorted(file for file in old if file not in new)
+	changed = sorted(file for file, info in new.items() if file in old and old[file] != info)
+	return added, removed, changed
+
+
+def _updated(path, size, old_size):
+	"Returns True if path already has its new size (which is not the old one), eg. when resuming an update"
+	return size != old_size and os.path.exists(path) and os.path.getsize(path) == size
+
+
+def update(old, new, old_dir, new_dir, base_url):
+	"""
+	Returns the shell commands updating a local tree from the build of the
+	files old, stored in old_dir, to the build of the files new, stored in
+	new_dir and served from base_url, and the (url, size) of the files
+	they download.
+	If the builds are stored in different directories, old_dir is first
+	hard-linked into new_dir, so that the unchanged files are shared and
+	old_dir is left as it is: changed and added files are unlinked before
+	they are downloaded (again).
+	"""
+	added, removed, changed = diff(old, new)
+	separate = os.path.normpath(old_dir) != os.path.normpath(new_dir)
+	commands, downloads = [], []
+	if separate:
+		# -n: on a resumed update, keep the files already updated
+		commands.append("mkdir -p %s && cp -aln %s %s &&" % (quote(new_dir), quote(old_dir + "/."), quote(new_dir + "/")))
+
+	for file in changed:
+		path = os.path.join(new_dir, file)
+		size = new[file][0]
+		if _updated(path, size, old[file][0]):
+			continue
+		if separate:
+			commands.append(rm(path))
+		commands.append(curl(base_url + file, path))
+		downloads.append((base_url + file, size))
+
+	for file in added:
+		path = os.path.join(new_dir, file)
+		size = new[file][0]
+		if _updated(path, size, None):
+			continue
+		if separate:
+			# A stray copy in old_dir was hard-linked by cp
+			commands.append(rm(path))
+		commands.append(curl(base_url + file, path))
+		downloads.append((base_url + file, size))
+
+	for file in removed:
+		path = os.path.join(new_dir, file)
+		if os.path.exists(path) or os.path.exists(os.path.join(old_dir, file)):
+			commands.append(rm(path))
+
+	return commands, downloads
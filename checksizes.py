@@ -7,6 +7,7 @@ Check the sizes of all the files relative to that path specified in the given mf
 
 import os
 import sys
+import storage
 from argparse import ArgumentParser
 
 from xml.dom.minidom import getDOMImplementation, parseString
@@ -18,7 +19,7 @@ from mfil import MFIL2 as MFIL
 
 LIVE = 1
 PTR  = 2
-MPQ_BASE_DIR = os.environ.get("MPQ_BASE_DIR", os.environ.get("XDG_DATA_HOME", os.path.join(os.path.expanduser("~"), ".local", "share")), "mpq"))
+MPQ_BASE_DIR = os.environ.get("MPQ_BASE_DIR", os.path.join(os.environ.get("XDG_DATA_HOME", os.path.join(os.path.expanduser("~"), ".local", "share")), "mpq"))
 
 class ServerError(Exception):
 	pass
@@ -45,7 +46,7 @@ class Downloader(object):
 
 	def exec_(self):
 		for path in self.args.mfil:
-			with open(path, "rb") as f:
+			with storage.open(path) as f:
 				total, errors = 0, 0
 				baseDir = os.path.dirname(path)
 				f = MFIL(f)
@@ -0,0 +1,96 @@
+"""
+Process-wide fetch coordination.
+NGDPConnection, the catalogs, Resource and the proxy register their
+fetches with COORDINATOR, keyed by the path the object is stored at: an
+object shared by several products (or catalogs, or connections) is only
+fetched once at a time, every caller getting the result of that fetch,
+and objects fetched and verified during this run are not checked again.
+The coordinator is per process: the shards of ngdp.py --jobs each have
+their own, and do not share the fetches of the archives they have in
+common.
+"""
+
+import threading
+from concurrent.futures import Future
+
+import metrics
+
+
+class SingleFlight(object):
+	"""
+	Collapses concurrent calls for the same key into one: the first caller
+	runs the function, the others wait for its result.
+	"""
+	def __init__(self):
+		self._calls = {}
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._calls)
+
+	def do(self, key, func, *args):
+		with self._lock:
+			future = self._calls.get(key)
+			leader = future is None
+			if leader:
+				future = self._calls[key] = Future()
+
+		if not leader:
+			metrics.shared_fetch()
+			return future.result()
+
+		try:
+			future.set_result(func(*args))
+		except BaseException as e:
+			future.set_exception(e)
+		finally:
+			with self._lock:
+				del self._calls[key]
+		return future.result()
+
+
+class Coordinator(object):
+	"""
+	SingleFlight that also remembers the results of completed fetches
+	(other than None, which means the fetch failed) until reset().
+	"""
+	def __init__(self):
+		self.flights = SingleFlight()
+		self._done = {}
+		self._lock = threading.Lock()
+
+	def __repr__(self):
+		return "<Coordinator: %i in flight, %i done>" % (len(self.flights), len(self._done))
+
+	def do(self, key, func, *args):
+		"Returns func(*args), sharing the call with the concurrent ones for key"
+		return self.flights.do(key, func, *args)
+
+	def fetch(self, key, func, *args):
+		"""
+		Returns func(*args), unless it already completed for key during this
+		run, in which case its result is returned again.
+		"""
+		with self._lock:
+			if key in self._done:
+				metrics.shared_fetch()
+				return self._done[key]
+		return self.flights.do(key, self._fetch, key, func, *args)
+
+	def _fetch(self, key, func, *args):
+		# A previous leader may have completed between fetch() and do()
+		with self._lock:
+			if key in self._done:
+				return self._done[key]
+		ret = func(*args)
+		if ret is not None:
+			with self._lock:
+				self._done[key] = ret
+		return ret
+
+	def reset(self):
+		with self._lock:
+			self._done.clear()
+
+
+COORDINATOR = Coordinator()
@@ -0,0 +1,210 @@
+"""
+Vectorized parser for NGDP encoding tables (CKey -> EKey and EKey specs).
+Requires NumPy.
+"""
+
+import struct
+from hashlib import md5
+
+import numpy as np
+
+
+HEADER = struct.Struct(">2sBBBHHIIBI")
+KEY_SIZE = 16
+# key_count (1) + file size (5) + ckey + one ekey
+CKEY_RECORD_SIZE = 1 + 5 + KEY_SIZE + KEY_SIZE
+# ekey + espec index (4) + file size (5)
+ESPEC_RECORD_SIZE = KEY_SIZE + 4 + 5
+
+
+class EncodingError(Exception):
+	pass
+
+
+def _keys(keys):
+	"Convert an iterable of hex strings or 16-byte digests to an S16 array"
+	return np.array([bytes.fromhex(key) if isinstance(key, str) else bytes(key) for key in keys], dtype="S16")
+
+
+def _tohex(keys):
+	# Going through tobytes() because S16 items lose their trailing NULs
+	data = np.ascontiguousarray(keys).tobytes().hex()
+	return [data[i:i+KEY_SIZE*2] for i in range(0, len(data), KEY_SIZE*2)]
+
+
+def _uint40(columns):
+	"Big endian 40-bit integers from a (n, 5) uint8 array"
+	columns = columns.astype(np.uint64)
+	ret = np.zeros(len(columns), dtype=np.uint64)
+	for i in range(5):
+		ret = (ret << np.uint64(8)) | columns[:, i]
+	return ret
+
+
+def _verify_pages(pages, index, what):
+	"Check the md5 of every page against the page index in one pass"
+	digests = np.frombuffer(b"".join(md5(page).digest() for page in pages), dtype="S16")
+	expected = index[:, KEY_SIZE:].copy().view("S16").ravel()
+	bad = np.nonzero(digests != expected)[0]
+	if len(bad):
+		raise EncodingError("%i corrupt %s pages (first: %i)" % (len(bad), what, bad[0]))
+
+
+class EncodingTable(object):
+	"""
+	Parsed encoding table.
+	ckeys, ekeys and sizes are parallel arrays sorted by ckey (ekeys holds
+	the first ekey of each ckey; the others are in extra_ekeys).
+	espec_ekeys, espec_indices and espec_sizes are sorted by ekey.
+	"""
+	def __init__(self, data, verify=True):
+		data = memoryview(data)
+		(
+			magic, version, ckey_size, ekey_size, ckey_page_kb, espec_page_kb,
+			ckey_page_count, espec_page_count, _, espec_block_size,
+		) = HEADER.unpack_from(data)
+		if magic != b"EN":
+			raise EncodingError("Bad encoding magic: %r" % (magic))
+		if ckey_size != KEY_SIZE or ekey_size != KEY_SIZE:
+			raise EncodingError("Unsupported key sizes: %i/%i" % (ckey_size, ekey_size))
+
+		pos = HEADER.size
+		self.especs = bytes(data[pos:pos+espec_block_size]).decode("utf-8").rstrip("\0").split("\0")
+		pos += espec_block_size
+
+		ckey_page_size = ckey_page_kb * 1024
+		ckey_index = np.frombuffer(data, dtype=np.uint8, count=ckey_page_count * KEY_SIZE * 2, offset=pos).reshape(-1, KEY_SIZE * 2)
+		pos += ckey_index.size
+		ckey_pages = np.frombuffer(data, dtype=np.uint8, count=ckey_page_count * ckey_page_size, offset=pos).reshape(-1, ckey_page_size)
+		pos += ckey_pages.size
+
+		espec_page_size = espec_page_kb * 1024
+		espec_index = np.frombuffer(data, dtype=np.uint8, count=espec_page_count * KEY_SIZE * 2, offset=pos).reshape(-1, KEY_SIZE * 2)
+		pos += espec_index.size
+		espec_pages = np.frombuffer(data, dtype=np.uint8, count=espec_page_count * espec_page_size, offset=pos).reshape(-1, espec_page_size)
+		pos += espec_pages.size
+
+		if verify:
+			_verify_pages(ckey_pages, ckey_index, "ckey")
+			_verify_pages(espec_pages, espec_index, "espec")
+
+		self._parse_ckey_pages(ckey_pages)
+		self._parse_espec_pages(espec_pages)
+
+	def __repr__(self):
+		return "<%s: %i ckeys, %i especs>" % (self.__class__.__name__, len(self), len(self.espec_ekeys))
+
+	def __len__(self):
+		return len(self.ckeys)
+
+	def __contains__(self, ckey):
+		return self.get(ckey) is not None
+
+	def _parse_ckey_pages(self, pages):
+		"""
+		Entries are variable-length, but almost all of them have a single
+		ekey. Parse every page as fixed CKEY_RECORD_SIZE records at once and
+		only walk the pages that turn out to contain multi-ekey entries.
+		"""
+		per_page = pages.shape[1] // CKEY_RECORD_SIZE
+		records = pages[:, :per_page * CKEY_RECORD_SIZE].reshape(len(pages), per_page, CKEY_RECORD_SIZE)
+		counts = records[:, :, 0]
+		# Entries stop at the first zero key count (the rest is padding)
+		valid = np.cumprod(counts != 0, axis=1).astype(bool)
+		multi = np.any(valid & (counts > 1), axis=1)
+		valid[multi] = False
+
+		records = records[valid]
+		ckeys = [records[:, 6:6+KEY_SIZE]]
+		ekeys = [records[:, 6+KEY_SIZE:]]
+		sizes = [_uint40(records[:, 1:6])]
+		self.extra_ekeys = {}
+
+		for page in pages[multi]:
+			page_ckeys, page_ekeys, page_sizes = self._walk_ckey_page(bytes(page))
+			ckeys.append(page_ckeys)
+			ekeys.append(page_ekeys)
+			sizes.append(page_sizes)
+
+		ckeys = np.concatenate(ckeys).copy().view("S16").ravel()
+		ekeys = np.concatenate(ekeys).copy().view("S16").ravel()
+		sizes = np.concatenate(sizes)
+		order = np.argsort(ckeys, kind="stable")
+		self.ckeys = ckeys[order]
+		self.ekeys = ekeys[order]
+		self.sizes = sizes[order]
+
+	def _walk_ckey_page(self, page):
+		ckeys, ekeys, sizes = [], [], []
+		pos = 0
+		while pos + 6 + KEY_SIZE <= len(page):
+			count = page[pos]
+			if not count:
+				break
+			size = int.from_bytes(page[pos+1:pos+6], "big")
+			ckey = page[pos+6:pos+6+KEY_SIZE]
+			pos += 6 + KEY_SIZE
+			keys = [page[pos+i*KEY_SIZE:pos+(i+1)*KEY_SIZE] for i in range(count)]
+			pos += count * KEY_SIZE
+			ckeys.append(np.frombuffer(ckey, dtype=np.uint8))
+			ekeys.append(np.frombuffer(keys[0], dtype=np.uint8))
+			sizes.append(size)
+			if count > 1:
+				self.extra_ekeys[ckey] = keys[1:]
+		if not ckeys:
+			empty = np.zeros((0, KEY_SIZE), dtype=np.uint8)
+			return empty, empty, np.zeros(0, dtype=np.uint64)
+		return np.stack(ckeys), np.stack(ekeys), np.array(sizes, dtype=np.uint64)
+
+	def _parse_espec_pages(self, pages):
+		per_page = pages.shape[1] // ESPEC_RECORD_SIZE
+		records = pages[:, :per_page * ESPEC_RECORD_SIZE].reshape(-1, ESPEC_RECORD_SIZE)
+		# Padding entries have a zero ekey
+		records = records[np.any(records[:, :KEY_SIZE] != 0, axis=1)]
+		ekeys = records[:, :KEY_SIZE].copy().view("S16").ravel()
+		indices = records[:, KEY_SIZE:KEY_SIZE+4].copy().view(">u4").ravel()
+		order = np.argsort(ekeys, kind="stable")
+		self.espec_ekeys = ekeys[order]
+		self.espec_indices = indices[order].astype(np.uint32)
+		self.espec_sizes = _uint40(records[:, KEY_SIZE+4:])[order]
+
+	def lookup(self, ckeys):
+		"""
+		Batched CKey -> EKey lookup.
+		Takes hex strings or digests; returns the (S16) ekeys and a mask
+		of the ckeys that were found.
+		"""
+		keys = _keys(ckeys)
+		if not len(self.ckeys):
+			return np.zeros(len(keys), dtype="S16"), np.zeros(len(keys), dtype=bool)
+		idx = np.minimum(np.searchsorted(self.ckeys, keys), len(self.ckeys) - 1)
+		found = self.ckeys[idx] == keys
+		return self.ekeys[idx], found
+
+	def lookup_hex(self, ckeys):
+		"Like lookup(), but returns a list of hex ekeys (None when not found)"
+		ekeys, found = self.lookup(ckeys)
+		return [ekey if ok else None for ekey, ok in zip(_tohex(ekeys), found)]
+
+	def get(self, ckey):
+		return self.lookup_hex([ckey])[0]
+
+	def size(self, ckey):
+		keys = _keys([ckey])
+		idx = np.searchsorted(self.ckeys, keys)[0]
+		if idx < len(self.ckeys) and self.ckeys[idx] == keys[0]:
+			return int(self.sizes[idx])
+
+	def espec(self, ekey):
+		"Returns the encoding spec of ekey, or None"
+		keys = _keys([ekey])
+		idx = np.searchsorted(self.espec_ekeys, keys)[0]
+		if idx < len(self.espec_ekeys) and self.espec_ekeys[idx] == keys[0]:
+			return self.especs[self.espec_indices[idx]]
+
+	def encoded_size(self, ekey):
+		"Returns the encoded size of ekey, or None"
+		keys = _keys([ekey])
+		idx = np.searchsorted(self.espec_ekeys, keys)[0]
+		if idx < len(self.espec_ekeys) and self.espec_ekeys[idx] == keys[0]:
+			return int(self.espec_sizes[idx])
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Offline integrity check of the mirrored NGDP archives.
+Usage:
+	fsck.py [--jobs N] [--json report.json] [path...]
+
+Every data and patch archive that has a cached .index is mapped in memory
+and each entry listed in the index is checked: it must lie within the
+archive and the md5 of its BLTE header must match its ekey. Archives are
+checked in parallel on a pool of processes. Nothing is downloaded.
+"""
+
+import json
+import logging
+import mmap
+import os
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import archiveindex
+import blte
+
+
+MPQ_BASE_DIR = os.environ.get("MPQ_BASE_DIR", os.path.join(os.environ.get("XDG_DATA_HOME", os.path.join(os.path.expanduser("~"), ".local", "share")), "mpq"))
+# Stop listing the bad entries of an archive after this many
+MAX_ERRORS = 100
+
+
+def find_archives(path):
+	"Yields the path of every archive under path that has a cached .index"
+	for root, dirnames, filenames in os.walk(path):
+		for filename in filenames:
+			if filename.endswith(".index"):
+				archive = os.path.join(root, filename[:-len(".index")])
+				if os.path.exists(archive):
+					yield archive
+
+
+def check_archive(path):
+	"""
+	Check every entry of the archive at path against its .index.
+	Returns a dict with the number of entries and the bad ones as
+	(ekey, offset, error) tuples.
+	"""
+	index = archiveindex.load(path + ".index")
+	errors = []
+	entries = 0
+	with open(path, "rb") as f:
+		size = os.fstat(f.fileno()).st_size
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+		try:
+			with memoryview(data) as view:
+				for ekey, entry_size, offset in index.raw_entries():
+					entries += 1
+					ekey = ekey.hex()
+					if offset + entry_size > size:
+						error = "entry ends at %i, past the end of the archive (%i bytes)" % (offset + entry_size, size)
+					else:
+						try:
+							actual = blte.ekey(view[offset:offset+entry_size])
+							error = None if actual == ekey else "ekey mismatch: %s" % (actual)
+						except Exception as e:
+							error = str(e)
+					if error:
+						errors.append((ekey, offset, error))
+						if len(errors) >= MAX_ERRORS:
+							break
+		finally:
+			if size:
+				data.close()
+
+	return {"path": path, "size": size, "entries": entries, "errors": errors}
+
+
+def fsck(paths, jobs=None):
+	"Check every archive under paths; yields the result of each archive as it completes"
+	archives = [archive for path in paths for archive in find_archives(path)]
+	logging.info("Checking %i archives", len(archives))
+	with ProcessPoolExecutor(jobs) as executor:
+		futures = {executor.submit(check_archive, archive): archive for archive in archives}
+		for future in as_completed(futures):
+			try:
+				yield future.result()
+			except Exception as e:
+				yield {"path": futures[future], "size": 0, "entries": 0, "errors": [(None, None, "could not check: %s" % (e))]}
+
+
+def main():
+	logging.basicConfig(level=logging.INFO)
+	arguments = ArgumentParser(prog="fsck")
+	arguments.add_argument("--jobs", type=int, dest="jobs", help="number of processes (defaults to the number of cores)")
+	arguments.add_argument("--json", type=str, dest="json", help="write the full report to this file as JSON")
+	arguments.add_argument("paths", type=str, nargs="*", help="directories to check (defaults to $MPQ_BASE_DIR/NGDP)")
+	args = arguments.parse_args(sys.argv[1:])
+
+	paths = args.paths or [os.path.join(MPQ_BASE_DIR, "NGDP")]
+	report = []
+	total, entries = 0, 0
+	for result in fsck(paths, args.jobs):
+		total += result["size"]
+		entries += result["entries"]
+		if result["errors"]:
+			report.append(result)
+			print("%s: %i bad entries" % (result["path"], len(result["errors"])))
+			for ekey, offset, error in result["errors"]:
+				print("\t%s at %s: %s" % (ekey, offset, error))
+
+	print("%i entries checked (%i bytes), %i corrupt archives" % (entries, total, len(report)))
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump(report, f, indent="\t")
+
+	exit(1 if report else 0)
+
+
+if __name__ == "__main__":
+	main()
@@ -2,6 +2,7 @@
 
 import os
 import json
+import storage
 from urllib.request import urlopen
 from urllib.error import HTTPError
 """
@@ -25,11 +26,12 @@ bases = {
 	"http://dist.blizzard.com.edgesuite.net/wow-pod/beta/0E1FFF21/NA/15464.direct",
 }
 
-MPQ_BASE_DIR = os.environ.get("MPQ_BASE_DIR", os.environ.get("XDG_DATA_HOME", os.path.join(os.path.expanduser("~"), ".local", "share")), "mpq"))
+MPQ_BASE_DIR = os.environ.get("MPQ_BASE_DIR", os.path.join(os.environ.get("XDG_DATA_HOME", os.path.join(os.path.expanduser("~"), ".local", "share")), "mpq"))
 
 NOT_FOUND = "File not found."
 
-if __name__ == "__main__":
+
+def main():
 	db = []
 	filesystem = []
 	tried = []
@@ -42,6 +44,7 @@ if __name__ == "__main__":
 
 	for root, dirnames, filenames in os.walk(MPQ_BASE_DIR):
 		for file in filenames:
+			file = file[:len(file) - len(storage.extension(file))]
 			if file.endswith(".mfil") or file.endswith(".torrent"):
 				filesystem.append(file)
 
@@ -71,8 +74,7 @@ if __name__ == "__main__":
 					if x != NOT_FOUND:
 						print("Downloading... %r" % (url))
 						x += f.read()
-						with open(file, "wb") as out:
-							out.write(x)
+						storage.write(file, x)
 					else:
 						tried.append(url)
 
@@ -83,3 +85,7 @@ if __name__ == "__main__":
 
 	with open("tried.json", "w") as f:
 		f.write(json.dumps(tried))
+
+
+if __name__ == "__main__":
+	main()
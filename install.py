@@ -0,0 +1,81 @@
+"""
+Parser for NGDP install manifests.
+The manifest lists the files a client installs, each with its ckey and
+size, and a set of tags (platform, architecture, locale...) with one bit
+per file telling whether the file belongs to the tag.
+"""
+
+import struct
+from collections import OrderedDict, namedtuple
+
+
+InstallTag = namedtuple("InstallTag", ("name", "type", "mask"))
+InstallEntry = namedtuple("InstallEntry", ("name", "ckey", "size"))
+
+
+class InstallError(Exception):
+	pass
+
+
+def _cstring(data, pos):
+	end = data.index(b"\0", pos)
+	return data[pos:end].decode("utf-8"), end + 1
+
+
+class InstallManifest(object):
+	def __init__(self, data):
+		data = bytes(data)
+		magic, version, hash_size, tag_count, entry_count = struct.unpack_from(">2sBBHI", data)
+		if magic != b"IN":
+			raise InstallError("Bad install manifest magic: %r" % (magic))
+
+		pos = 10
+		mask_size = (entry_count + 7) // 8
+		self.tags = []
+		for i in range(tag_count):
+			name, pos = _cstring(data, pos)
+			type, = struct.unpack_from(">H", data, pos)
+			pos += 2
+			mask = int.from_bytes(data[pos:pos+mask_size], "big")
+			pos += mask_size
+			self.tags.append(InstallTag(name, type, mask))
+
+		self.entries = []
+		for i in range(entry_count):
+			name, pos = _cstring(data, pos)
+			ckey = data[pos:pos+hash_size].hex()
+			pos += hash_size
+			size, = struct.unpack_from(">I", data, pos)
+			pos += 4
+			self.entries.append(InstallEntry(name, ckey, size))
+
+		self._bits = mask_size * 8
+
+	def __repr__(self):
+		return "<%s: %i files, %i tags>" % (self.__class__.__name__, len(self.entries), len(self.tags))
+
+	def __len__(self):
+		return len(self.entries)
+
+	def tag_names(self):
+		return [tag.name for tag in self.tags]
+
+	def select(self, names):
+		"""
+		Returns the entries matching the given tag names. Tags of the same
+		type are alternatives (eg. enUS or deDE), tags of different types
+		must all match (eg. Windows and x86_64 and enUS).
+		"""
+		tags = {tag.name.lower(): tag for tag in self.tags}
+		groups = OrderedDict()
+		for name in names:
+			tag = tags.get(name.lower())
+			if tag is None:
+				raise InstallError("Unknown tag %r (available: %s)" % (name, ", ".join(self.tag_names())))
+			groups[tag.type] = groups.get(tag.type, 0) | tag.mask
+
+		mask = (1 << self._bits) - 1
+		for group in groups.values():
+			mask &= group
+
+		return [entry for i, entry in enumerate(self.entries) if mask >> (self._bits - 1 - i) & 1]
@@ -0,0 +1,39 @@
+"""
+Thread-safe LRU cache, shared by the in-memory caches of parsed configs
+(simplestore) and catalogs (bpp).
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+	"Thread-safe mapping that keeps the maxsize most recently used items"
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self._items = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __repr__(self):
+		return "<LRUCache: %i/%i items>" % (len(self._items), self.maxsize)
+
+	def __len__(self):
+		return len(self._items)
+
+	def get(self, key, default=None):
+		with self._lock:
+			if key not in self._items:
+				return default
+			self._items.move_to_end(key)
+			return self._items[key]
+
+	def set(self, key, value):
+		with self._lock:
+			self._items[key] = value
+			self._items.move_to_end(key)
+			while len(self._items) > self.maxsize:
+				self._items.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._items.clear()
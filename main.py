@@ -13,17 +13,27 @@ D3:
 S2:
 	patchdl S2 --component <os> --client <version>
 
+Update a local tree from an older build (listed in db.json):
+	patchdl D3 --from-build 7728
+
 Tool:
 	patchdl --tool <version>
 """
 
+import builddiff
+import json
+import logging
 import os
 import sys
+import storage
 from bcoding import bdecode
+from io import BytesIO
+from bpp import Record, ServerError, _post, dump_request
 from mfil import MFIL2 as MFIL
+from profiling import Profiler
 from urllib.request import urlopen
 from urllib.error import HTTPError
-from xml.dom.minidom import getDOMImplementation, parseString
+from xml.dom.minidom import parseString
 from xml.parsers.expat import ExpatError
 
 
@@ -32,9 +42,6 @@ LIVE = 1
 PTR  = 2
 MPQ_BASE_DIR = os.environ.get("MPQ_BASE_DIR", os.path.join(os.environ.get("XDG_DATA_HOME", os.path.join(os.path.expanduser("~"), ".local", "share")), "mpq"))
 
-class ServerError(Exception):
-	pass
-
 class Cache(object):
 	"""
 	Simple caching mechanism that assumes file integrity by file name.
@@ -59,17 +66,16 @@ class Cache(object):
 		return path
 
 	def get(self, item):
-		path = self._path(item)
-		if os.path.exists(path):
-			return path
+		"Returns the path of the (possibly compressed) cached item, or None"
+		return storage.find(self._path(item))
 
-	def set(self, item, data):
-		path = self._path(item)
-		with open(path, "wb") as f:
-			f.write(data)
-		f = open(path, "rb")
+	def open(self, item):
+		"Returns the uncompressed cached item as a binary file object"
+		return storage.open(self._path(item))
 
-		return path, f
+	def set(self, item, data):
+		path = storage.write(self._path(item), data)
+		return path, BytesIO(data)
 
 	def verify(self, item):
 		import re
@@ -85,9 +91,7 @@ class Cache(object):
 			raise ValueError("Could not find a hash in %s" % (name))
 		hash = sre[0].lower()
 
-		with open(path, "rb") as f:
-			fhash = md5(f.read()).hexdigest()
-			return fhash == hash
+		return md5(storage.read(path)).hexdigest() == hash
 
 class Downloader(object):
 
@@ -108,10 +112,20 @@ class Downloader(object):
 		arguments.add_argument("--show-avi", action="store_true", dest="avi", help="include .avi files in the output")
 		arguments.add_argument("--show-downloaded", action="store_true", dest="downloaded", help="include downloaded files in the output")
 		arguments.add_argument("--post-data", type=str, dest="data", help="Send this data (emulates wget --post-data)")
+		arguments.add_argument("--profile", type=str, dest="profile", help="write per-phase cProfile stats and peak memory to this directory")
+		arguments.add_argument("--plan", action="store_true", dest="plan", help="only print the size of what would be downloaded and an estimate of how long it would take")
+		arguments.add_argument("--from-build", type=int, dest="from_build", help="only output what changed since this build (mfil downloads only): the files to download and remove to update a local tree")
+		arguments.add_argument("--db", type=str, dest="db", default="db.json", help="build database to look --from-build up in")
 		arguments.add_argument("program", type=str, nargs="?", default="WoW", help="possible choices are WoW, WoWB, WoWT, S2, D3, D3B, Agnt, Clnt")
 		self.args = arguments.parse_args(*args)
+		logging.basicConfig(level=logging.DEBUG if self.args.debug else logging.WARNING)
 
 		self.cache = Cache(PROGRAM)
+		self.profiler = Profiler(self.args.profile)
+		self.plan = None
+		if self.args.plan:
+			from plan import Plan
+			self.plan = Plan()
 
 	def debug(self, output):
 		if self.args.debug:
@@ -124,22 +138,23 @@ class Downloader(object):
 		sys.stderr.write("warning: %s\n" % (output))
 
 	def exec_(self):
+		try:
+			return self.run()
+		finally:
+			self.profiler.write()
+
+	def run(self):
 		xml = self.getProgramXML()
 		server = self.SERVER % (self.args.server)
 
 		self.debug("POST %r %r" % (server, xml))
 
-		try:
-			f = urlopen(server, xml)
-		except HTTPError as e:
-			self.error("Could not open %s: %s" % (server, e))
-			return 1
-
-		response = f.read()
-		if not response:
-			self.error("No response from %s" % (server))
-			return 1
-		self.debug("response=%r" % (response))
+		with self.profiler.phase("version-query"):
+			try:
+				records = _post(server, xml)
+			except ServerError as e:
+				self.error("%s: %s" % (server, e))
+				return 1
 
 		downloadTypes = {
 			"Agnt": self.downloadAgent,
@@ -158,11 +173,11 @@ class Downloader(object):
 			"WoWT": self.downloadMfil,
 		}
 
-		for record in parseString(response).getElementsByTagName("record"):
-			serverProgram = record.getAttribute("program")
-			component = record.getAttribute("component")
+		for record in records:
+			serverProgram = record.program
+			component = record.component
 			print("%s::%s" % (serverProgram, component))
-			self.debug("record=%r" % (record.toxml()))
+			self.debug("record=%r" % (record,))
 
 			if component == "blob":
 				self.downloadBlob(record)
@@ -178,14 +193,17 @@ class Downloader(object):
 				self.error(e)
 				continue
 
+		if self.plan is not None:
+			self.plan.resolve()
+			print(self.plan.report(self.args.base, self.plan.probe()))
+
 		return 0
 
 	def downloadAgent(self, record):
-		data = record.firstChild.data.strip()
+		data = record.text
 		self.debug("data=%r" % (data))
 
-		component = record.getAttribute("component")
-		if component == "cdn":
+		if record.component == "cdn":
 			cdns = data.split("|")
 			print("Available CDNs: %s" % (", ".join(cdns)))
 			return
@@ -193,32 +211,34 @@ class Downloader(object):
 		incrementalTorrent, fullTorrent, toBuild, fromBuild, zero = data.split(";")
 
 		files = set()
-		for url in (incrementalTorrent, fullTorrent):
-			torrent = urlopen(url)
+		with self.profiler.phase("torrent"):
+			for url in (incrementalTorrent, fullTorrent):
+				torrent = urlopen(url)
 
-			d = bdecode(torrent)
-			directDownload = d["direct download"].decode("utf-8")
-			self.debug("directDownload=%r" % (directDownload))
+				d = bdecode(torrent)
+				directDownload = d["direct download"].decode("utf-8")
+				self.debug("directDownload=%r" % (directDownload))
 
-			# As of S2 1.5, directDownload supports mirrors, e.g.:
-			# "http://dist.blizzard.com.edgesuite.net/sc2-pod-retail/NA/22342.direct|http://llnw.blizzard.com/sc2-pod-retail/NA/22342.direct"
-			directDownload = directDownload.split("|")[0]
+				# As of S2 1.5, directDownload supports mirrors, e.g.:
+				# "http://dist.blizzard.com.edgesuite.net/sc2-pod-retail/NA/22342.direct|http://llnw.blizzard.com/sc2-pod-retail/NA/22342.direct"
+				directDownload = directDownload.split("|")[0]
 
-			# Always make sure the url ends with a slash, so we don't
-			# get a different result depending on whether it does or not
-			if not directDownload.endswith("/"):
-				directDownload += "/"
+				# Always make sure the url ends with a slash, so we don't
+				# get a different result depending on whether it does or not
+				if not directDownload.endswith("/"):
+					directDownload += "/"
 
-			for f in d["info"]["files"]:
-				if f["type"] == "alignment":
-					continue
-				path = "/".join(f["path"])
-				files.add(path)
+				for f in d["info"]["files"]:
+					if f["type"] == "alignment":
+						continue
+					path = "/".join(f["path"])
+					files.add(path)
 
-		self.outputFiles(files, directDownload)
+		with self.profiler.phase("output"):
+			self.outputFiles(files, directDownload)
 
 	def downloadBlob(self, record):
-		data = record.firstChild.data.strip()
+		data = record.text
 		self.debug("data=%r" % (data))
 		base, installHash, gameHash, _ = data.split(";")
 		self.debug("base=%r, installHash=%r, gameHash=%r, _=%r" % (base, installHash, gameHash, _))
@@ -226,9 +246,12 @@ class Downloader(object):
 		install = base + "/" + "%s_install_%s.blob" % (self.args.program.lower(), installHash)
 		print("Game blob at %s" % (game))
 		print("Install blob at %s" % (install))
+		if self.plan is not None:
+			self.plan.add("blob", game)
+			self.plan.add("blob", install)
 
 	def downloadClassic(self, record):
-		data = record.firstChild.data.strip()
+		data = record.text
 		self.debug("data=%r" % (data))
 
 		base, name, md5, build = data.split(";")
@@ -239,14 +262,15 @@ class Downloader(object):
 	def downloadMfil(self, record):
 		program = self.args.program
 
-		data = record.firstChild.data.strip()
+		data = record.text
 		self.debug("data=%r" % (data))
 
 		base, thash, mhash, build = data.split(";")
 		self.debug("base=%r" % (base))
 
 		build = int(build)
-		baseUrl = self.getBaseUrl(base, program, self.args.preferred_server)
+		with self.profiler.phase("config-fetch"):
+			baseUrl = self.getBaseUrl(base, program, self.args.preferred_server)
 		self.debug("baseUrl=%r" % (baseUrl))
 		tfilUrl = baseUrl + "%s-%i-%s.torrent" % (program.lower(), build, thash)
 		if self.args.mfil:
@@ -258,22 +282,85 @@ class Downloader(object):
 		self.debug("mfilUrl=%r" % (mfilUrl))
 		self.debug("build=%r" % (build))
 
-		torrent = self.cache.get(tfilUrl)
-		if torrent:
-			self.debug("cache hit: torrent=%r" % (torrent))
-			torrent = open(torrent, "rb")
-		else:
-			self.debug("Reading torrent file: %r" % (tfilUrl))
-			try:
-				torrent = urlopen(tfilUrl)
-			except HTTPError as e:
-				raise ServerError("Could not open %s: %s" % (tfilUrl, e))
+		with self.profiler.phase("torrent"):
+			d = self.getTorrent([tfilUrl])
+		directDownload = self.getDirectDownload(d)
+
+		with self.profiler.phase("manifest"):
+			mfil = self.getMfil([mfilUrl])
+
+		if self.args.from_build is not None:
+			with self.profiler.phase("diff"):
+				old = self.loadBuild(record.component, (baseUrl, directDownload), self.args.from_build)
+				if old is None:
+					return
+				oldDirectDownload, oldFiles = old
+				newFiles = builddiff.build_files(mfil, d)
+			with self.profiler.phase("output"):
+				self.outputDiff(oldFiles, newFiles, oldDirectDownload, directDownload)
+			return
+
+		files = set()
+		for file, fileInfo in mfil["file"].items():
+
+			if isinstance(fileInfo["size"], str) and int(fileInfo["size"]) == 0:
+				# Directory
+				continue
 
-			path, torrent = self.cache.set(tfilUrl, torrent.read())
-			self.debug("Cache torrent path=%r" % (path))
+			files.add(file)
 
+		if True: # add a flag to disable?
+			for f in d["info"]["files"]:
+				if f["type"] == "alignment":
+					continue
+				files.add("/".join(f["path"]))
+
+		with self.profiler.phase("output"):
+			self.outputFiles(files, directDownload, mfil["file"])
+
+	def openManifest(self, urls):
+		"""
+		Returns the mfil or torrent file found at the first of urls (the same
+		file name on several servers) that has it, as a binary file object.
+		The cache and the local tree of the program are looked at first.
+		"""
+		name = os.path.basename(urls[0])
+		if self.cache.get(name):
+			self.debug("cache hit: %r" % (name))
+			return self.cache.open(name)
+
+		# checksizes-style trees keep the manifests next to the files
+		programDir = os.path.join(self.args.base, self.args.program)
+		if os.path.isdir(programDir):
+			for dir in sorted(os.listdir(programDir)):
+				path = storage.find(os.path.join(programDir, dir, name))
+				if path:
+					self.debug("local copy: %r" % (path))
+					return storage.open(path)
+
+		error = None
+		for url in urls:
+			self.debug("Reading %r" % (url))
+			try:
+				data = urlopen(url).read()
+			except HTTPError as e:
+				error = "Could not open %s: %s" % (url, e)
+				continue
+			if data == b"File not found.":
+				error = "File not found: %r" % (url)
+				continue
+			path, f = self.cache.set(name, data)
+			self.debug("Cache path=%r" % (path))
+			return f
+		raise ServerError(error)
+
+	def getTorrent(self, urls):
+		"Returns the decoded torrent at the first of urls that has it, from the cache if possible"
+		torrent = self.openManifest(urls)
 		self.debug("Parsing torrent...")
-		d = bdecode(torrent)
+		return bdecode(torrent)
+
+	def getDirectDownload(self, d):
 		directDownload = d["direct download"]
 		self.debug("directDownload=%r" % (directDownload))
 
@@ -285,38 +372,37 @@ class Downloader(object):
 		# get a different result depending on whether it does or not
 		if not directDownload.endswith("/"):
 			directDownload += "/"
+		return directDownload
 
-		mfil = self.cache.get(mfilUrl)
-		if mfil:
-			self.debug("cache hit: mfil=%r" % (mfil))
-		else:
-			self.debug("Reading manifest file: %r" % (mfilUrl))
-			try:
-				mfil = urlopen(mfilUrl).read()
-			except HTTPError as e:
-				raise ServerError("Could not open %s: %s" % (mfilUrl, e))
-
-			mfilPath, mfil = self.cache.set(mfilUrl, mfil)
-			self.debug("Cache manifest path=%r" % (mfilPath))
-
-		mfil = MFIL(mfil)
+	def getMfil(self, urls):
+		"Returns the parsed mfil at the first of urls that has it, from the cache if possible"
+		return MFIL(self.openManifest(urls))
 
-		files = set()
-		for file, fileInfo in mfil["file"].items():
+	def loadBuild(self, component, bases, build):
+		"""
+		Returns (direct download url, files) for build, looked up in the
+		build database, or None if it is not listed there. Its mfil and
+		torrent are looked for on bases, then on the servers getmanifests
+		knows of, unless they are cached.
+		"""
+		from getmanifests import bases as knownBases
 
-			if isinstance(fileInfo["size"], str) and int(fileInfo["size"]) == 0:
-				# Directory
-				continue
-
-			files.add(file)
+		program = self.args.program
+		with open(self.args.db, "r") as f:
+			db = json.load(f)
 
-		if True: # add a flag to disable?
-			for f in d["info"]["files"]:
-				if f["type"] == "alignment":
-					continue
-				files.add("/".join(f["path"]))
+		for entry in db:
+			if entry["program"] == program and entry["component"] == component and int(entry["build"]) == build:
+				break
+		else:
+			self.error("Build %i of %s %s is not in %s" % (build, program, component, self.args.db))
+			return None
 
-		self.outputFiles(files, directDownload, mfil["file"])
+		bases = list(bases) + [base + "/" for base in sorted(knownBases)]
+		tfil = "%s-%i-%s.torrent" % (program.lower(), build, entry["tHash"])
+		mfil = "%s-%i-%s.mfil" % (program.lower(), build, entry["mHash"])
+		d = self.getTorrent([base + tfil for base in bases])
+		return self.getDirectDownload(d), builddiff.build_files(self.getMfil([base + mfil for base in bases]), d)
 
 	def getBaseUrl(self, base, product, server):
 		try:
@@ -359,35 +445,16 @@ class Downloader(object):
 		clientVersion = self.args.client
 		tool = self.args.tool
 
-		dom = getDOMImplementation().createDocument(None, "version", None)
-		dom.documentElement.setAttribute("program", program)
-
-		record = dom.createElement("record")
-		record.setAttribute("program", "Bnet")
-		record.setAttribute("component", "Win")
-		record.setAttribute("version", "1")
-		dom.documentElement.appendChild(record)
-
-		record = dom.createElement("record")
-		record.setAttribute("program", "Agnt")
-		record.setAttribute("component", "cdn")
-		record.setAttribute("version", "1")
-		dom.documentElement.appendChild(record)
-
-		record = dom.createElement("record")
-		record.setAttribute("program", program)
-		record.setAttribute("component", component)
-		record.setAttribute("version", str(clientVersion))
-		dom.documentElement.appendChild(record)
+		records = [
+			Record("Bnet", "Win", "1"),
+			Record("Agnt", "cdn", "1"),
+			Record(program, component, str(clientVersion)),
+		]
 
 		if tool is not None:
-			record = dom.createElement("record")
-			record.setAttribute("program", "Tool")
-			record.setAttribute("component", "Win")
-			record.setAttribute("version", str(tool))
-			dom.documentElement.appendChild(record)
+			records.append(Record("Tool", "Win", str(tool)))
 
-		return dom.documentElement.toxml("utf-8")
+		return dump_request(program, records)
 
 	def outputFiles(self, files, baseUrl, mfil=None):
 		formats = {
@@ -431,10 +498,38 @@ class Downloader(object):
 
 				output.append(outputFormat % {"url": baseUrl + file, "output": path})
 				total += 1
+				if self.plan is not None:
+					size = int(mfil[file]["size"]) if mfil and file in mfil else None
+					self.plan.add("file", baseUrl + file, size)
 
+		if self.plan is not None:
+			# Only the summary is printed by run()
+			output = []
 		print("\n".join(output))
 		print("%i/%i files" % (total, len(files)))
 
+	def outputDiff(self, oldFiles, newFiles, oldBaseUrl, baseUrl):
+		"""
+		Output the commands updating the local tree of the build of oldFiles
+		(served from oldBaseUrl) to the build of newFiles. See builddiff.update().
+		"""
+		oldDir = os.path.join(self.args.base, self.args.program, oldBaseUrl.split("/")[-2])
+		targetDir = os.path.join(self.args.base, self.args.program, baseUrl.split("/")[-2])
+		if not os.path.isdir(oldDir):
+			self.warn("No local tree of build %i at %s" % (self.args.from_build, oldDir))
+
+		added, removed, changed = builddiff.diff(oldFiles, newFiles)
+		output, downloads = builddiff.update(oldFiles, newFiles, oldDir, targetDir, baseUrl)
+		if self.plan is not None:
+			for url, size in downloads:
+				self.plan.add("file", url, size)
+			# Only the summary is printed by run()
+			output = []
+		print("\n".join(output))
+		print("%i added, %i removed, %i changed files: %i files (%i bytes) to download" % (
+			len(added), len(removed), len(changed), len(downloads), sum(size for url, size in downloads)
+		))
+
 def main():
 	app = Downloader(sys.argv[1:])
 	exit(app.exec_())
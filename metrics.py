@@ -0,0 +1,220 @@
+"""
+Per-request metrics for the transport paths.
+Counters and latency histograms labelled by host and object type,
+exportable as a Prometheus text file or as JSON.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+PREFIX = "patchtools_"
+
+
+def _labels(labels):
+	return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+	labels = list(labels) + list(extra)
+	if not labels:
+		return ""
+	values = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+	return "{%s}" % (values)
+
+
+class Histogram(object):
+	__slots__ = ("counts", "sum", "count")
+
+	def __init__(self):
+		self.counts = [0] * len(BUCKETS)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		for i, bound in enumerate(BUCKETS):
+			if value <= bound:
+				self.counts[i] += 1
+		self.sum += value
+		self.count += 1
+
+
+class Registry(object):
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.counters = {}
+		self.histograms = {}
+
+	def inc(self, name, value=1, **labels):
+		key = (name, _labels(labels))
+		with self._lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def observe(self, name, value, **labels):
+		key = (name, _labels(labels))
+		with self._lock:
+			if key not in self.histograms:
+				self.histograms[key] = Histogram()
+			self.histograms[key].observe(value)
+
+	def reset(self):
+		with self._lock:
+			self.counters.clear()
+			self.histograms.clear()
+
+	def snapshot(self):
+		"Returns a picklable copy of the metrics, to merge() into another registry"
+		with self._lock:
+			return dict(self.counters), dict(self.histograms)
+
+	def merge(self, snapshot):
+		"Add the metrics of a snapshot() (eg. from a worker process) to this registry"
+		counters, histograms = snapshot
+		with self._lock:
+			for key, value in counters.items():
+				self.counters[key] = self.counters.get(key, 0) + value
+			for key, other in histograms.items():
+				if key not in self.histograms:
+					self.histograms[key] = Histogram()
+				h = self.histograms[key]
+				h.counts = [a + b for a, b in zip(h.counts, other.counts)]
+				h.sum += other.sum
+				h.count += other.count
+
+	def to_prometheus(self):
+		lines = []
+		with self._lock:
+			names = set()
+			for (name, labels), value in sorted(self.counters.items()):
+				if name not in names:
+					lines.append("# TYPE %s%s counter" % (PREFIX, name))
+					names.add(name)
+				lines.append("%s%s%s %s" % (PREFIX, name, _format_labels(labels), value))
+
+			for (name, labels), h in sorted(self.histograms.items(), key=lambda item: item[0]):
+				if name not in names:
+					lines.append("# TYPE %s%s histogram" % (PREFIX, name))
+					names.add(name)
+				for bound, count in zip(BUCKETS, h.counts):
+					lines.append("%s%s_bucket%s %i" % (PREFIX, name, _format_labels(labels, [("le", bound)]), count))
+				lines.append("%s%s_bucket%s %i" % (PREFIX, name, _format_labels(labels, [("le", "+Inf")]), h.count))
+				lines.append("%s%s_sum%s %f" % (PREFIX, name, _format_labels(labels), h.sum))
+				lines.append("%s%s_count%s %i" % (PREFIX, name, _format_labels(labels), h.count))
+
+		return "\n".join(lines) + "\n"
+
+	def to_json(self):
+		with self._lock:
+			counters = [
+				{"name": name, "labels": dict(labels), "value": value}
+				for (name, labels), value in sorted(self.counters.items())
+			]
+			histograms = [
+				{
+					"name": name,
+					"labels": dict(labels),
+					"buckets": dict(zip(BUCKETS, h.counts)),
+					"sum": h.sum,
+					"count": h.count,
+				}
+				for (name, labels), h in sorted(self.histograms.items(), key=lambda item: item[0])
+			]
+		return json.dumps({"timestamp": time.time(), "counters": counters, "histograms": histograms}, indent="\t")
+
+	def write(self, path):
+		"Write the metrics to path, as JSON if it ends with .json or as Prometheus text otherwise"
+		data = self.to_json() if path.endswith(".json") else self.to_prometheus()
+		tmp = path + ".tmp"
+		with open(tmp, "w") as f:
+			f.write(data)
+		os.replace(tmp, path)
+
+
+REGISTRY = Registry()
+
+
+def _host(url):
+	return urlparse(url).netloc or url
+
+
+def request(url, type, bytes, seconds, status=200):
+	"Record a completed request to url for an object of the given type"
+	host = _host(url)
+	REGISTRY.inc("requests_total", host=host, type=type, status=status)
+	REGISTRY.inc("bytes_total", bytes, host=host, type=type)
+	REGISTRY.observe("request_seconds", seconds, host=host, type=type)
+
+
+def cache_hit(url, type):
+	"Record that the object of the given type at url was already on disk"
+	REGISTRY.inc("cache_hits_total", host=_host(url), type=type)
+
+
+def cache_miss(url, type):
+	"Record that the object of the given type at url had to be fetched"
+	REGISTRY.inc("cache_misses_total", host=_host(url), type=type)
+
+
+def shared_fetch():
+	"Record a fetch that was answered by an identical fetch of the same process"
+	REGISTRY.inc("shared_fetches_total")
+
+
+def verify_failure(url, type):
+	REGISTRY.inc("verify_failures_total", host=_host(url), type=type)
+
+
+def retry(url, type):
+	REGISTRY.inc("retries_total", host=_host(url), type=type)
+
+
+def circuit_opened(host):
+	REGISTRY.inc("circuit_open_total", host=host)
+
+
+def write(path):
+	REGISTRY.write(path)
+
+
+class Writer(threading.Thread):
+	"""
+	Writes the metrics to path every interval seconds, and once more on stop().
+	"""
+	def __init__(self, path, interval=60):
+		super().__init__(daemon=True)
+		self.path = path
+		self.interval = interval
+		self._stop_event = threading.Event()
+
+	def run(self):
+		while not self._stop_event.wait(self.interval):
+			write(self.path)
+
+	def stop(self):
+		self._stop_event.set()
+		write(self.path)
+
+
+def add_arguments(parser):
+	"Add the --metrics and --metrics-interval options used by writer() to an ArgumentParser"
+	parser.add_argument("--metrics", type=str, dest="metrics", help="write metrics to this file (JSON if it ends with .json, Prometheus text otherwise)")
+	parser.add_argument("--metrics-interval", type=int, dest="metrics_interval", default=60, help="seconds between metrics file updates")
+
+
+@contextmanager
+def writer(args):
+	"Write the metrics to the --metrics file of the parsed args (if any) while in the block, and once more on exit"
+	if not args.metrics:
+		yield None
+		return
+	writer = Writer(args.metrics, args.metrics_interval)
+	writer.start()
+	try:
+		yield writer
+	finally:
+		writer.stop()
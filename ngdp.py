@@ -1,17 +1,30 @@
 #!/usr/bin/env python
 
+import json
 import logging
-import requests
 import hashlib
 import os
 import re
+import sys
+import metrics
+import multiprocessing
+import retry
+import storage
+from argparse import ArgumentParser
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from logging.handlers import QueueHandler, QueueListener
 from urllib.parse import urlparse
-from bpp import NGDPConnection, BPPConnection, Catalog
-
-logging.basicConfig(level=logging.DEBUG)
+import archiveindex
+from bpp import INDEX_TYPES, NGDPConnection, BPPConnection, Catalog, ServerError
+from plan import Plan
+from profiling import Profiler
+from retry import FetchError
+from scheduler import ARCHIVE, INDEX, Scheduler, parse_rate
 
 USER_AGENT = "NGDP12"
 MPQ_BASE_DIR = os.environ.get("MPQ_BASE_DIR", os.path.join(os.environ.get("XDG_DATA_HOME", os.path.join(os.path.expanduser("~"), ".local", "share")), "mpq"))
+# The patch server region codes substituted for {REGION_CODE}, by preference
+REGION_CODES = ("us", "eu", "kr", "tw", "cn")
 MD5_REGEX = re.compile(r"[0-9a-f]{32}", re.I)
 
 
@@ -42,13 +55,12 @@ def cache_old(url):
 	filename = os.path.basename(path)
 	full_path = os.path.join(save_path, filename)
 
-	if os.path.exists(full_path):
+	if storage.exists(full_path):
 		return
 
-	if not os.path.exists(save_path):
-		os.makedirs(save_path)
+	import requests
 
-	r = requests.get(url)
+	r = retry.fetch([url], lambda url: requests.get(url, timeout=retry.DEFAULT_POLICY.timeout), "old")
 	if r.status_code == 404:
 		logging.error("Not found: %r", r.url)
 		return
@@ -62,76 +74,570 @@ def cache_old(url):
 		content_hash = hashlib.md5(r.content).hexdigest()
 		assert content_hash == checksum, "%r != %r" % (content_hash, checksum)
 
-	with open(full_path, "wb") as f:
-		f.write(r.content)
+	storage.write(full_path, r.content)
 
 
-if __name__ == "__main__":
-	import sys
-	if len(sys.argv) > 1:
-		version = sys.argv[1]
+def cache_archive(ngdp, archive, index, type="data"):
+	"Wait for the archive's .index to be cached, then cache the archive itself"
+	index.result()
+	return ngdp.cache_hash(archive, type=type)
+
+
+def get_server(d, region="us"):
+	"""
+	Returns the patch server of a catalog install, caching the files of
+	old-style catalogs. If region is None, {REGION_CODE} is left in place.
+	"""
+	if "instructions_url" in d:
+		if region is None:
+			return d["instructions_url"]
+		return d["instructions_url"].replace("{REGION_CODE}", region)
+
+	# old-style catalog
+	other_urls = set()
+
+	if "configuration" in d:
+		# eg. http://dist.blizzard.com.edgesuite.net/tools-pod/bna/cache/b5/05/b5056174e18346a7c6c5a1e06cc0e828
+		for lang, dd in d["configuration"].items():
+			for key, url in dd.items():
+				if key != "instructions_url":
+					other_urls.add(url)
+		server = d["configuration"]["enus"]["instructions_url"]
 	else:
-		version = 16
-	catalog = get_catalog(version)
-	# Old catalogs:
-	# catalog = Catalog("dist.blizzard.com.edgesuite.net", "tools-pod/bna/cache", "45743849d79f0d8b21c4a15d24784d4f")
-	# catalog = Catalog("dist.blizzard.com.edgesuite.net", "tools-pod/bna/cache", "53edb19ea85ae425aa5f48c4e39e7f55")
-	# catalog = Catalog("dist.blizzard.com.edgesuite.net", "tools-pod/bna/cache", "8ed65f975dc4e830c44bf885332a219b")
-	# catalog = Catalog("dist.blizzard.com.edgesuite.net", "tools-pod/bna/cache", "d0cb714772d51f35bf96475ea120a7a2")
-	# catalog = Catalog("dist.blizzard.com.edgesuite.net", "tools-pod/bna/cache", "e8abcaca9b130e806c4baed122d4385c")
-
-	catalog.preload()
-
-	for lang, clog in catalog.regions.items():
-		for product, d in clog.root["installs"].items():
-
-			if "instructions_url" not in d:
-				# old-style catalog
-				other_urls = set()
-
-				if "configuration" in d:
-					# eg. http://dist.blizzard.com.edgesuite.net/tools-pod/bna/cache/b5/05/b5056174e18346a7c6c5a1e06cc0e828
-					for lang, dd in d["configuration"].items():
-						for key, url in dd.items():
-							if key != "instructions_url":
-								other_urls.add(url)
-					server = d["configuration"]["enus"]["instructions_url"]
-				else:
-					for lang, dd in d.items():
-						if isinstance(dd, dict):
-							for key, url in dd.items():
-								if key != "instructions_url":
-									other_urls.add(url)
-					server = d["enus"]["instructions_url"]
+		for lang, dd in d.items():
+			if isinstance(dd, dict):
+				for key, url in dd.items():
+					if key != "instructions_url":
+						other_urls.add(url)
+		server = d["enus"]["instructions_url"]
+
+	for url in other_urls:
+		cache_old(url)
+
+	return server
+
 
-				for url in other_urls:
-					cache_old(url)
+def state_key(name, tags=None):
+	"""
+	Returns the SyncState key of name. Syncs limited to install tags only
+	fetch part of a build: they are recorded apart (as name#tag,...), so
+	that a later full incremental sync does not take them as complete.
+	"""
+	if not tags:
+		return name
+	return "%s#%s" % (name, ",".join(sorted(tag.lower() for tag in tags)))
 
+
+class SyncState(object):
+	"""
+	Remembers the last synced cdnconfig hash of each product, for incremental runs.
+	A SyncState without a path is only kept in memory.
+	"""
+	def __init__(self, path=None):
+		self.path = path
+		self.products = {}
+		if path and os.path.exists(path):
+			with open(path, "r") as f:
+				self.products = json.load(f)
+
+	def __repr__(self):
+		return "<SyncState at %r>" % (self.path)
+
+	def get(self, product):
+		return self.products.get(product)
+
+	def entries(self, product):
+		"Returns the entries of product, including those of its other regional builds (product@region)"
+		return {key: hash for key, hash in self.products.items() if key == product or key.startswith(product + "@")}
+
+	def set(self, product, hash):
+		self.products[product] = hash
+
+	def save(self):
+		if not self.path:
+			return
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		tmp = self.path + ".tmp"
+		with open(tmp, "w") as f:
+			json.dump(self.products, f, indent="\t", sort_keys=True)
+		os.replace(tmp, self.path)
+
+
+class Mirror(object):
+	"""
+	Mirrors every NGDP product in a catalog.
+	If a scheduler is given, indexes and archives are fetched on its workers
+	while the configs of the next products are being resolved.
+	If a SyncState is given, only the archives added since the last synced
+	cdnconfig of each product are fetched.
+	If install tags are given (eg. Windows, x86_64, enUS), only the files of
+	the install manifest matching them are fetched, as loose data files.
+	Files that have a patch from a version already on disk are fetched as
+	patches instead.
+	If a Plan is given, the configs are resolved but no archive is fetched:
+	what would be is added to the plan instead. With install tags, the
+	encoding table, install and patch manifests of each build are still
+	fetched to select the files (tens of MB per product).
+	With all_regions, the versions of every region are queried and each
+	distinct build is mirrored, instead of only the first region's.
+	"""
+	def __init__(self, save_path=MPQ_BASE_DIR, profiler=None, scheduler=None, state=None, tags=None, plan=None, all_regions=False):
+		self.save_path = save_path
+		self.profiler = profiler or Profiler()
+		self.scheduler = scheduler
+		self.state = state
+		self.tags = tags
+		self.plan = plan
+		self.all_regions = all_regions
+		self.unreferenced = {}
+		self.synced = {}
+		self._pending = []
+
+	def products(self, catalog):
+		seen = set()
+		for lang, clog in catalog.regions.items():
+			for product, d in clog.root["installs"].items():
+				if product in seen:
+					continue
+				seen.add(product)
+				server = get_server(d, None if self.all_regions else "us")
+				if server.endswith(":1119/patch"):
+					# "Skipping old patch system
+					continue
+				yield product, server
+
+			if not self.all_regions:
+				# The installs are the same in every lang
+				break
+
+	def run(self, catalog):
+		for product, server in self.products(catalog):
+			self.sync_product(product, server)
+		self.finish()
+
+	def archives(self, ngdp, product, hash, cdnconfig, key="archives", seen=None):
+		"""
+		Returns the archives (or patch-archives, depending on key) of cdnconfig
+		to fetch for product (or for one of its regional builds, see
+		sync_product). Archives in seen, if given, are left out; the others
+		are added to it.
+		"""
+		ret = cdnconfig[key]
+		previous = self.state.get(product) if self.state is not None else None
+		if previous == hash:
+			logging.info("%r is up to date (cdnconfig %r)", product, hash)
+			ret = []
+		elif previous:
+			old = ngdp.config(previous)
+			if old and key in old:
+				old_archives = set(old[key])
+				new_archives = set(cdnconfig[key])
+				ret = [archive for archive in cdnconfig[key] if archive not in old_archives]
+				removed = [archive for archive in old[key] if archive not in new_archives]
+				logging.info("%r: cdnconfig %r -> %r, %i new %s, %i no longer referenced", product, previous, hash, len(ret), key, len(removed))
+				if removed:
+					self.unreferenced.setdefault(product, []).extend(removed)
+
+		if seen is not None:
+			ret = [archive for archive in ret if archive not in seen]
+			seen.update(ret)
+		return ret
+
+	def sync_product(self, product, server):
+		"""
+		Mirror the build of the first region of product, or with all_regions,
+		every distinct build of its regions. server may contain {REGION_CODE},
+		in which case the versions of every region code are queried.
+		The builds of the other regions are tracked as product@region.
+		"""
+		servers = [server]
+		if "{REGION_CODE}" in server:
+			servers = [server.replace("{REGION_CODE}", code) for code in REGION_CODES]
+		logging.info("Initializing new NGDP Connection for %r: %r", product, servers[0])
+		ngdp = NGDPConnection(servers[0], save_path=self.save_path, scheduler=self.scheduler)
+
+		with self.profiler.phase("version-query"):
+			if self.all_regions and len(servers) > 1:
+				ngdp.merge_versions(servers[1:])
+			regions = ngdp.regions
+
+		if not self.all_regions:
+			self.sync_build(ngdp, product, product, regions[0])
+			return
+
+		groups = ngdp.region_groups()
+		logging.info("%r: %i regions, %i distinct builds", product, len(regions), len(groups))
+		seen = set()
+		for i, group in enumerate(groups.values()):
+			name = product if i == 0 else "%s@%s" % (product, group[0])
+			self.sync_build(ngdp, product, name, group[0], seen)
+
+	def sync_build(self, ngdp, product, name, region, seen=None):
+		"Mirror the build of product for region, recording it as name. See archives() for seen."
+		profiler = self.profiler
+		try:
+			with profiler.phase("config-fetch"):
+				buildconfig = ngdp.build_config(region=region)
+		except AssertionError as e:
+			if product != "prometheus":
+				raise
 			else:
-				server = d["instructions_url"].replace("{REGION_CODE}", "us") # XXX
-			if server.endswith(":1119/patch"):
-				# "Skipping old patch system
+				logging.error("Hash failing? %r", e)
+				return
+		with profiler.phase("config-fetch"):
+			cdnconfig = ngdp.cdn_config(region=region)
+
+		if "archives" not in cdnconfig:
+			logging.warn("No archives in %r", cdnconfig)
+			return
+
+		hash = ngdp.version(region, "cdnconfig")
+		if self.plan is not None:
+			self.plan_product(ngdp, name, region, buildconfig, cdnconfig, hash, seen)
+			return
+		if self.tags:
+			results = self.sync_selected(ngdp, product, region, cdnconfig)
+			self._pending.append((state_key(name, self.tags), hash, results))
+			return
+
+		results = []
+		if "patch" in buildconfig:
+			# The patch manifest, so that clients can update from older builds
+			with profiler.phase("config-fetch"):
+				results.append(ngdp.cache_hash(buildconfig["patch"], type="patch", index=False))
+
+		for type, key in (("data", "archives"), ("patch", "patch-archives")):
+			if key not in cdnconfig:
 				continue
-			logging.info("Initializing new NGDP Connection for %r: %r", product, server)
-			ngdp = NGDPConnection(server, save_path=MPQ_BASE_DIR)
+			for archive in self.archives(ngdp, name, hash, cdnconfig, key, seen):
+				if self.scheduler:
+					index = self.scheduler.submit(ngdp.cache_index, archive, type, priority=INDEX, product=product)
+					results.append(self.scheduler.submit(cache_archive, ngdp, archive, index, type, priority=ARCHIVE, product=product))
+					continue
 
-			regions = ngdp.regions
+				try:
+					with profiler.phase("index-verify"):
+						ngdp.cache_index(archive, type)
+				except FetchError:
+					logging.exception("Error while caching the index of %r for %r", archive, product)
+					results.append(None)
+					continue
+				with profiler.phase("archive-download"):
+					results.append(ngdp.cache_hash(archive, type=type))
+
+		self._pending.append((name, hash, results))
+
+	def select(self, product, manifest):
+		"Returns the entries of manifest matching self.tags, ignoring the tags it does not have"
+		names = {name.lower() for name in manifest.tag_names()}
+		tags = [tag for tag in self.tags if tag.lower() in names]
+		if len(tags) < len(self.tags):
+			logging.warning("%r has no %s install tag, ignoring it", product, ", ".join(tag for tag in self.tags if tag not in tags))
+		if not tags:
+			return []
+		return manifest.select(tags)
+
+	def sync_selected(self, ngdp, product, region, cdnconfig):
+		"""
+		Fetch the files of the install manifest matching self.tags.
+		Returns the results to wait for; errors are logged and recorded as
+		a None result (an incomplete sync).
+		"""
+		try:
+			return self._sync_selected(ngdp, product, region, cdnconfig)
+		except (KeyError, FetchError, ServerError):
+			logging.exception("Error while fetching the %s files of %r", ",".join(self.tags), product)
+			return [None]
+
+	def _sync_selected(self, ngdp, product, region, cdnconfig):
+		profiler = self.profiler
+		with profiler.phase("config-fetch"):
+			manifest = ngdp.install_manifest(region)
+			encoding = ngdp.encoding(region)
+			patches = ngdp.patch_manifest(region)
+		entries = self.select(product, manifest)
+		logging.info(
+			"%r: %i/%i files selected for %s (%i bytes of %i)", product, len(entries), len(manifest),
+			",".join(self.tags), sum(entry.size for entry in entries), sum(entry.size for entry in manifest.entries)
+		)
+
+		ekeys, patch_ekeys = [], []
+		missing = 0
+		for entry, ekey in zip(entries, encoding.lookup_hex(entry.ckey for entry in entries)):
+			if ekey is None:
+				missing += 1
+				continue
+			record = self.patch_for(ngdp, patches, entry.ckey, ekey)
+			if record:
+				patch_ekeys.append(record.patch_ekey)
+			else:
+				ekeys.append(ekey)
+		if missing:
+			logging.warning("%r: %i selected files are missing from the encoding table", product, missing)
+		if patch_ekeys:
+			logging.info("%r: fetching %i files as patches", product, len(patch_ekeys))
+
+		results = []
+		with profiler.phase("index-verify"):
+			ranges, loose = ngdp.locate(ekeys, cdnconfig["archives"])
+		self.fetch(ngdp, product, "data", ranges, loose, results)
+		if patch_ekeys:
+			with profiler.phase("index-verify"):
+				ranges, loose = ngdp.locate(patch_ekeys, cdnconfig.get("patch-archives", []), type="patch")
+			self.fetch(ngdp, product, "patch", ranges, loose, results)
+		return results
+
+	def plan_product(self, ngdp, product, region, buildconfig, cdnconfig, hash, seen=None):
+		"Add what sync_build would fetch for product to self.plan"
+		plan = self.plan
+		if self.tags:
 			try:
-				buildconfig = ngdp.build_config(region=regions[0])
-			except AssertionError as e:
-				if product != "prometheus":
-					raise
-				else:
-					logging.error("Hash failing? %r", e)
+				with self.profiler.phase("config-fetch"):
+					manifest = ngdp.install_manifest(region)
+					encoding = ngdp.encoding(region)
+					patches = ngdp.patch_manifest(region)
+			except (KeyError, FetchError, ServerError):
+				logging.exception("Error while planning the %s files of %r", ",".join(self.tags), product)
+				return
+			entries = self.select(product, manifest)
+			for entry, ekey in zip(entries, encoding.lookup_hex(entry.ckey for entry in entries)):
+				if ekey is None or os.path.exists(ngdp.get_paths(ekey, "data")[1]):
 					continue
-			cdnconfig = ngdp.cdn_config(region=regions[0])
+				record = self.patch_for(ngdp, patches, entry.ckey, ekey)
+				if record:
+					plan.add("patch", ngdp.get_paths(record.patch_ekey, "patch")[0], record.patch_size)
+				else:
+					plan.add("data", ngdp.get_paths(ekey, "data")[0], encoding.encoded_size(ekey))
+			return
 
-			if "archives" not in cdnconfig:
-				logging.warn("No archives in %r", cdnconfig)
+		if "patch" in buildconfig:
+			url, path = ngdp.get_paths(buildconfig["patch"], "patch")
+			if not os.path.exists(path):
+				plan.add("patch", url)
+
+		for type, key in (("data", "archives"), ("patch", "patch-archives")):
+			if key not in cdnconfig:
 				continue
-			for archive in cdnconfig["archives"]:
-				ngdp.cache_hash(archive, type="data")
+			index_type = INDEX_TYPES[type]
+			# The cdnconfig lists the size of each archive index
+			index_sizes = dict(zip(cdnconfig[key], cdnconfig.get(key + "-index-size", [])))
+			for archive in self.archives(ngdp, product, hash, cdnconfig, key, seen):
+				archive_size = None
+				index_url, index_path = ngdp.get_paths(archive, index_type)
+				if os.path.exists(index_path):
+					try:
+						archive_size = archiveindex.load(index_path).archive_size
+					except archiveindex.ArchiveIndexError as e:
+						logging.warning("Could not read %r: %s", index_path, e)
+				else:
+					size = index_sizes.get(archive)
+					plan.add(index_type, index_url, int(size) if size else None)
+
+				url, path = ngdp.get_paths(archive, type)
+				if not os.path.exists(path):
+					plan.add(type, url, archive_size)
+
+	def patch_for(self, ngdp, patches, ckey, ekey):
+		"""
+		Returns the PatchRecord to fetch instead of the file ekey, if its
+		source is already on disk (and the file itself is not).
+		"""
+		if patches is None or os.path.exists(ngdp.get_paths(ekey, "data")[1]):
+			return None
+		for record in patches.get(ckey):
+			if os.path.exists(ngdp.get_paths(record.source_ekey, "data")[1]):
+				return record
+
+	def fetch(self, ngdp, product, type, ranges, loose, results):
+		"Fetch the archive ranges and loose files returned by NGDPConnection.locate()"
+		for archive, archive_entries in ranges.items():
+			if self.scheduler:
+				results.append(self.scheduler.submit(ngdp.cache_ranges, archive, archive_entries, type, priority=ARCHIVE, product=product))
+				continue
+			try:
+				with self.profiler.phase("archive-download"):
+					results.append(ngdp.cache_ranges(archive, archive_entries, type))
+			except (FetchError, ServerError):
+				logging.exception("Error while fetching from %r for %r", archive, product)
+				results.append(None)
+		for ekey in sorted(loose):
+			if self.scheduler:
+				results.append(self.scheduler.submit(ngdp.cache_hash, ekey, type, index=False, priority=ARCHIVE, product=product))
+				continue
+			with self.profiler.phase("archive-download"):
+				results.append(ngdp.cache_hash(ekey, type, index=False))
+
+	def finish(self):
+		"Wait for the pending downloads and record the products that synced completely in self.synced"
+		for product, hash, results in self._pending:
+			complete = True
+			for result in results:
+				if isinstance(result, Future):
+					try:
+						result = result.result()
+					except Exception:
+						logging.exception("Error while caching archive for %r", product)
+						result = None
+				if result is None:
+					complete = False
 
-		# XXX We only need one lang, they're all the same.
-		break
+			if complete:
+				self.synced[product] = hash
+			if self.state is not None:
+				if complete:
+					self.state.set(product, hash)
+				else:
+					logging.warning("%r did not sync completely, it will be retried next run", product)
+
+		self._pending = []
+		if self.state is not None:
+			self.state.save()
+
+
+def _init_worker(queue, level):
+	"Send the logs of a pool worker to the parent process"
+	root = logging.getLogger()
+	for handler in root.handlers[:]:
+		root.removeHandler(handler)
+	root.addHandler(QueueHandler(queue))
+	root.setLevel(level)
+
+
+def sync_shard(save_path, product, server, incremental=False, previous=None, tags=None, workers=0, rate=None, host_rate=None, all_regions=False):
+	"""
+	Mirror a single product, in a pool worker process. previous are the
+	SyncState entries of the product.
+	Returns the cdnconfig hashes of the builds that synced completely, the
+	archives that are no longer referenced (both by SyncState key) and a
+	snapshot of the metrics.
+	"""
+	metrics.REGISTRY.reset()
+	state = None
+	if incremental:
+		state = SyncState()
+		for key, hash in (previous or {}).items():
+			state.set(key, hash)
+	scheduler = None
+	if workers > 0:
+		scheduler = Scheduler(workers=workers, rate=rate, host_rate=host_rate)
+
+	try:
+		mirror = Mirror(save_path, scheduler=scheduler, state=state, tags=tags, all_regions=all_regions)
+		mirror.sync_product(product, server)
+		mirror.finish()
+	finally:
+		if scheduler:
+			scheduler.shutdown()
+	return mirror.synced, mirror.unreferenced, metrics.REGISTRY.snapshot()
+
+
+def run_sharded(catalog, jobs, save_path=MPQ_BASE_DIR, state=None, tags=None, workers=0, rate=None, host_rate=None, all_regions=False):
+	"""
+	Mirror the products of catalog on a pool of jobs processes, each with
+	its own NGDPConnection (and scheduler of workers threads). Bandwidth
+	caps are split evenly between the processes.
+	Logs and metrics of the workers are merged into the parent's.
+	Returns the archives that are no longer referenced, by product.
+	"""
+	products = list(Mirror(save_path, all_regions=all_regions).products(catalog))
+	if rate:
+		rate = max(rate // jobs, 1)
+	if host_rate:
+		host_rate = max(host_rate // jobs, 1)
+
+	root = logging.getLogger()
+	queue = multiprocessing.Queue()
+	listener = QueueListener(queue, *root.handlers, respect_handler_level=True)
+	listener.start()
+	unreferenced = {}
+	try:
+		with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(queue, root.level)) as executor:
+			futures = {}
+			for product, server in products:
+				previous = state.entries(product) if state is not None else None
+				args = (save_path, product, server, state is not None, previous, tags, workers, rate, host_rate, all_regions)
+				futures[executor.submit(sync_shard, *args)] = product
 
+			for future in as_completed(futures):
+				product = futures[future]
+				try:
+					synced, removed, snapshot = future.result()
+				except Exception:
+					logging.exception("Error while mirroring %r", product)
+					continue
+				metrics.REGISTRY.merge(snapshot)
+				unreferenced.update(removed)
+				if state is not None:
+					for key, hash in synced.items():
+						state.set(key, hash)
+					if state_key(product, tags) not in synced:
+						logging.warning("%r did not sync completely, it will be retried next run", product)
+	finally:
+		listener.stop()
+
+	if state is not None:
+		state.save()
+	return unreferenced
+
+
+def main():
+	logging.basicConfig(level=logging.DEBUG)
+	arguments = ArgumentParser(prog="ngdp")
+	arguments.add_argument("version", type=int, nargs="?", default=16, help="catalog version")
+	metrics.add_arguments(arguments)
+	arguments.add_argument("--profile", type=str, dest="profile", help="write per-phase cProfile stats and peak memory to this directory")
+	arguments.add_argument("--workers", type=int, dest="workers", default=4, help="concurrent archive downloads (0 to download inline, eg. for --profile)")
+	arguments.add_argument("--rate", type=parse_rate, dest="rate", help="global bandwidth cap in bytes/s (eg. 10M)")
+	arguments.add_argument("--host-rate", type=parse_rate, dest="host_rate", help="per-host bandwidth cap in bytes/s (eg. 2M)")
+	arguments.add_argument("--incremental", action="store_true", dest="incremental", help="only fetch archives added since the last synced cdnconfig of each product")
+	arguments.add_argument("--tags", type=str, dest="tags", help="only fetch the installed files matching these comma-separated install tags (eg. Windows,x86_64,enUS)")
+	arguments.add_argument("--plan", action="store_true", dest="plan", help="only print what would be fetched, with its size and an estimate of how long it would take (the configs are still fetched, and with --tags the encoding table, install and patch manifests of each build)")
+	arguments.add_argument("--all-regions", action="store_true", dest="all_regions", help="mirror the build of every region (each distinct build once) instead of the first region's")
+	arguments.add_argument("--jobs", type=int, dest="jobs", default=1, help="mirror products in this many processes (--workers then applies to each process, and --profile only covers the catalog load)")
+	args = arguments.parse_args(sys.argv[1:])
+	profiler = Profiler(args.profile)
+	scheduler = None
+	if args.workers > 0 and args.jobs <= 1 and not args.plan:
+		scheduler = Scheduler(workers=args.workers, rate=args.rate, host_rate=args.host_rate)
+
+	with metrics.writer(args):
+		try:
+			# Old catalogs:
+			# catalog = Catalog("dist.blizzard.com.edgesuite.net", "tools-pod/bna/cache", "45743849d79f0d8b21c4a15d24784d4f")
+			# catalog = Catalog("dist.blizzard.com.edgesuite.net", "tools-pod/bna/cache", "53edb19ea85ae425aa5f48c4e39e7f55")
+			# catalog = Catalog("dist.blizzard.com.edgesuite.net", "tools-pod/bna/cache", "8ed65f975dc4e830c44bf885332a219b")
+			# catalog = Catalog("dist.blizzard.com.edgesuite.net", "tools-pod/bna/cache", "d0cb714772d51f35bf96475ea120a7a2")
+			# catalog = Catalog("dist.blizzard.com.edgesuite.net", "tools-pod/bna/cache", "e8abcaca9b130e806c4baed122d4385c")
+			with profiler.phase("catalog-load"):
+				catalog = get_catalog(args.version)
+				catalog.preload()
+			state = None
+			if args.incremental:
+				state = SyncState(os.path.join(MPQ_BASE_DIR, "NGDP", "sync-state.json"))
+			tags = args.tags.split(",") if args.tags else None
+			if args.plan:
+				plan = Plan()
+				mirror = Mirror(MPQ_BASE_DIR, profiler, state=state, tags=tags, plan=plan, all_regions=args.all_regions)
+				for product, server in mirror.products(catalog):
+					mirror.sync_product(product, server)
+				plan.resolve()
+				print(plan.report(MPQ_BASE_DIR, plan.probe(), args.rate))
+				return
+			elif args.jobs > 1:
+				unreferenced = run_sharded(catalog, args.jobs, MPQ_BASE_DIR, state, tags, args.workers, args.rate, args.host_rate, args.all_regions)
+			else:
+				mirror = Mirror(MPQ_BASE_DIR, profiler, scheduler, state, tags, all_regions=args.all_regions)
+				mirror.run(catalog)
+				unreferenced = mirror.unreferenced
+			for product, archives in unreferenced.items():
+				print("%s: %i archives no longer referenced" % (product, len(archives)))
+				for archive in archives:
+					print("\t%s" % (archive))
+		finally:
+			if scheduler:
+				scheduler.shutdown()
+			profiler.write()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,89 @@
+"""
+Parser for NGDP patch manifests.
+The manifest lists, for every file of a build that can be patched, the
+patches that turn an older version of it (by ekey) into the new one.
+"""
+
+import struct
+from collections import namedtuple
+from hashlib import md5
+
+
+PatchRecord = namedtuple("PatchRecord", ("source_ekey", "source_size", "patch_ekey", "patch_size", "index"))
+
+HEADER = struct.Struct(">2sBBBBBHB")
+
+
+class PatchError(Exception):
+	pass
+
+
+class PatchManifest(object):
+	def __init__(self, data, verify=True):
+		data = bytes(data)
+		(
+			magic, self.version, file_key_size, old_key_size, patch_key_size,
+			block_size_bits, block_count, self.flags,
+		) = HEADER.unpack_from(data)
+		if magic != b"PA":
+			raise PatchError("Bad patch manifest magic: %r" % (magic))
+
+		pos = HEADER.size
+		self.encoding_ckey = data[pos:pos+16].hex()
+		self.encoding_ekey = data[pos+16:pos+32].hex()
+		pos += 32
+		self.encoding_size, self.encoding_encoded_size, espec_size = struct.unpack_from(">IIB", data, pos)
+		pos += 9
+		self.encoding_espec = data[pos:pos+espec_size].decode("utf-8")
+		pos += espec_size
+
+		block_size = 1 << block_size_bits
+		blocks = []
+		for i in range(block_count):
+			pos += file_key_size
+			checksum, offset = struct.unpack_from(">16sI", data, pos)
+			pos += 20
+			blocks.append((checksum, offset))
+
+		self.entries = {}
+		for i, (checksum, offset) in enumerate(blocks):
+			block = data[offset:offset+block_size]
+			if verify and md5(block).digest() != checksum:
+				raise PatchError("Checksum mismatch for patch manifest block %i" % (i))
+			self._parse_block(block, file_key_size, old_key_size, patch_key_size)
+
+	def __repr__(self):
+		return "<%s: %i files>" % (self.__class__.__name__, len(self))
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, ckey):
+		return ckey in self.entries
+
+	def _parse_block(self, block, file_key_size, old_key_size, patch_key_size):
+		pos = 0
+		while pos < len(block):
+			count = block[pos]
+			if not count:
+				break
+			pos += 1
+			ckey = block[pos:pos+file_key_size].hex()
+			# skip the decoded size of the target file
+			pos += file_key_size + 5
+			records = []
+			for i in range(count):
+				source_ekey = block[pos:pos+old_key_size].hex()
+				pos += old_key_size
+				source_size = int.from_bytes(block[pos:pos+5], "big")
+				pos += 5
+				patch_ekey = block[pos:pos+patch_key_size].hex()
+				pos += patch_key_size
+				patch_size, index = struct.unpack_from(">IB", block, pos)
+				pos += 5
+				records.append(PatchRecord(source_ekey, source_size, patch_ekey, patch_size, index))
+			self.entries[ckey] = records
+
+	def get(self, ckey):
+		"Returns the PatchRecords that produce the file ckey (empty if there are none)"
+		return self.entries.get(ckey, [])
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Single entry point for the patchtools scripts.
+Usage:
+	patchtools <command> [arguments...]
+	patchtools patchdl WoW --server public-test
+	patchtools ngdp --incremental
+
+Only the modules of the command being run are imported, so that short
+invocations from scripts do not pay for the whole NGDP/BPP stack.
+"""
+
+import os
+import sys
+
+
+# command -> (module, description)
+# Modules ending in .py are scripts that cannot be imported by name.
+COMMANDS = {
+	"patchdl": ("main", "list the files of a program's latest patch"),
+	"runner": ("runner", "query every known program on the BPP patch servers"),
+	"ngdp": ("ngdp", "mirror the NGDP products of the catalog"),
+	"fsck": ("fsck", "check the mirrored archives against their indexes"),
+	"proxy": ("proxy", "serve the mirror over HTTP, filling misses from the CDN"),
+	"compress": ("storage", "compress the catalogs, configs and manifests already on disk"),
+	"checksizes": ("checksizes", "check the sizes of the files listed in an mfil"),
+	"integrity": ("check-meta-integrity.py", "check the md5 of the cached mfil and torrent files"),
+	"getmanifests": ("getmanifests", "fetch the mfil and torrent files listed in db.json"),
+	"etr": ("etr", "extract the torrent from a Blizzard Downloader executable"),
+	"bench": ("bench", "benchmark the transport paths against a local fake CDN"),
+}
+
+
+def usage():
+	lines = ["usage: patchtools <command> [arguments...]", "", "commands:"]
+	for name, (module, description) in COMMANDS.items():
+		lines.append("\t%-14s%s" % (name, description))
+	return "\n".join(lines)
+
+
+def run(name, args):
+	"Run the command name as if its script had been called with args"
+	module, description = COMMANDS[name]
+	sys.argv = [name] + list(args)
+	if module.endswith(".py"):
+		import runpy
+		path = os.path.join(os.path.dirname(os.path.abspath(__file__)), module)
+		return runpy.run_path(path, run_name="__main__")
+
+	from importlib import import_module
+	return import_module(module).main()
+
+
+def main():
+	if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+		print(usage())
+		exit(len(sys.argv) < 2)
+
+	name = sys.argv[1]
+	if name not in COMMANDS:
+		sys.stderr.write("patchtools: unknown command %r\n\n%s\n" % (name, usage()))
+		exit(2)
+
+	run(name, sys.argv[2:])
+
+
+if __name__ == "__main__":
+	main()
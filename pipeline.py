@@ -0,0 +1,152 @@
+"""
+Overlapped download, verification and write stages.
+The thread receiving a response hands every chunk over to a hashing
+thread and to a writing thread, so that an object is verified and on
+disk almost as soon as its last byte arrives, instead of being hashed
+and written only once it has been downloaded. The chunks are shared by
+the stages, not copied. The queues between the stages are bounded: a
+slow disk slows the download down rather than filling memory.
+"""
+
+import os
+import queue
+import threading
+
+
+QUEUE_DEPTH = 64
+# Objects smaller than this go through the stages on the receiving
+# thread: starting threads would cost more than it saves
+INLINE_SIZE = 1024 * 1024
+
+_DONE = object()
+
+
+class Stage(object):
+	"""
+	Calls func on every item put into it, in order, on a thread of its own
+	(or on the calling thread if inline is set). The first exception
+	raised by func is raised again by put() or close().
+	"""
+	def __init__(self, func, depth=QUEUE_DEPTH, name=None, inline=False):
+		self.func = func
+		self.error = None
+		self._thread = None
+		if not inline:
+			self._queue = queue.Queue(depth)
+			self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+			self._thread.start()
+
+	def __repr__(self):
+		return "<Stage: %r>" % (self.func)
+
+	def _run(self):
+		while True:
+			item = self._queue.get()
+			if item is _DONE:
+				return
+			if self.error is None:
+				try:
+					self.func(item)
+				except BaseException as e:
+					self.error = e
+
+	def put(self, item):
+		if self.error is not None:
+			raise self.error
+		if self._thread is None:
+			try:
+				self.func(item)
+			except BaseException as e:
+				self.error = e
+				raise
+		else:
+			self._queue.put(item)
+
+	def close(self):
+		"Wait for the items put so far to be processed"
+		if self._thread is not None:
+			self._queue.put(_DONE)
+			self._thread.join()
+			self._thread = None
+		if self.error is not None:
+			raise self.error
+
+
+class Pipeline(object):
+	"""
+	Sink for the chunks of a download.
+	Chunks fed to it are written to a temporary file next to path (if any)
+	and passed to the update() of each of hashers, on separate threads.
+	Once the download is complete, close() waits for both stages; commit()
+	then moves the file in place, or abort() discards it. Used as a context
+	manager, the pipeline is aborted on error.
+	"""
+	def __init__(self, path=None, hashers=(), size=None, depth=QUEUE_DEPTH):
+		self.path = path
+		self.hashers = list(hashers)
+		self.size = 0
+		self.tmp = None
+		self._file = None
+		self._closed = False
+		self._stages = []
+		inline = size is not None and size < INLINE_SIZE
+		if path:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			self.tmp = "%s.%i-%i.part" % (path, os.getpid(), threading.get_ident())
+			self._file = open(self.tmp, "wb")
+			self._stages.append(Stage(self._file.write, depth, "pipeline-write", inline))
+		if self.hashers:
+			self._stages.append(Stage(self._hash, depth, "pipeline-hash", inline))
+
+	def __repr__(self):
+		return "<Pipeline to %r: %i bytes>" % (self.path, self.size)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		if type is not None:
+			self.abort()
+
+	def _hash(self, chunk):
+		for hasher in self.hashers:
+			hasher.update(chunk)
+
+	def feed(self, chunk):
+		self.size += len(chunk)
+		for stage in self._stages:
+			stage.put(chunk)
+
+	def close(self):
+		"Wait for the chunks fed so far to be hashed and written. Returns the size."
+		if self._closed:
+			return self.size
+		self._closed = True
+		error = None
+		for stage in self._stages:
+			try:
+				stage.close()
+			except BaseException as e:
+				error = error or e
+		if self._file:
+			self._file.close()
+		if error is not None:
+			raise error
+		return self.size
+
+	def commit(self):
+		"Move the downloaded file to path. Returns path."
+		self.close()
+		os.replace(self.tmp, self.path)
+		self.tmp = None
+		return self.path
+
+	def abort(self):
+		"Discard the downloaded file"
+		try:
+			self.close()
+		except Exception:
+			pass
+		if self.tmp and os.path.exists(self.tmp):
+			os.remove(self.tmp)
+		self.tmp = None
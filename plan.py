@@ -0,0 +1,147 @@
+"""
+Dry-run transfer plans.
+A Plan collects what a run would download, with sizes taken from index
+metadata where they are known and from concurrent HEAD requests
+otherwise, and estimates how long the transfer will take from a short
+throughput probe against the CDN.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import retry
+
+
+PROBE_SIZE = 8 << 20
+HEAD_WORKERS = 16
+
+
+def format_size(size):
+	for unit in ("B", "KiB", "MiB", "GiB"):
+		if size < 1024:
+			return "%.1f %s" % (size, unit)
+		size /= 1024
+	return "%.1f TiB" % (size)
+
+
+def format_duration(seconds):
+	seconds = int(seconds)
+	if seconds < 60:
+		return "%is" % (seconds)
+	if seconds < 3600:
+		return "%im%02is" % (seconds // 60, seconds % 60)
+	return "%ih%02im" % (seconds // 3600, seconds % 3600 // 60)
+
+
+class Plan(object):
+	def __init__(self):
+		self.items = []
+		self._urls = set()
+		self._lock = threading.Lock()
+
+	def __repr__(self):
+		return "<Plan: %i items>" % (len(self.items))
+
+	def __len__(self):
+		return len(self.items)
+
+	def add(self, kind, url, size=None):
+		"""
+		Plan the download of url (of the given kind, eg. data or index); size
+		is None if unknown. urls that are already planned are ignored.
+		"""
+		with self._lock:
+			if url in self._urls:
+				return
+			self._urls.add(url)
+			self.items.append([kind, url, size])
+
+	def resolve(self, workers=HEAD_WORKERS):
+		"Fill in the unknown sizes with concurrent HEAD requests"
+		import requests
+
+		def head(item):
+			try:
+				r = retry.fetch([item[1]], lambda url: requests.head(url, allow_redirects=True, timeout=retry.DEFAULT_POLICY.timeout), "head")
+			except retry.FetchError as e:
+				logging.warning("Could not get the size of %s: %s", item[1], e)
+				return
+			if r.status_code == 200 and "Content-Length" in r.headers:
+				item[2] = int(r.headers["Content-Length"])
+			else:
+				logging.warning("Could not get the size of %s: HTTP %r", item[1], r.status_code)
+
+		unknown = [item for item in self.items if item[2] is None]
+		if unknown:
+			logging.info("Getting the size of %i files", len(unknown))
+			with ThreadPoolExecutor(workers) as executor:
+				list(executor.map(head, unknown))
+
+	def probe(self, size=PROBE_SIZE):
+		"""
+		Measure the download throughput (in bytes/s) by fetching up to size
+		bytes of the largest planned item. Returns None if there is nothing
+		to measure.
+		"""
+		import requests
+
+		items = [item for item in self.items if item[2]]
+		if not items:
+			return None
+		kind, url, item_size = max(items, key=lambda item: item[2])
+		start = time.perf_counter()
+		try:
+			r = requests.get(url, headers={"Range": "bytes=0-%i" % (min(size, item_size) - 1)}, timeout=retry.DEFAULT_POLICY.timeout)
+		except requests.RequestException as e:
+			logging.warning("Throughput probe failed: %s", e)
+			return None
+		elapsed = time.perf_counter() - start
+		if r.status_code not in (200, 206) or not elapsed:
+			return None
+		return len(r.content) / elapsed
+
+	def totals(self):
+		"Returns an OrderedDict of kind -> (count, total size, count of unknown sizes)"
+		ret = OrderedDict()
+		for kind, url, size in self.items:
+			count, total, unknown = ret.get(kind, (0, 0, 0))
+			ret[kind] = (count + 1, total + (size or 0), unknown + (size is None))
+		return ret
+
+	@property
+	def total_size(self):
+		return sum(size or 0 for kind, url, size in self.items)
+
+	def report(self, path=None, throughput=None, rate=None):
+		"""
+		Returns the plan summary as text, with the free space at path and
+		an ETA based on throughput (capped at rate) if given.
+		"""
+		lines = []
+		count, unknown = 0, 0
+		for kind, (kind_count, size, kind_unknown) in self.totals().items():
+			lines.append("%-12s %8i files %12s" % (kind, kind_count, format_size(size)))
+			count += kind_count
+			unknown += kind_unknown
+		total = "%-12s %8i files %12s" % ("total", count, format_size(self.total_size))
+		if unknown:
+			total += " (%i of unknown size)" % (unknown)
+		lines.append(total)
+
+		if path:
+			import shutil
+
+			path = os.path.abspath(path)
+			while not os.path.exists(path) and os.path.dirname(path) != path:
+				path = os.path.dirname(path)
+			free = shutil.disk_usage(path).free
+			lines.append("Free space at %s: %s%s" % (path, format_size(free), " (NOT ENOUGH)" if free < self.total_size else ""))
+
+		if throughput:
+			speed = min(throughput, rate) if rate else throughput
+			lines.append("Throughput: %s/s, ETA %s" % (format_size(speed), format_duration(self.total_size / speed)))
+		return "\n".join(lines)
@@ -0,0 +1,85 @@
+"""
+Phase-level profiling.
+Records cProfile stats and tracemalloc peak memory for each named phase
+of a run, and writes them to a directory for later comparison:
+	<directory>/<phase>.prof (load with pstats or snakeviz)
+	<directory>/summary.json
+"""
+
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Phase(object):
+	def __init__(self, name):
+		self.name = name
+		self.profile = cProfile.Profile()
+		self.calls = 0
+		self.elapsed = 0.0
+		self.peak_memory = 0
+
+	def as_dict(self):
+		return {"calls": self.calls, "elapsed": self.elapsed, "peak_memory": self.peak_memory}
+
+
+class Profiler(object):
+	"""
+	Profiler for the phases of a run. Entering the same phase several times
+	accumulates its stats. Phases do not nest: a phase entered while another
+	one is active is counted as part of the outer phase.
+	Only the calling thread is profiled by cProfile.
+	A Profiler without a directory does nothing.
+	"""
+	def __init__(self, directory=None):
+		self.directory = directory
+		self.phases = OrderedDict()
+		self._active = None
+
+	def __repr__(self):
+		return "<Profiler at %r>" % (self.directory)
+
+	@property
+	def enabled(self):
+		return bool(self.directory)
+
+	@contextmanager
+	def phase(self, name):
+		if not self.enabled or self._active is not None:
+			yield
+			return
+
+		if name not in self.phases:
+			self.phases[name] = Phase(name)
+		phase = self.phases[name]
+
+		if not tracemalloc.is_tracing():
+			tracemalloc.start()
+		tracemalloc.reset_peak()
+		self._active = phase
+		start = time.perf_counter()
+		phase.profile.enable()
+		try:
+			yield
+		finally:
+			phase.profile.disable()
+			phase.elapsed += time.perf_counter() - start
+			phase.calls += 1
+			phase.peak_memory = max(phase.peak_memory, tracemalloc.get_traced_memory()[1])
+			self._active = None
+
+	def write(self):
+		if not self.enabled:
+			return
+
+		os.makedirs(self.directory, exist_ok=True)
+		for name, phase in self.phases.items():
+			phase.profile.dump_stats(os.path.join(self.directory, name + ".prof"))
+
+		summary = OrderedDict((name, phase.as_dict()) for name, phase in self.phases.items())
+		with open(os.path.join(self.directory, "summary.json"), "w") as f:
+			json.dump(summary, f, indent="\t")
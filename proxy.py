@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+Read-through CDN proxy serving the MPQ_BASE_DIR tree.
+Usage:
+	proxy.py --upstream level3.blizzard.com [--upstream ...] [--port 8080]
+
+Requests are mapped to the on-disk layout used by NGDPConnection and
+BaseCatalog:
+	/<path>/{config,data,patch}/xx/yy/<hash>[.index] -> NGDP/<path>/...
+	/<path>/xx/yy/<hash> -> Clog/<path>/...
+Objects that are not on disk yet are fetched from the upstream hosts,
+once: concurrent requests for the same object wait for the same fetch.
+Configs and catalogs stored compressed (see storage.py) are served
+uncompressed. Range requests are supported.
+"""
+
+import logging
+import os
+import re
+import sys
+from argparse import ArgumentParser
+from coordinator import COORDINATOR
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+import retry
+import storage
+
+
+MPQ_BASE_DIR = os.environ.get("MPQ_BASE_DIR", os.path.join(os.environ.get("XDG_DATA_HOME", os.path.join(os.path.expanduser("~"), ".local", "share")), "mpq"))
+OBJECT_REGEX = re.compile(r"^[0-9a-f]{32}(\.index)?$")
+RANGE_REGEX = re.compile(r"^bytes=(\d*)-(\d*)$")
+CHUNK_SIZE = 64 * 1024
+# Types that may be stored compressed
+TEXT_TYPES = ("config", "catalog")
+
+
+def local_path(base, url_path):
+	"""
+	Returns (type, path on disk) for a request path, or None if the path
+	is not a CDN object.
+	"""
+	parts = url_path.split("?", 1)[0].strip("/").split("/")
+	if len(parts) < 4 or not OBJECT_REGEX.match(parts[-1]) or any(part in ("", ".", "..") for part in parts):
+		return None
+	if parts[-1][:2] != parts[-3] or parts[-1][2:4] != parts[-2]:
+		return None
+
+	if len(parts) >= 5 and parts[-4] in ("config", "data", "patch"):
+		type = parts[-4]
+		if parts[-1].endswith(".index"):
+			type = "index" if type == "data" else "patch-index"
+		return type, os.path.join(base, "NGDP", *parts)
+	return "catalog", os.path.join(base, "Clog", *parts)
+
+
+def _hashers(type):
+	"Returns the hash objects that verify an object of type while it is being received"
+	if type in TEXT_TYPES:
+		return [md5()]
+	if type in ("index", "patch-index"):
+		import archiveindex
+		return [archiveindex.IndexHasher()]
+	return []
+
+
+def _verify(type, hash, hashers):
+	"Returns True if the object fed to hashers is intact (when that can be checked cheaply)"
+	if type in TEXT_TYPES:
+		return hashers[0].hexdigest() == hash
+	if type in ("index", "patch-index"):
+		return not hashers[0].error()
+	return True
+
+
+class Proxy(object):
+	def __init__(self, base, upstreams):
+		self.base = base
+		self.upstreams = upstreams
+
+	def __repr__(self):
+		return "<Proxy for %r at %r>" % (self.upstreams, self.base)
+
+	def fill(self, url_path, type, path):
+		"""
+		Fetch url_path from upstream to path. Returns the path it was stored
+		at (compressed configs and catalogs get an extension), or None if
+		upstream does not have it.
+		"""
+		import requests
+		from pipeline import Pipeline
+
+		hash = os.path.basename(path).split(".")[0]
+
+		def download(url):
+			"Stream url to path, verifying and writing it while it is being received"
+			r = requests.get(url, stream=True, timeout=retry.DEFAULT_POLICY.timeout)
+			r.pipeline = None
+			size = 0
+			if r.status_code == 200:
+				length = r.headers.get("Content-Length")
+				with Pipeline(path, _hashers(type), int(length) if length else None) as pipeline:
+					for chunk in r.iter_content(CHUNK_SIZE):
+						pipeline.feed(chunk)
+					size = pipeline.close()
+				r.pipeline = pipeline
+			metrics.request(url, type, size, r.elapsed.total_seconds(), r.status_code)
+			r.close()
+			return r
+
+		def check(r):
+			if r.pipeline is not None and not _verify(type, hash, r.pipeline.hashers):
+				metrics.verify_failure(r.url, type)
+				r.pipeline.abort()
+				return False
+			return True
+
+		urls = ["http://%s%s" % (host, url_path) for host in self.upstreams]
+		r = retry.fetch(urls, download, type, check)
+		if r.pipeline is None or r.status_code != 200:
+			return None
+		path = r.pipeline.commit()
+		if type in TEXT_TYPES and storage.COMPRESSION:
+			path = storage.compress(path, storage.COMPRESSION)
+		logging.info("Cached %r", path)
+		return path
+
+	def get(self, url_path):
+		"""
+		Returns the path on disk of the object for url_path, fetching it
+		from upstream if needed, or None if there is no such object.
+		"""
+		ret = local_path(self.base, url_path)
+		if ret is None:
+			return None
+		type, path = ret
+		if type in TEXT_TYPES:
+			path = storage.find(path) or path
+		# Hits and misses are recorded against the first upstream host
+		url = "http://%s%s" % (self.upstreams[0], url_path) if self.upstreams else "local"
+		if os.path.exists(path):
+			metrics.cache_hit(url, type)
+			return path
+
+		metrics.cache_miss(url, type)
+		if not self.upstreams:
+			return None
+		return COORDINATOR.do(path, self.fill, url_path, type, path)
+
+
+def _parse_range(header, size):
+	"Returns the (start, end) byte range (end excluded) of a Range header, or None if it cannot be satisfied"
+	sre = RANGE_REGEX.match(header.strip())
+	if not sre or sre.groups() == ("", ""):
+		return None
+	start, end = sre.groups()
+	if not start:
+		# Suffix range: the last `end` bytes
+		start, end = max(size - int(end), 0), size
+	else:
+		start, end = int(start), min(int(end) + 1, size) if end else size
+	if start >= size or start >= end:
+		return None
+	return start, end
+
+
+def make_handler(proxy):
+	class Handler(BaseHTTPRequestHandler):
+		protocol_version = "HTTP/1.1"
+
+		def log_message(self, format, *args):
+			logging.debug("%s - %s", self.address_string(), format % args)
+
+		def do_HEAD(self):
+			self.serve(body=False)
+
+		def do_GET(self):
+			self.serve(body=True)
+
+		def serve(self, body):
+			try:
+				path = proxy.get(self.path)
+			except retry.FetchError as e:
+				logging.error("Could not fetch %r: %s", self.path, e)
+				return self.send_error(502)
+			if path is None:
+				return self.send_error(404)
+
+			with storage.open(path) as f:
+				size = f.seek(0, os.SEEK_END)
+				f.seek(0)
+				start, end = 0, size
+				if "Range" in self.headers:
+					byte_range = _parse_range(self.headers["Range"], size)
+					if byte_range is None:
+						self.send_response(416)
+						self.send_header("Content-Range", "bytes */%i" % (size))
+						self.send_header("Content-Length", "0")
+						self.end_headers()
+						return
+					start, end = byte_range
+					self.send_response(206)
+					self.send_header("Content-Range", "bytes %i-%i/%i" % (start, end - 1, size))
+				else:
+					self.send_response(200)
+				self.send_header("Content-Type", "application/octet-stream")
+				self.send_header("Content-Length", str(end - start))
+				self.send_header("Accept-Ranges", "bytes")
+				self.end_headers()
+				if not body:
+					return
+
+				f.seek(start)
+				remaining = end - start
+				while remaining > 0:
+					chunk = f.read(min(CHUNK_SIZE, remaining))
+					if not chunk:
+						break
+					self.wfile.write(chunk)
+					remaining -= len(chunk)
+
+	return Handler
+
+
+def serve(proxy, bind="", port=8080):
+	server = ThreadingHTTPServer((bind, port), make_handler(proxy))
+	server.daemon_threads = True
+	return server
+
+
+def main():
+	logging.basicConfig(level=logging.INFO)
+	arguments = ArgumentParser(prog="proxy")
+	arguments.add_argument("--bind", type=str, dest="bind", default="", help="address to listen on (defaults to all)")
+	arguments.add_argument("--port", type=int, dest="port", default=8080, help="port to listen on")
+	arguments.add_argument("--base", type=str, dest="base", default=MPQ_BASE_DIR, help="base directory of the mirror")
+	arguments.add_argument("--upstream", type=str, dest="upstreams", action="append", default=[], help="upstream CDN host to fill misses from (can be repeated)")
+	metrics.add_arguments(arguments)
+	args = arguments.parse_args(sys.argv[1:])
+
+	proxy = Proxy(args.base, args.upstreams)
+	server = serve(proxy, args.bind, args.port)
+	logging.info("Serving %r on port %i", proxy, args.port)
+	with metrics.writer(args):
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.server_close()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,174 @@
+"""
+Retries with exponential backoff and per-host circuit breakers.
+
+Transient failures (connection errors, timeouts, 5xx/429 responses and
+content that fails verification) are retried with full-jitter
+exponential backoff. Every failure is counted against the host that
+served it; after `threshold` consecutive failures the host's breaker
+opens and requests go to the other hosts serving the same object until
+`cooldown` seconds have passed (or until every host is failing).
+"""
+
+import logging
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import metrics
+
+
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+
+class FetchError(IOError):
+	pass
+
+
+class RetryPolicy(object):
+	def __init__(self, attempts=5, backoff=0.5, max_backoff=30, timeout=60):
+		self.attempts = attempts
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.timeout = timeout
+
+	def __repr__(self):
+		return "<RetryPolicy: %i attempts>" % (self.attempts)
+
+	def delay(self, attempt):
+		"Seconds to wait after the given (0-based) failed attempt"
+		return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+	"""
+	Opens after threshold consecutive failures. Once cooldown seconds have
+	passed, requests are let through again; the first success closes the
+	breaker and another failure opens it for a new cooldown.
+	"""
+	def __init__(self, host, threshold=5, cooldown=30):
+		self.host = host
+		self.threshold = threshold
+		self.cooldown = cooldown
+		self.failures = 0
+		self.opened = None
+		self._lock = threading.Lock()
+
+	def __repr__(self):
+		return "<CircuitBreaker for %r: %s>" % (self.host, "open" if self.opened else "closed")
+
+	def remaining(self):
+		"Seconds until requests are let through again"
+		with self._lock:
+			if self.opened is None:
+				return 0
+			return max(0, self.opened + self.cooldown - time.monotonic())
+
+	def allow(self):
+		return self.remaining() == 0
+
+	def success(self):
+		with self._lock:
+			self.failures = 0
+			self.opened = None
+
+	def failure(self):
+		with self._lock:
+			self.failures += 1
+			if self.failures < self.threshold:
+				return
+			if self.opened is None:
+				logging.warning("Too many failures from %r, avoiding it for %is", self.host, self.cooldown)
+				metrics.circuit_opened(self.host)
+			self.opened = time.monotonic()
+
+
+DEFAULT_POLICY = RetryPolicy()
+_breakers = {}
+_lock = threading.Lock()
+
+
+def breaker(url):
+	"Returns the CircuitBreaker of the host of url"
+	host = urlparse(url).netloc or url
+	with _lock:
+		if host not in _breakers:
+			_breakers[host] = CircuitBreaker(host)
+		return _breakers[host]
+
+
+def _pick(urls, attempt):
+	candidates = [url for url in urls if breaker(url).allow()]
+	if candidates:
+		# Spread the retries over the healthy hosts
+		return candidates[attempt % len(candidates)]
+
+	# Every host is failing: keep retrying (with backoff) the one that
+	# will recover first rather than stalling for the whole cooldown
+	return min(urls, key=lambda url: breaker(url).remaining())
+
+
+def _transient(error):
+	"""
+	Returns True if error is a network error, worth retrying. Local errors
+	(eg. a full disk while writing the download, or a bug in a callback)
+	are not, and must not count against the host.
+	"""
+	# Imported here to keep them off the start-up path of the tools
+	import socket
+	from http.client import HTTPException
+	from urllib.error import URLError
+
+	if isinstance(error, (ConnectionError, socket.timeout, URLError, HTTPException)):
+		return True
+	# Only check for requests exceptions if requests is in use
+	requests = sys.modules.get("requests")
+	return requests is not None and isinstance(error, requests.RequestException)
+
+
+def _status(response):
+	return getattr(response, "status_code", getattr(response, "status", 200))
+
+
+def fetch(urls, get, type="", check=None, policy=None):
+	"""
+	Returns get(url) for one of urls (the same object on several hosts),
+	retrying transient failures on the healthiest hosts.
+	If check is given, responses for which it returns False are retried
+	as well. Errors that are not transient (eg. a HTTPError 404, or errors
+	that are not network errors) are raised as is; FetchError is raised
+	once all attempts have failed.
+	"""
+	policy = policy or DEFAULT_POLICY
+	error = None
+	for attempt in range(policy.attempts):
+		url = _pick(urls, attempt)
+		host = breaker(url)
+		try:
+			r = get(url)
+		except Exception as e:
+			if not _transient(e):
+				raise
+			code = getattr(e, "code", None)
+			if code is not None and code not in RETRY_STATUSES:
+				host.success()
+				raise
+			error = "%s: %s" % (url, e)
+		else:
+			if _status(r) in RETRY_STATUSES:
+				error = "%s: HTTP %i" % (url, _status(r))
+			elif check is not None and _status(r) < 400 and not check(r):
+				error = "%s: verification failed" % (url)
+			else:
+				host.success()
+				return r
+
+		host.failure()
+		if attempt + 1 < policy.attempts:
+			metrics.retry(url, type)
+			delay = policy.delay(attempt)
+			logging.warning("Attempt %i/%i failed (%s), retrying in %.1fs", attempt + 1, policy.attempts, error, delay)
+			time.sleep(delay)
+
+	raise FetchError("Giving up after %i attempts: %s" % (policy.attempts, error))
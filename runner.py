@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 
+import logging
 import os
+import sys
 import bpp
+import metrics
+from argparse import ArgumentParser
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from plan import Plan
 
 
 def humanizedsize(bytes, precision=1):
@@ -26,265 +33,299 @@ def humanizedsize(bytes, precision=1):
 MPQ_BASE_DIR = os.environ.get("MPQ_BASE_DIR", os.path.join(os.environ.get("XDG_DATA_HOME", os.path.join(os.path.expanduser("~"), ".local", "share")), "mpq"))
 
 
-def cache_blob(blob):
-	base = os.path.join(MPQ_BASE_DIR, blob.program, blob.base.split("/")[-2])
-	path = os.path.join(base, blob.name())
-	blob.cache(path)
-
+def blob_path(blob):
+	return os.path.join(MPQ_BASE_DIR, blob.program, blob.base.split("/")[-2], blob.name())
 
-def main():
-	records = []
 
-	live = bpp.BPPConnection(program="Release1")
-	live.addRecord(program="Agnt", component="blob", version="1")
-	live.addRecord(program="Agnt", component="cdn", version="1")
-	live.addRecord(program="Agnt", component="cfg", version="1")
-	live.addRecord(program="Agnt", component="Win", version="1")
-
-	live.addRecord(program="Bnet", component="Win", version="1")
-
-	live.addRecord(program="Clnt", component="blob", version="1")
-	live.addRecord(program="Clnt", component="Win", version="1")
-
-	live.addRecord(program="dgst", component="blob", version="1")
-	live.addRecord(program="dgst", component="blob", version="3")
-
-	live.addRecord(program="bd3", component="Win", version="1")
-	live.addRecord(program="BD3R", component="Win", version="1")
-	live.addRecord(program="BS2R", component="Win", version="1")
-	live.addRecord(program="BWWR", component="Win", version="1")
-	live.addRecord(program="BBNR", component="Win", version="1")
-	live.addRecord(program="BCLT", component="blob", version="1")
-	live.addRecord(program="D3", component="blob", version="1")
-	live.addRecord(program="D3", component="enUS", version="1")
-	live.addRecord(program="D3T", component="enUS", version="2")
-
-	live.addRecord(program="bs2", component="Win", version="1")
-	live.addRecord(program="S2", component="enUS", version="1")
-	live.addRecord(program="S2", component="blob", version="1")
-
-	live.addRecord(program="bwow", component="Win", version="1")
-	live.addRecord(program="WoW", component="Win", version="1")
-	live.addRecord(program="WoW", component="enUS", version="1")
-	live.addRecord(program="WoW", component="enUS", version="3")
-	live.addRecord(program="WoW", component="enUS", version="4")
-	live.addRecord(program="WoW", component="blob", version="1")
-
-	live.addRecord(program="HSB", component="enUS", version="1")
-	live.addRecord(program="HSB", component="blob", version="1")
-
-	records += live.open("http://enUS.patch.battle.net:1119/patch")
-
-	liveEU = bpp.BPPConnection(program="Release2")
-	liveEU.addRecord(program="Agnt", component="blob", version="1")
-	liveEU.addRecord(program="Agnt", component="cdn", version="1")
-	liveEU.addRecord(program="Agnt", component="cfg", version="1")
-	liveEU.addRecord(program="Agnt", component="Win", version="1")
-
-	liveEU.addRecord(program="Bnet", component="Win", version="1")
-
-	liveEU.addRecord(program="Clnt", component="blob", version="1")
-	liveEU.addRecord(program="Clnt", component="Win", version="1")
-
-	liveEU.addRecord(program="dgst", component="blob", version="1")
-	liveEU.addRecord(program="dgst", component="blob", version="3")
-
-	liveEU.addRecord(program="bd3", component="Win", version="1")
-	liveEU.addRecord(program="BD3R", component="Win", version="1")
-	liveEU.addRecord(program="BS2R", component="Win", version="1")
-	liveEU.addRecord(program="BWWR", component="Win", version="1")
-	liveEU.addRecord(program="BBNR", component="Win", version="1")
-	liveEU.addRecord(program="BCLT", component="blob", version="1")
-	liveEU.addRecord(program="D3", component="blob", version="1")
-	liveEU.addRecord(program="D3", component="enUS", version="1")
-	liveEU.addRecord(program="D3T", component="enUS", version="2")
-
-	liveEU.addRecord(program="bs2", component="Win", version="1")
-	liveEU.addRecord(program="S2", component="enUS", version="1")
-	liveEU.addRecord(program="S2", component="blob", version="1")
-
-	liveEU.addRecord(program="bwow", component="Win", version="1")
-	liveEU.addRecord(program="WoW", component="Win", version="1")
-	liveEU.addRecord(program="WoW", component="enUS", version="1")
-	#liveEU.addRecord(program="WoW", component="enUS", version="3") # causes 400 on enGB only
-	liveEU.addRecord(program="WoW", component="enUS", version="4")
-	liveEU.addRecord(program="WoW", component="blob", version="1")
-
-	liveEU.addRecord(program="HSB", component="enUS", version="1")
-	liveEU.addRecord(program="HSB", component="blob", version="1")
-
-	records += liveEU.open("http://enGB.patch.battle.net:1119/patch")
-
-
-	liveMac = bpp.BPPConnection(program="Release1Mac")
-	liveMac.addRecord(program="Agnt", component="Mac", version="1")
-	liveMac.addRecord(program="Bnet", component="Mac", version="1")
-	liveMac.addRecord(program="Clnt", component="Mac", version="1")
-
-	liveMac.addRecord(program="bwow", component="Mac", version="1")
-	liveMac.addRecord(program="WoW", component="Mac", version="1")
-
-	liveMac.addRecord(program="bd3", component="Mac", version="1")
-	liveMac.addRecord(program="bs2", component="Mac", version="1")
-	liveMac.addRecord(program="BD3R", component="Mac", version="1")
-	liveMac.addRecord(program="BS2R", component="Mac", version="1")
-	liveMac.addRecord(program="BWWR", component="Mac", version="1")
-	liveMac.addRecord(program="BBNR", component="Mac", version="1")
-
-	records += liveMac.open("http://enUS.patch.battle.net:1119/patch")
-
-
-	ptr = bpp.BPPConnection(program="Test1")
-	ptr.addRecord(program="Agnt", component="blob", version="1")
-	ptr.addRecord(program="Agnt", component="cfg", version="1")
-	ptr.addRecord(program="Agnt", component="cdn", version="1")
-	ptr.addRecord(program="AgtB", component="blob", version="1")
-	ptr.addRecord(program="AgtB", component="Win", version="1")
-	ptr.addRecord(program="Bnet", component="Win", version="1")
-	ptr.addRecord(program="Clnt", component="blob", version="1")
-
-	# ptr.addRecord(program="Clog", component="PUB", version="1")
-	# ptr.addRecord(program="Clog", component="PUB", version="2")
-	# ptr.addRecord(program="Clog", component="PUB", version="3")
-	# ptr.addRecord(program="Clog", component="PUB", version="4")
-	# ptr.addRecord(program="Clog", component="PUB", version="5")
-	ptr.addRecord(program="Clog", component="PUB", version="6")
-	ptr.addRecord(program="Clog", component="PUB", version="7")
-	ptr.addRecord(program="Clog", component="PUB", version="8")
-	ptr.addRecord(program="Clog", component="PUB", version="9")
-	ptr.addRecord(program="Clog", component="PUB", version="10")
-	ptr.addRecord(program="Clog", component="PUB", version="11")
-	ptr.addRecord(program="Clog", component="PUB", version="12")
-	ptr.addRecord(program="Clog", component="PUB", version="13")
-
-	ptr.addRecord(program="dgst", component="blob", version="1")
-	ptr.addRecord(program="dgst", component="blob", version="3")
-
-	ptr.addRecord(program="D3", component="blob", version="1")
-	ptr.addRecord(program="D3", component="enUS", version="1")
-	ptr.addRecord(program="D3B", component="blob", version="1")
-	ptr.addRecord(program="D3B", component="enUS", version="3")
-	ptr.addRecord(program="D3T", component="blob", version="1")
-	ptr.addRecord(program="D3T", component="enUS", version="2")
-
-	ptr.addRecord(program="S2", component="blob", version="1")
-	ptr.addRecord(program="S2B", component="enUS", version="3")
-	ptr.addRecord(program="S2B", component="blob", version="1")
-	ptr.addRecord(program="S2T", component="blob", version="1")
-
-	ptr.addRecord(program="bwow", component="Win", version="1")
-	ptr.addRecord(program="WoW", component="blob", version="1")
-	ptr.addRecord(program="WoW", component="enUS", version="1")
-	ptr.addRecord(program="WoWT", component="enUS", version="1")
-	ptr.addRecord(program="WoWB", component="enUS", version="1")
-	ptr.addRecord(program="WoWB", component="enUS", version="3")
-
-	ptr.addRecord(program="HSB", component="blob", version="1")
-	ptr.addRecord(program="HSB", component="enUS", version="1")
-	ptr.addRecord(program="TCGB", component="blob", version="1")
-
-	records += ptr.open("http://public-test.patch.battle.net:1119/patch")
-
-
-	ptr2 = bpp.BPPConnection(program="Test2")
-	ptr2.addRecord(program="Bnet", component="Win", version="2")
-	ptr2.addRecord(program="WoW", component="enUS", version="2")
-	ptr2.addRecord(program="WoWT", component="enUS", version="2")
-
-	records += ptr2.open("http://public-test.patch.battle.net:1119/patch")
-
-
-	ptrMac = bpp.BPPConnection(program="Test2")
-
-	ptrMac.addRecord(program="AgtB", component="Mac", version="1")
-	ptrMac.addRecord(program="Bnet", component="Mac", version="1")
-	ptrMac.addRecord(program="BnaB", component="Mac", version="1")
-	ptrMac.addRecord(program="BD3T", component="Mac", version="1")
-	ptrMac.addRecord(program="BD3B", component="Mac", version="1")
-	ptrMac.addRecord(program="BS2B", component="Mac", version="1")
-	ptrMac.addRecord(program="BWWT", component="Mac", version="1")
-	ptrMac.addRecord(program="BWWB", component="Mac", version="1")
-	ptrMac.addRecord(program="BTCB", component="Mac", version="1")
-	ptrMac.addRecord(program="BBNB", component="Mac", version="1")
-
-	records += ptrMac.open("http://public-test.patch.battle.net:1119/patch")
-
-	# Set a default CDN
-	cdn = "dist.blizzard.com.edgesuite.net"
-
-	for record in records:
-		print("%s->%s" % (record.program, record.component))
-
-		if record.component == "enUS":
-			miss, hit = [], []
-			patch = bpp.MFILPatch(*record.text.split(";"))
-			try:
-				patch.configure(program=record.program, server="akamai")
-			except bpp.ServerError as e:
-				print(e)
-				continue
-			bases, files = patch.getDirectDownload()
-			base = bases[0]
-
-			baseDir = os.path.join(MPQ_BASE_DIR, record.program, base.split("/")[-2])
-
-			for file in files:
-				local = os.path.join(baseDir, file.path)
-				remote = base + file.path
-				if os.path.exists(local):
-					hit.append((remote, local, file))
-				else:
-					miss.append((remote, local, file))
-
-			fmt = "curl --progress-bar --create-dirs --fail {remote} -o {local} &&"
-			for remote, local, file in miss:
-				print(fmt.format(remote=remote, local=local))
-
-			for remote, local, file in hit:
-				localsize = os.path.getsize(local)
-				if localsize != file.size:
-					print("WARNING: %i != %i for %s at %s" % (localsize, file.size, remote, local))
-
-		if record.component == "blob":
-			base, installHash, gameHash, _ = record.text.split(";")
-
-			if base == "Bna":
-				_, base, win, osx = record.text.split(";")
-				baseDir = os.path.join(MPQ_BASE_DIR, "Clog", "bna", *base.split("/")[4:-1])
-				for name in win, osx:
-					blob = bpp.SimpleResource(base, name)
-					path = os.path.join(baseDir, name)
-					blob.cache(path)
+def cache_blob(blob):
+	blob.cache(blob_path(blob), verify=True)
+
+
+ENUS = "http://enUS.patch.battle.net:1119/patch"
+ENGB = "http://enGB.patch.battle.net:1119/patch"
+PUBLIC_TEST = "http://public-test.patch.battle.net:1119/patch"
+DEFAULT_CDN = "dist.blizzard.com.edgesuite.net"
+WORKERS = 8
+
+RELEASE_RECORDS = (
+	("Agnt", "blob", "1"),
+	("Agnt", "cdn", "1"),
+	("Agnt", "cfg", "1"),
+	("Agnt", "Win", "1"),
+
+	("Bnet", "Win", "1"),
+
+	("Clnt", "blob", "1"),
+	("Clnt", "Win", "1"),
+
+	("dgst", "blob", "1"),
+	("dgst", "blob", "3"),
+
+	("bd3", "Win", "1"),
+	("BD3R", "Win", "1"),
+	("BS2R", "Win", "1"),
+	("BWWR", "Win", "1"),
+	("BBNR", "Win", "1"),
+	("BCLT", "blob", "1"),
+	("D3", "blob", "1"),
+	("D3", "enUS", "1"),
+	("D3T", "enUS", "2"),
+
+	("bs2", "Win", "1"),
+	("S2", "enUS", "1"),
+	("S2", "blob", "1"),
+
+	("bwow", "Win", "1"),
+	("WoW", "Win", "1"),
+	("WoW", "enUS", "1"),
+	("WoW", "enUS", "3"),
+	("WoW", "enUS", "4"),
+	("WoW", "blob", "1"),
+
+	("HSB", "enUS", "1"),
+	("HSB", "blob", "1"),
+)
+
+# (server, program, records)
+SWEEP = (
+	(ENUS, "Release1", RELEASE_RECORDS),
+	# WoW enUS 3 causes 400 on enGB only
+	(ENGB, "Release2", tuple(r for r in RELEASE_RECORDS if r != ("WoW", "enUS", "3"))),
+	(ENUS, "Release1Mac", (
+		("Agnt", "Mac", "1"),
+		("Bnet", "Mac", "1"),
+		("Clnt", "Mac", "1"),
+
+		("bwow", "Mac", "1"),
+		("WoW", "Mac", "1"),
+
+		("bd3", "Mac", "1"),
+		("bs2", "Mac", "1"),
+		("BD3R", "Mac", "1"),
+		("BS2R", "Mac", "1"),
+		("BWWR", "Mac", "1"),
+		("BBNR", "Mac", "1"),
+	)),
+	(PUBLIC_TEST, "Test1", (
+		("Agnt", "blob", "1"),
+		("Agnt", "cfg", "1"),
+		("Agnt", "cdn", "1"),
+		("AgtB", "blob", "1"),
+		("AgtB", "Win", "1"),
+		("Bnet", "Win", "1"),
+		("Clnt", "blob", "1"),
+
+		# ("Clog", "PUB", "1"),
+		# ("Clog", "PUB", "2"),
+		# ("Clog", "PUB", "3"),
+		# ("Clog", "PUB", "4"),
+		# ("Clog", "PUB", "5"),
+		("Clog", "PUB", "6"),
+		("Clog", "PUB", "7"),
+		("Clog", "PUB", "8"),
+		("Clog", "PUB", "9"),
+		("Clog", "PUB", "10"),
+		("Clog", "PUB", "11"),
+		("Clog", "PUB", "12"),
+		("Clog", "PUB", "13"),
+
+		("dgst", "blob", "1"),
+		("dgst", "blob", "3"),
+
+		("D3", "blob", "1"),
+		("D3", "enUS", "1"),
+		("D3B", "blob", "1"),
+		("D3B", "enUS", "3"),
+		("D3T", "blob", "1"),
+		("D3T", "enUS", "2"),
+
+		("S2", "blob", "1"),
+		("S2B", "enUS", "3"),
+		("S2B", "blob", "1"),
+		("S2T", "blob", "1"),
+
+		("bwow", "Win", "1"),
+		("WoW", "blob", "1"),
+		("WoW", "enUS", "1"),
+		("WoWT", "enUS", "1"),
+		("WoWB", "enUS", "1"),
+		("WoWB", "enUS", "3"),
+
+		("HSB", "blob", "1"),
+		("HSB", "enUS", "1"),
+		("TCGB", "blob", "1"),
+	)),
+	(PUBLIC_TEST, "Test2", (
+		("Bnet", "Win", "2"),
+		("WoW", "enUS", "2"),
+		("WoWT", "enUS", "2"),
+	)),
+	(PUBLIC_TEST, "Test2", (
+		("AgtB", "Mac", "1"),
+		("Bnet", "Mac", "1"),
+		("BnaB", "Mac", "1"),
+		("BD3T", "Mac", "1"),
+		("BD3B", "Mac", "1"),
+		("BS2B", "Mac", "1"),
+		("BWWT", "Mac", "1"),
+		("BWWB", "Mac", "1"),
+		("BTCB", "Mac", "1"),
+		("BBNB", "Mac", "1"),
+	)),
+)
+
+
+def query(sweep, executor):
+	"""
+	Send all the BPP requests in the sweep concurrently and return
+	the deduplicated response records, in sweep order, as (record, cdn)
+	tuples. cdn is the one announced by the "cdn" record of the same
+	server and program as the record, or DEFAULT_CDN.
+	"""
+	batch = bpp.BPPBatch()
+	for server, program, records in sweep:
+		conn = bpp.BPPConnection(program=program)
+		for record in records:
+			conn.addRecord(*record)
+		batch.add(conn, server)
+
+	responses = []
+	cdns = {}
+	for (server, program, _), records in zip(sweep, batch.open(executor=executor).values()):
+		responses.append(((server, program), records))
+		for record in records:
+			if record.component == "cdn":
+				# Example text: "dist.blizzard.com.edgesuite.net|llnw.blizzard.com"
+				cdns.setdefault((server, program), record.text.split("|")[0])
+
+	ret = OrderedDict()
+	for key, records in responses:
+		for record in records:
+			if record not in ret:
+				ret[record] = cdns.get(key, DEFAULT_CDN)
+	return list(ret.items())
+
+
+def process_mfil(record, plan=None):
+	ret = []
+	miss, hit = [], []
+	patch = bpp.MFILPatch(*record.text.split(";"))
+	try:
+		patch.configure(program=record.program, server="akamai")
+	except bpp.ServerError as e:
+		return [str(e)]
+	bases, files = patch.getDirectDownload()
+	base = bases[0]
+
+	baseDir = os.path.join(MPQ_BASE_DIR, record.program, base.split("/")[-2])
+
+	for file in files:
+		local = os.path.join(baseDir, file.path)
+		remote = base + file.path
+		if os.path.exists(local):
+			hit.append((remote, local, file))
+		else:
+			miss.append((remote, local, file))
+
+	if plan is not None:
+		for remote, local, file in miss:
+			plan.add("file", remote, file.size)
+		miss = []
+
+	fmt = "curl --progress-bar --create-dirs --fail {remote} -o {local} &&"
+	for remote, local, file in miss:
+		ret.append(fmt.format(remote=remote, local=local))
+
+	for remote, local, file in hit:
+		localsize = os.path.getsize(local)
+		if localsize != file.size:
+			ret.append("WARNING: %i != %i for %s at %s" % (localsize, file.size, remote, local))
+
+	return ret
+
+
+def process_blob(record, plan=None):
+	base, installHash, gameHash, _ = record.text.split(";")
+
+	if base == "Bna":
+		_, base, win, osx = record.text.split(";")
+		baseDir = os.path.join(MPQ_BASE_DIR, "Clog", "bna", *base.split("/")[4:-1])
+		for name in win, osx:
+			blob = bpp.SimpleResource(base, name)
+			path = os.path.join(baseDir, name)
+			if plan is not None:
+				if not os.path.exists(path):
+					plan.add("blob", blob.url())
 				continue
+			blob.cache(path)
+		return []
+
+	elif not base.startswith("http"):
+		return ["Skipping %r: %r" % (base, record.text)]
+
+	blobs = [bpp.Blob(base, gameHash, "game", record.program)]
+	if installHash and installHash != "00000000000000000000000000000000":
+		blobs.append(bpp.Blob(base, installHash, "install", record.program))
+
+	ret = []
+	for blob in blobs:
+		if plan is not None:
+			if not os.path.exists(blob_path(blob)):
+				plan.add("blob", blob.url())
+			continue
+		try:
+			cache_blob(blob)
+		except bpp.ServerError as e:
+			ret.append(str(e))
+	return ret
+
+
+def process(record, cdn, plan=None):
+	"""
+	Process a BPP response record. If a Plan is given, the files that
+	would be downloaded are added to it instead (catalogs are still cached).
+	"""
+	ret = ["%s->%s" % (record.program, record.component)]
 
-			elif not base.startswith("http"):
-				print("Skipping %r: %r" % (base, record.text))
-				continue
+	if record.component == "enUS":
+		ret += process_mfil(record, plan)
 
-			gameBlob = bpp.Blob(base, gameHash, "game", record.program)
-			cache_blob(gameBlob)
+	if record.component == "blob":
+		ret += process_blob(record, plan)
 
-			if installHash and installHash != "00000000000000000000000000000000":
-				installBlob = bpp.Blob(base, installHash, "install", record.program)
-				cache_blob(installBlob)
+	if record.component == "cfg":
+		# deprecated, empty
+		ret.append(record.text)
 
-		if record.component == "cdn":
-			# Example text: "dist.blizzard.com.edgesuite.net|llnw.blizzard.com"
-			cdn = record.text.split("|")[0]
+	if record.component == "PUB" and record.program == "Clog":
+		path, hash = record.text.split(";")
+		clog = bpp.Catalog(cdn, path, hash, save_path=MPQ_BASE_DIR)
+		clog.preload()
 
-		if record.component == "cfg":
-			# deprecated, empty
-			print(record.text)
+	return ret
 
-		if record.component == "Win":
-			if record.text.count(";") == 3:
-				pass
-			#resource = bpp.SimpleResource(base, name)
 
-		if record.component == "PUB" and record.program == "Clog":
-			path, hash = record.text.split(";")
-			clog = bpp.Catalog(cdn, path, hash, save_path=MPQ_BASE_DIR)
-			clog.preload()
+def main():
+	logging.basicConfig(level=logging.DEBUG)
+	arguments = ArgumentParser(prog="runner")
+	metrics.add_arguments(arguments)
+	arguments.add_argument("--plan", action="store_true", dest="plan", help="only print what would be downloaded, with its size and an estimate of how long it would take")
+	args = arguments.parse_args(sys.argv[1:])
+
+	with metrics.writer(args):
+		plan = Plan() if args.plan else None
+		sweep(plan)
+		if plan is not None:
+			plan.resolve()
+			print(plan.report(MPQ_BASE_DIR, plan.probe()))
+
+
+def sweep(plan=None):
+	with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+		records = query(SWEEP, executor)
+		for lines in executor.map(lambda item: process(item[0], item[1], plan), records):
+			for line in lines:
+				print(line)
 
 
 if __name__ == "__main__":
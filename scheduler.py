@@ -0,0 +1,221 @@
+"""
+Prioritizing download scheduler with bandwidth caps.
+
+Tasks are run by a pool of worker threads in priority order (configs,
+then indexes, then archives), round-robin across products within the same
+priority. Transfers are throttled by token buckets, globally and per host;
+config transfers are never made to wait for tokens, so critical metadata
+keeps flowing while a bulk mirror saturates the cap.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from urllib.parse import urlparse
+
+
+CONFIG = 0
+INDEX = 1
+ARCHIVE = 2
+
+PRIORITIES = {
+	"versions": CONFIG,
+	"cdns": CONFIG,
+	"blobs": CONFIG,
+	"config": CONFIG,
+	"catalog": CONFIG,
+	"index": INDEX,
+	"patch-index": INDEX,
+	"data": ARCHIVE,
+	"patch": ARCHIVE,
+}
+
+
+def priority_for(type):
+	return PRIORITIES.get(type, INDEX)
+
+
+def parse_rate(text):
+	"Parse a rate in bytes per second, with an optional K, M or G suffix (eg. 10M)"
+	text = str(text).strip().upper()
+	if text.endswith("/S"):
+		text = text[:-2]
+	if text.endswith("B"):
+		text = text[:-1]
+	factors = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+	if text and text[-1] in factors:
+		return int(float(text[:-1]) * factors[text[-1]])
+	return int(text)
+
+
+class Response(object):
+	"""
+	A response read through Scheduler.get(): the url, status_code, headers
+	and content of the streamed requests Response, as the content of that
+	one cannot be set.
+	"""
+	def __init__(self, response, content):
+		self.url = response.url
+		self.status_code = response.status_code
+		self.headers = response.headers
+		self.encoding = response.encoding
+		self.content = content
+
+	def __repr__(self):
+		return "<Response [%i]: %r>" % (self.status_code, self.url)
+
+	@property
+	def text(self):
+		return self.content.decode(self.encoding or "utf-8", "replace")
+
+
+class TokenBucket(object):
+	"""
+	Token bucket refilled at rate bytes per second, holding at most burst bytes.
+	Consumers debit what they used and sleep off any deficit.
+	"""
+	def __init__(self, rate, burst=None):
+		self.rate = rate
+		self.burst = burst or rate
+		self.tokens = self.burst
+		self.updated = time.monotonic()
+		self._lock = threading.Lock()
+
+	def __repr__(self):
+		return "<TokenBucket: %i bytes/s>" % (self.rate)
+
+	def consume(self, amount, wait=True):
+		with self._lock:
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			self.tokens -= amount
+			deficit = -self.tokens
+
+		if wait and deficit > 0:
+			time.sleep(deficit / self.rate)
+
+
+class Scheduler(object):
+	"""
+	Runs submitted tasks on `workers` threads, plus `reserved` threads that
+	only pick up config and index tasks so that they never queue behind
+	long archive downloads.
+	"""
+	CHUNK_SIZE = 64 * 1024
+
+	def __init__(self, workers=4, rate=None, host_rate=None, reserved=1):
+		self.rate = TokenBucket(rate) if rate else None
+		self.host_rate = host_rate
+		self._hosts = {}
+		self._queues = {}
+		self._cond = threading.Condition()
+		self._shutdown = False
+		self._threads = []
+		for i in range(workers):
+			self._start(ARCHIVE)
+		for i in range(reserved):
+			self._start(INDEX)
+
+	def __repr__(self):
+		return "<Scheduler: %i workers>" % (len(self._threads))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.shutdown()
+
+	def _start(self, max_priority):
+		thread = threading.Thread(target=self._work, args=(max_priority, ), daemon=True)
+		thread.start()
+		self._threads.append(thread)
+
+	def _pop(self, max_priority):
+		"Pop the next task, round-robin across products. Must hold _cond."
+		for priority in sorted(self._queues):
+			if priority > max_priority:
+				break
+			products = self._queues[priority]
+			product, tasks = next(iter(products.items()))
+			task = tasks.popleft()
+			del products[product]
+			if tasks:
+				# Put the product at the back of the line
+				products[product] = tasks
+			if not products:
+				del self._queues[priority]
+			return task
+
+	def _work(self, max_priority):
+		while True:
+			with self._cond:
+				while True:
+					task = self._pop(max_priority)
+					if task is not None or self._shutdown:
+						break
+					self._cond.wait()
+			if task is None:
+				return
+
+			future, fn, args, kwargs = task
+			if not future.set_running_or_notify_cancel():
+				continue
+			try:
+				future.set_result(fn(*args, **kwargs))
+			except BaseException as e:
+				future.set_exception(e)
+
+	def submit(self, fn, *args, priority=ARCHIVE, product=None, **kwargs):
+		future = Future()
+		with self._cond:
+			if self._shutdown:
+				raise RuntimeError("Cannot submit to a scheduler that was shut down")
+			products = self._queues.setdefault(priority, OrderedDict())
+			products.setdefault(product, deque()).append((future, fn, args, kwargs))
+			self._cond.notify_all()
+		return future
+
+	def throttle(self, url, amount, priority=ARCHIVE):
+		"Account for amount bytes transferred from url, sleeping as needed to honour the caps"
+		wait = priority != CONFIG
+		if self.host_rate:
+			host = urlparse(url).netloc
+			with self._cond:
+				if host not in self._hosts:
+					self._hosts[host] = TokenBucket(self.host_rate)
+				bucket = self._hosts[host]
+			bucket.consume(amount, wait)
+		if self.rate:
+			self.rate.consume(amount, wait)
+
+	def get(self, url, type, headers=None, timeout=None):
+		"""
+		GET url, throttled according to the priority of type.
+		Returns a Response with its content read.
+		"""
+		import requests
+		r = requests.get(url, headers=headers, stream=True, timeout=timeout)
+		try:
+			content = b"".join(self.iter_content(r, url, type))
+		finally:
+			r.close()
+		return Response(r, content)
+
+	def iter_content(self, r, url, type):
+		"Yields the content of the streamed response r in chunks, throttled according to the priority of type"
+		priority = priority_for(type)
+		for chunk in r.iter_content(self.CHUNK_SIZE):
+			self.throttle(url, len(chunk), priority)
+			yield chunk
+
+	def shutdown(self, wait=True):
+		with self._cond:
+			self._shutdown = True
+			self._cond.notify_all()
+		if wait:
+			for thread in self._threads:
+				thread.join()
+		logging.debug("%r shut down", self)
@@ -1,36 +1,143 @@
-from io import StringIO
+import re
+from binascii import hexlify
+from hashlib import md5
 
+import storage
+from lru import LRUCache
+
+
+HASH_LIST_REGEX = re.compile(r"[0-9a-f]{32}(?: [0-9a-f]{32})*", re.I)
+CACHE_SIZE = 256
+
+_cache = LRUCache(CACHE_SIZE)
+
+
+class HashArray(object):
+	"""
+	Compact array of 16-byte md5 digests, as found in config hash lists
+	(eg. cdnconfig archives). Items are converted to hex strings on access.
+	"""
+	__slots__ = ("data", )
+
+	def __init__(self, data=b""):
+		assert len(data) % 16 == 0, len(data)
+		self.data = bytes(data)
+
+	@classmethod
+	def fromhex(cls, text):
+		# bytes.fromhex() skips the whitespace between hashes
+		return cls(bytes.fromhex(text))
+
+	def __repr__(self):
+		return "<%s: %i hashes>" % (self.__class__.__name__, len(self))
+
+	def __len__(self):
+		return len(self.data) // 16
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return self.__class__(b"".join(self.digests()[index]))
+		return hexlify(self.digest(index)).decode()
+
+	def __iter__(self):
+		data = self.data
+		for i in range(0, len(data), 16):
+			yield hexlify(data[i:i+16]).decode()
+
+	def __contains__(self, hash):
+		if isinstance(hash, str):
+			try:
+				hash = bytes.fromhex(hash)
+			except ValueError:
+				return False
+		if len(hash) != 16:
+			return False
+		pos = self.data.find(hash)
+		while pos != -1:
+			if pos % 16 == 0:
+				return True
+			pos = self.data.find(hash, pos + 1)
+		return False
+
+	def __eq__(self, other):
+		if isinstance(other, HashArray):
+			return self.data == other.data
+		if isinstance(other, (list, tuple)):
+			return list(self) == [hash.lower() for hash in other]
+		return NotImplemented
+
+	def digest(self, index):
+		length = len(self)
+		if index < 0:
+			index += length
+		if not 0 <= index < length:
+			raise IndexError("HashArray index out of range")
+		return self.data[index*16:index*16+16]
+
+	def digests(self):
+		data = self.data
+		return [data[i:i+16] for i in range(0, len(data), 16)]
+
+
+def loads(text, compact=False):
+	"""
+	Parse a config file. Values with spaces are returned as lists.
+	If compact is set, lists of hashes are returned as HashArray.
+	"""
+	if isinstance(text, bytes):
+		text = text.decode("utf-8")
 
-def load(file):
 	ret = {}
-	while True:
-		line = file.readline()
+	for line in text.splitlines():
 		if line.startswith("#"):
 			# comment
 			continue
 
-		if not line:
-			# end of file
-			break
-
 		line = line.strip()
 		if not line:
 			# blank line
 			continue
 
-		assert line.count("=") == 1
-		if line.endswith("="):
+		key, _, value = line.partition("=")
+		assert "=" not in value
+		key = key.strip()
+		value = value.strip()
+		if not value:
 			# no value
-			key = line.split("=")[0]
 			value = None
-		else:
-			key, value = line.split(" = ")
-			if " " in value:
+		elif " " in value:
+			if compact and HASH_LIST_REGEX.fullmatch(value):
+				value = HashArray.fromhex(value)
+			else:
 				value = value.split()
 		ret[key] = value
 
 	return ret
 
 
-def loads(text):
-	return load(StringIO(text))
+def load(file, compact=False):
+	return loads(file.read(), compact)
+
+
+def load_cached(path, hash=None, compact=True):
+	"""
+	Parse the config at path, caching the result by the config's own md5.
+	If hash is not given, it is computed from the file contents.
+	The returned dict is shared between callers and must not be modified.
+	"""
+	data = None
+	if hash is None:
+		data = storage.read(path)
+		hash = md5(data).hexdigest()
+
+	key = (hash, compact)
+	ret = _cache.get(key)
+	if ret is not None:
+		return ret
+
+	if data is None:
+		data = storage.read(path)
+	ret = loads(data, compact)
+
+	_cache.set(key, ret)
+	return ret
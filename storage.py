@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+Optionally compressed at-rest storage for text metadata: catalogs,
+configs, mfil and torrent files and the NGDPv0 files.
+Usage (to compress an existing tree):
+	storage.py [--compression xz] [path...]
+
+When MPQ_COMPRESSION is set to gz or xz, new files are written as
+<path>.gz or <path>.xz. Reads look for <path>, then for its compressed
+variants, and always return the uncompressed bytes: hash-named files are
+still checked against the md5 of their uncompressed contents. Files whose
+own name ends in .gz or .xz should not go through this module.
+"""
+
+import io
+import logging
+import os
+import sys
+import threading
+from argparse import ArgumentParser
+from hashlib import md5
+
+
+MPQ_BASE_DIR = os.environ.get("MPQ_BASE_DIR", os.path.join(os.environ.get("XDG_DATA_HOME", os.path.join(os.path.expanduser("~"), ".local", "share")), "mpq"))
+COMPRESSION = os.environ.get("MPQ_COMPRESSION", "")
+# Extension -> module providing compress() and decompress(), imported on
+# first use to keep them off the startup path of the tools
+FORMATS = {
+	"gz": "gzip",
+	"xz": "lzma",
+}
+
+
+def _codec(compression):
+	from importlib import import_module
+	return import_module(FORMATS[compression])
+
+
+def extension(path):
+	"Returns the compression extension of path (eg. '.xz'), or ''"
+	ext = os.path.splitext(path)[1]
+	return ext if ext[1:] in FORMATS else ""
+
+
+def find(path):
+	"Returns the path of the stored (possibly compressed) file for path, or None"
+	if os.path.exists(path):
+		return path
+	for ext in FORMATS:
+		if os.path.exists(path + "." + ext):
+			return path + "." + ext
+
+
+def exists(path):
+	return find(path) is not None
+
+
+def read(path):
+	"Returns the uncompressed contents of the file stored for path"
+	stored = find(path)
+	if stored is None:
+		raise FileNotFoundError("No such file: %r" % (path))
+	with io.open(stored, "rb") as f:
+		data = f.read()
+	ext = extension(stored)
+	if ext:
+		data = _codec(ext[1:]).decompress(data)
+	return data
+
+
+def open(path):
+	"Returns a binary file object of the uncompressed contents stored for path"
+	stored = find(path)
+	if stored is not None and not extension(stored):
+		return io.open(stored, "rb")
+	return io.BytesIO(read(path))
+
+
+def write(path, data, compression=None):
+	"""
+	Atomically write data for path, compressed with compression (defaults
+	to MPQ_COMPRESSION). Returns the path of the file that was written.
+	"""
+	if compression is None:
+		compression = COMPRESSION
+	if compression:
+		if compression not in FORMATS:
+			raise ValueError("Unknown compression %r (choices: %s)" % (compression, ", ".join(sorted(FORMATS))))
+		data = _codec(compression).compress(data)
+		path += "." + compression
+
+	dirname = os.path.dirname(path)
+	if dirname:
+		os.makedirs(dirname, exist_ok=True)
+	tmp = "%s.%i-%i.part" % (path, os.getpid(), threading.get_ident())
+	with io.open(tmp, "wb") as f:
+		f.write(data)
+	os.replace(tmp, path)
+	return path
+
+
+def compress(path, compression):
+	"""
+	Compress the plain file at path in place. The compressed copy is read
+	back and compared before the original is removed.
+	Returns the new path.
+	"""
+	with io.open(path, "rb") as f:
+		data = f.read()
+	new_path = write(path, data, compression)
+	if md5(read(new_path)).digest() != md5(data).digest():
+		os.remove(new_path)
+		raise IOError("Compressed copy of %r does not match the original" % (path))
+	os.remove(path)
+	return new_path
+
+
+def _compressible(root, filename):
+	if filename.endswith((".mfil", ".torrent")):
+		return True
+	parts = os.path.abspath(root).split(os.sep)
+	if "Clog" in parts or "NGDPv0" in parts:
+		return True
+	# NGDP/<path>/config/xx/yy/<hash>
+	return "NGDP" in parts and len(parts) >= 3 and parts[-3] == "config"
+
+
+def compress_tree(base, compression):
+	"Compress the metadata files under base. Returns (files, bytes before, bytes after)."
+	# Absolute, to match the absolute links written by Catalog.preload
+	base = os.path.abspath(base)
+	renamed = {}
+	links = []
+	count, before, after = 0, 0, 0
+	for root, dirnames, filenames in os.walk(base):
+		for filename in filenames:
+			path = os.path.join(root, filename)
+			if os.path.islink(path):
+				links.append(path)
+				continue
+			if extension(filename) or filename.endswith(".part") or not _compressible(root, filename):
+				continue
+			size = os.path.getsize(path)
+			new_path = compress(path, compression)
+			logging.debug("Compressed %r", path)
+			renamed[os.path.normpath(path)] = new_path
+			count += 1
+			before += size
+			after += os.path.getsize(new_path)
+
+	# Point the links (eg. Clog/<name>.json) to the compressed files
+	for link in links:
+		target = os.readlink(link)
+		new_target = renamed.get(os.path.normpath(os.path.join(os.path.dirname(link), target)))
+		if new_target:
+			if not os.path.isabs(target):
+				new_target = os.path.relpath(new_target, os.path.dirname(link))
+			os.remove(link)
+			os.symlink(new_target, link + extension(new_target))
+
+	return count, before, after
+
+
+def main():
+	logging.basicConfig(level=logging.INFO)
+	arguments = ArgumentParser(prog="storage")
+	arguments.add_argument("--compression", type=str, dest="compression", default=COMPRESSION or "xz", choices=sorted(FORMATS), help="compression to use (defaults to $MPQ_COMPRESSION, or xz)")
+	arguments.add_argument("paths", type=str, nargs="*", help="directories to compress (defaults to $MPQ_BASE_DIR)")
+	args = arguments.parse_args(sys.argv[1:])
+
+	for path in args.paths or [MPQ_BASE_DIR]:
+		count, before, after = compress_tree(path, args.compression)
+		print("%s: %i files compressed, %i -> %i bytes" % (path, count, before, after))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Tests for the build-to-build diffs of patchdl --from-build.
+Usage:
+	python -m unittest test_builddiff
+"""
+
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import builddiff
+
+
+OLD = {
+	"Data/base.MPQ": (100, "1"),
+	"Data/enUS/locale.MPQ": (50, "1"),
+	"Data/patch.MPQ": (10, "1"),
+	"Data/old.MPQ": (5, None),
+	"Launcher.exe": (7, None),
+	"Blizzard Updater.exe": (9, None),
+}
+NEW = {
+	"Data/base.MPQ": (100, "1"),
+	# Same size, other flags
+	"Data/enUS/locale.MPQ": (50, "3"),
+	"Data/patch.MPQ": (20, "1"),
+	"Data/new.MPQ": (8, None),
+	"Launcher.exe": (7, None),
+	"Blizzard Updater.exe": (11, None),
+}
+BASE_URL = "http://example.com/wow-pod/16000.direct/"
+
+
+class BuildDiffTest(unittest.TestCase):
+	def setUp(self):
+		self.base = tempfile.mkdtemp()
+		self.old_dir = os.path.join(self.base, "WoW", "15050.direct")
+		self.new_dir = os.path.join(self.base, "WoW", "16000.direct")
+		for file, (size, flags) in OLD.items():
+			self.write(self.old_dir, file, b"o" * size)
+
+	def tearDown(self):
+		shutil.rmtree(self.base)
+
+	def write(self, dir, file, data):
+		path = os.path.join(dir, file)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "wb") as f:
+			f.write(data)
+
+	def test_diff(self):
+		added, removed, changed = builddiff.diff(OLD, NEW)
+		self.assertEqual(added, ["Data/new.MPQ"])
+		self.assertEqual(removed, ["Data/old.MPQ"])
+		self.assertEqual(changed, ["Blizzard Updater.exe", "Data/enUS/locale.MPQ", "Data/patch.MPQ"])
+		self.assertEqual(builddiff.diff(OLD, OLD), ([], [], []))
+
+	def test_build_files(self):
+		torrent = {"info": {"files": [
+			{"type": "file", "path": ["Data", "a.MPQ"], "length": 3},
+			{"type": "file", "path": ["b.exe"], "length": 4},
+			{"type": "alignment", "path": ["pad"], "length": 1},
+		]}}
+		mfil = {"file": {
+			"Data/a.MPQ": {"size": "3", "flags": "1"},
+			"Data": {"size": "0"},
+			"c.txt": {"size": 5},
+		}}
+		self.assertEqual(builddiff.build_files(mfil, torrent), {
+			"Data/a.MPQ": (3, "1"),
+			"b.exe": (4, None),
+			"c.txt": (5, None),
+		})
+
+	def test_update_in_place(self):
+		commands, downloads = builddiff.update(OLD, NEW, self.old_dir, self.old_dir, BASE_URL)
+		self.assertEqual(downloads, [
+			(BASE_URL + "Blizzard Updater.exe", 11),
+			(BASE_URL + "Data/enUS/locale.MPQ", 50),
+			(BASE_URL + "Data/patch.MPQ", 20),
+			(BASE_URL + "Data/new.MPQ", 8),
+		])
+		self.assertFalse(any(command.startswith("cp ") for command in commands))
+		self.assertEqual(commands[-1], builddiff.rm(os.path.join(self.old_dir, "Data/old.MPQ")))
+
+	def test_update_resume(self):
+		# Files that already have their new size were updated by a previous run
+		self.write(self.old_dir, "Data/patch.MPQ", b"n" * 20)
+		self.write(self.old_dir, "Data/new.MPQ", b"n" * 8)
+		self.write(self.old_dir, "Blizzard Updater.exe", b"n" * 11)
+		os.remove(os.path.join(self.old_dir, "Data/old.MPQ"))
+		commands, downloads = builddiff.update(OLD, NEW, self.old_dir, self.old_dir, BASE_URL)
+		# A flags-only change cannot be told apart, it is always downloaded
+		self.assertEqual(downloads, [(BASE_URL + "Data/enUS/locale.MPQ", 50)])
+		self.assertEqual(len(commands), 1)
+
+	def test_update_to_new_dir(self):
+		commands, downloads = builddiff.update(OLD, NEW, self.old_dir, self.new_dir, BASE_URL)
+		self.assertEqual(commands[0], "mkdir -p %s && cp -aln %s/. %s/ &&" % (self.new_dir, self.old_dir, self.new_dir))
+		self.assertEqual(len(downloads), 4)
+		# Changed and added files are unlinked from old_dir before they are downloaded
+		for file in ("Data/enUS/locale.MPQ", "Data/new.MPQ"):
+			path = os.path.join(self.new_dir, file)
+			self.assertLess(commands.index(builddiff.rm(path)), commands.index(builddiff.curl(BASE_URL + file, path)))
+		self.assertIn(builddiff.rm(os.path.join(self.new_dir, "Data/old.MPQ")), commands)
+
+	def test_quoting(self):
+		commands, downloads = builddiff.update(OLD, NEW, self.old_dir, self.new_dir, BASE_URL)
+		path = os.path.join(self.new_dir, "Blizzard Updater.exe")
+		rm = [shlex.split(command)[:-1] for command in commands if command.startswith("rm ")]
+		self.assertIn(["rm", "-f", path], rm)
+		curl = [shlex.split(command) for command in commands if command.startswith("curl ")]
+		self.assertIn(["curl", "-#", "--fail", "--create-dirs", BASE_URL + "Blizzard Updater.exe", "-o", path, "&&"], curl)
+
+	@unittest.skipUnless(shutil.which("bash") and shutil.which("cp"), "needs bash and cp")
+	def test_update_commands(self):
+		"Run the commands (with a fake curl) and check both trees"
+		# A stray copy of an added file must not be overwritten through its link
+		self.write(self.old_dir, "Data/new.MPQ", b"o" * 8)
+		# A file in the working directory that an unquoted rm would remove
+		self.write(self.base, "Updater.exe", b"o")
+		commands, downloads = builddiff.update(OLD, NEW, self.old_dir, self.new_dir, BASE_URL)
+		script = 'curl() { mkdir -p "$(dirname "${@: -1}")"; printf "%0${SIZE}d" 0 > "${@: -1}"; }\n'
+		# Give every downloaded file its new size
+		for command in commands:
+			if command.startswith("curl "):
+				file = shlex.split(command)[4][len(BASE_URL):]
+				command = "SIZE=%i %s" % (NEW[file][0], command)
+			script += command + "\n"
+		subprocess.check_call(["bash", "-c", script + "true"], cwd=self.base)
+		self.assertTrue(os.path.exists(os.path.join(self.base, "Updater.exe")))
+
+		for file, (size, flags) in NEW.items():
+			self.assertEqual(os.path.getsize(os.path.join(self.new_dir, file)), size, file)
+		self.assertFalse(os.path.exists(os.path.join(self.new_dir, "Data/old.MPQ")))
+		# The old tree is untouched
+		for file, (size, flags) in list(OLD.items()) + [("Data/new.MPQ", (8, None))]:
+			with open(os.path.join(self.old_dir, file), "rb") as f:
+				self.assertEqual(f.read(), b"o" * size, file)
+		# Unchanged files are shared
+		self.assertEqual(os.stat(os.path.join(self.new_dir, "Data/base.MPQ")).st_ino, os.stat(os.path.join(self.old_dir, "Data/base.MPQ")).st_ino)
+
+
+if __name__ == "__main__":
+	unittest.main()
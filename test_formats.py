@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Round-trip tests for the NGDP binary formats: BLTE, encoding tables,
+install and patch manifests and archive indexes.
+Usage:
+	python -m unittest test_formats
+"""
+
+import os
+import struct
+import unittest
+from hashlib import md5
+
+import archiveindex
+import blte
+from bench import make_index
+from install import InstallError, InstallManifest
+from patch import PatchError, PatchManifest
+
+
+def make_encoding(files, page_size=4096):
+	"""
+	Build an encoding table for files, a list of (ckey, ekey, size,
+	encoded size) digests and sizes, with a single espec.
+	"""
+	ckey_page = b"".join(
+		bytes([1]) + size.to_bytes(5, "big") + ckey + ekey
+		for ckey, ekey, size, encoded_size in sorted(files)
+	).ljust(page_size, b"\0")
+	espec_page = b"".join(
+		ekey + struct.pack(">I", 0) + encoded_size.to_bytes(5, "big")
+		for ekey, ckey, size, encoded_size in sorted((f[1], f[0], f[2], f[3]) for f in files)
+	).ljust(page_size, b"\0")
+	especs = b"z\0"
+	header = struct.pack(">2sBBBHHIIBI", b"EN", 1, 16, 16, page_size // 1024, page_size // 1024, 1, 1, 0, len(especs))
+	return (
+		header + especs
+		+ min(f[0] for f in files) + md5(ckey_page).digest() + ckey_page
+		+ min(f[1] for f in files) + md5(espec_page).digest() + espec_page
+	)
+
+
+def make_install(tags, entries):
+	"""
+	Build an install manifest. tags is a list of (name, type, indices of
+	the entries having the tag), entries a list of (name, ckey, size).
+	"""
+	mask_size = (len(entries) + 7) // 8
+	data = struct.pack(">2sBBHI", b"IN", 1, 16, len(tags), len(entries))
+	for name, type, indices in tags:
+		mask = sum(1 << (mask_size * 8 - 1 - i) for i in indices)
+		data += name.encode("utf-8") + b"\0" + struct.pack(">H", type) + mask.to_bytes(mask_size, "big")
+	for name, ckey, size in entries:
+		data += name.encode("utf-8") + b"\0" + ckey + struct.pack(">I", size)
+	return data
+
+
+def make_patch(ckey, size, records, block_size_bits=8):
+	"""
+	Build a patch manifest with a single file ckey (of decoded size size),
+	patched by records: a list of (source ekey, source size, patch ekey,
+	patch size) digests and sizes.
+	"""
+	entry = bytes([len(records)]) + ckey + size.to_bytes(5, "big")
+	for source_ekey, source_size, patch_ekey, patch_size in records:
+		entry += source_ekey + source_size.to_bytes(5, "big") + patch_ekey + struct.pack(">IB", patch_size, 0)
+	block = entry.ljust(1 << block_size_bits, b"\0")
+	header = struct.pack(">2sBBBBBHB", b"PA", 1, 16, 16, 16, block_size_bits, 1, 0)
+	header += bytes(32) + struct.pack(">IIB", 0, 0, 1) + b"z"
+	offset = len(header) + 16 + 16 + 4
+	return header + ckey + md5(block).digest() + struct.pack(">I", offset) + block
+
+
+class BLTETest(unittest.TestCase):
+	def test_round_trip(self):
+		data = os.urandom(1000) + bytes(1000)
+		for mode in (b"Z", b"N"):
+			encoded = blte.encode(data, mode)
+			self.assertEqual(blte.decode(encoded), data)
+
+	def test_ekey(self):
+		encoded = blte.encode(b"hello")
+		header_size, = struct.unpack_from(">I", encoded, 4)
+		self.assertEqual(blte.ekey(encoded), md5(encoded[:header_size]).hexdigest())
+
+	def test_corrupt_chunk(self):
+		encoded = bytearray(blte.encode(b"hello", b"N"))
+		encoded[-1] ^= 0xff
+		with self.assertRaises(blte.BLTEError):
+			blte.decode(bytes(encoded))
+		self.assertNotEqual(blte.decode(bytes(encoded), verify=False), b"hello")
+
+
+class EncodingTableTest(unittest.TestCase):
+	def setUp(self):
+		import encoding
+		self.encoding = encoding
+		self.files = [(os.urandom(16), os.urandom(16), 100 + i, 50 + i) for i in range(20)]
+		self.data = make_encoding(self.files)
+
+	def test_lookup(self):
+		table = self.encoding.EncodingTable(self.data)
+		self.assertEqual(len(table), len(self.files))
+		for ckey, ekey, size, encoded_size in self.files:
+			self.assertEqual(table.get(ckey.hex()), ekey.hex())
+			self.assertEqual(table.size(ckey), size)
+			self.assertEqual(table.encoded_size(ekey), encoded_size)
+			self.assertEqual(table.espec(ekey), "z")
+		self.assertIsNone(table.get(os.urandom(16)))
+		self.assertEqual(table.lookup_hex([self.files[0][0], os.urandom(16)]), [self.files[0][1].hex(), None])
+
+	def test_corrupt_page(self):
+		data = bytearray(self.data)
+		data[-1] ^= 0xff
+		with self.assertRaises(self.encoding.EncodingError):
+			self.encoding.EncodingTable(bytes(data))
+		self.encoding.EncodingTable(bytes(data), verify=False)
+
+
+class InstallManifestTest(unittest.TestCase):
+	def setUp(self):
+		entries = [("f%i" % (i), os.urandom(16), i) for i in range(10)]
+		tags = [
+			("Windows", 1, [0, 1, 2, 3, 8]),
+			("OSX", 1, [4, 5, 6, 7, 9]),
+			("enUS", 3, [0, 2, 4, 6, 8, 9]),
+			("deDE", 3, [1, 3, 5, 7]),
+		]
+		self.manifest = InstallManifest(make_install(tags, entries))
+		self.entries = entries
+
+	def names(self, tags):
+		return [entry.name for entry in self.manifest.select(tags)]
+
+	def test_parse(self):
+		self.assertEqual(len(self.manifest), 10)
+		self.assertEqual(self.manifest.tag_names(), ["Windows", "OSX", "enUS", "deDE"])
+		self.assertEqual(self.manifest.entries[3].ckey, self.entries[3][1].hex())
+
+	def test_select(self):
+		self.assertEqual(self.names(["Windows", "enUS"]), ["f0", "f2", "f8"])
+		# Tags of the same type are alternatives
+		self.assertEqual(self.names(["windows", "enUS", "deDE"]), ["f0", "f1", "f2", "f3", "f8"])
+		self.assertEqual(self.names(["OSX"]), ["f4", "f5", "f6", "f7", "f9"])
+
+	def test_unknown_tag(self):
+		with self.assertRaises(InstallError):
+			self.manifest.select(["x86_64"])
+
+
+class PatchManifestTest(unittest.TestCase):
+	def test_round_trip(self):
+		ckey = os.urandom(16)
+		records = [(os.urandom(16), 1000, os.urandom(16), 42), (os.urandom(16), 900, os.urandom(16), 84)]
+		manifest = PatchManifest(make_patch(ckey, 1234, records))
+		self.assertEqual(len(manifest), 1)
+		self.assertIn(ckey.hex(), manifest)
+		got = manifest.get(ckey.hex())
+		self.assertEqual([(r.source_ekey, r.source_size, r.patch_ekey, r.patch_size) for r in got], [(a.hex(), b, c.hex(), d) for a, b, c, d in records])
+		self.assertEqual(manifest.get(os.urandom(16).hex()), [])
+
+	def test_corrupt_block(self):
+		data = bytearray(make_patch(os.urandom(16), 1, [(os.urandom(16), 1, os.urandom(16), 1)]))
+		data[-1] ^= 0xff
+		with self.assertRaises(PatchError):
+			PatchManifest(bytes(data))
+
+
+class ArchiveIndexTest(unittest.TestCase):
+	def setUp(self):
+		# 400 entries span three blocks
+		self.data = make_index(400, 400 * 100)
+
+	def test_entries(self):
+		index = archiveindex.ArchiveIndex(self.data)
+		entries = list(index)
+		self.assertEqual(len(index), 400)
+		self.assertEqual(len(entries), 400)
+		self.assertEqual([entry.ekey for entry in entries], sorted(entry.ekey for entry in entries))
+		self.assertEqual(index.archive_size, 400 * 100)
+		self.assertEqual(index.total_size, 400 * 100)
+
+	def test_hasher(self):
+		for chunk_size in (1, 1000, 4096, 5000, len(self.data)):
+			hasher = archiveindex.IndexHasher()
+			for i in range(0, len(self.data), chunk_size):
+				hasher.update(self.data[i:i+chunk_size])
+			self.assertIsNone(hasher.error(), chunk_size)
+
+	def test_hasher_errors(self):
+		data = bytearray(self.data)
+		data[5000] ^= 0xff
+		hasher = archiveindex.IndexHasher()
+		hasher.update(bytes(data))
+		self.assertIn("block 1", hasher.error())
+
+		hasher = archiveindex.IndexHasher()
+		hasher.update(self.data[:4096] + self.data[-100:])
+		self.assertIn("truncated", hasher.error())
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Tests for the compressed at-rest storage of text metadata.
+Usage:
+	python -m unittest test_storage
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import storage
+
+
+class StorageTest(unittest.TestCase):
+	def setUp(self):
+		self.base = tempfile.mkdtemp()
+		self.cwd = os.getcwd()
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.base)
+
+	def test_read_write(self):
+		path = os.path.join(self.base, "NGDP", "tpr", "config", "ab", "cd", "abcd")
+		for compression in [""] + sorted(storage.FORMATS):
+			stored = storage.write(path, b"hello", compression)
+			self.assertEqual(stored, path + ("." + compression if compression else ""))
+			self.assertEqual(storage.read(path), b"hello")
+			with storage.open(path) as f:
+				self.assertEqual(f.read(), b"hello")
+			os.remove(stored)
+		self.assertFalse(storage.exists(path))
+
+	def make_tree(self, relative_links=False):
+		"Write a Clog object and its named link, like Catalog.preload does"
+		mpq = os.path.join(self.base, "mpq")
+		target = os.path.join(mpq, "Clog", "ab", "cd", "abcd")
+		storage.write(target, b"{}", "")
+		link = os.path.join(mpq, "Clog", "foo.json")
+		os.symlink(os.path.relpath(target, os.path.dirname(link)) if relative_links else target, link)
+		return target, link
+
+	def check_tree(self, target, link):
+		self.assertFalse(os.path.exists(target))
+		self.assertFalse(os.path.lexists(link))
+		self.assertEqual(os.path.realpath(link + ".gz"), os.path.realpath(target + ".gz"))
+		self.assertEqual(storage.read(link), b"{}")
+
+	def test_compress_tree(self):
+		target, link = self.make_tree()
+		self.assertEqual(storage.compress_tree(os.path.join(self.base, "mpq"), "gz")[0], 1)
+		self.check_tree(target, link)
+
+	def test_compress_tree_relative_base(self):
+		target, link = self.make_tree()
+		os.chdir(self.base)
+		self.assertEqual(storage.compress_tree("mpq", "gz")[0], 1)
+		self.check_tree(target, link)
+
+	def test_compress_tree_relative_links(self):
+		target, link = self.make_tree(relative_links=True)
+		os.chdir(self.base)
+		storage.compress_tree("./mpq", "gz")
+		self.check_tree(target, link)
+		self.assertFalse(os.path.isabs(os.readlink(link + ".gz")))
+
+
+if __name__ == "__main__":
+	unittest.main()